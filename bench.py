@@ -0,0 +1,479 @@
+"""Load test for server.py, thousands of simulated clients on one asyncio loop
+
+The clients speak the framed protocol of client.py, or the old text protocol
+with --protocol legacy. They answer HEARTBEAT, COMMAND and "cmd ..." at once
+and can ping the server themselves. Commands are fanned out with the group
+command over an API session; the server's own round trip percentiles, thread
+count and memory are read the same way.
+
+    python bench.py --spawn --mode loop --clients 2000 --json baseline.json
+    python bench.py --spawn --mode loop --clients 2000 --baseline baseline.json
+    python bench.py --spawn --clients 2000 --restart
+    python bench.py --spawn --clients 3000 --reconnect jitter --drop --server-args --accept-rate 500
+    python bench.py --spawn --federation --clients 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import protocol
+
+def percentiles(samples: list, scale: float = 1000) -> dict:
+    """p50 / p95 / p99 / max of samples, in ms by default"""
+    if not samples: return {}
+    samples = sorted(samples)
+    def at(q): return round(samples[min(int(q * len(samples)), len(samples) - 1)] * scale, 3)
+    return {'p50': at(0.5), 'p95': at(0.95), 'p99': at(0.99), 'max': round(samples[-1] * scale, 3)}
+
+class Stats:
+    """Numbers of one run, shared by every simulated client"""
+    def __init__(self):
+        self.handshakes = []
+        self.connect_failed = 0
+        self.connect_retries = 0
+        self.retry_after = 0
+        self.disconnected = 0
+        self.heartbeats_answered = 0
+        self.commands_answered = 0
+        self.pings_sent = 0
+        self.ping_rtts = []
+        self.first_connect: float = None
+        self.last_connect: float = None
+
+class SimClient:
+    """One simulated client"""
+    def __init__(self, index: int, args, stats: Stats):
+        self.identifier = args.id_prefix + f"{index:X}".rjust(16 - len(args.id_prefix), '0')
+        self.args = args
+        self.stats = stats
+        self.connected = asyncio.Event()
+        # Set once connected or failed
+        self.settled = asyncio.Event()
+        self.task: asyncio.Future = None
+        self.writer: asyncio.StreamWriter = None
+        self.ping_sent: float = None
+        # Got HELLO_ACK on the current connection / the server's RETRY_AFTER hint
+        self.admitted = False
+        self.retry_after: float = None
+        # Start of the current (re)connect, the handshake time counts from here
+        self.started: float = None
+
+    async def run(self):
+        self.started = time.perf_counter()
+        if self.stats.first_connect is None: self.stats.first_connect = self.started
+        attempt = 0
+        while True:
+            await self._session()
+            if self.args.reconnect == 'none': return
+            if self.admitted: attempt = 0
+            # fixed is what client.py did before the jitter: 5 seconds, hint or not
+            if self.args.reconnect == 'fixed': delay = 5
+            else: delay = protocol.backoff_delay(attempt, self.args.backoff_base, self.args.backoff_cap, self.retry_after)
+            attempt += 1
+            self.stats.connect_retries += 1
+            await asyncio.sleep(delay)
+
+    async def _session(self):
+        """One connection, until it is closed"""
+        stats = self.stats
+        self.admitted, self.retry_after = False, None
+        try:
+            reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.args.host, self.args.port), self.args.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self._failed()
+            return
+        pinger = None
+        try:
+            if self.args.protocol == 'legacy':
+                self.writer.write(f"IDENTIFIER:{self.identifier}".encode('utf-8'))
+                # No answer in the text protocol, the server has it once it is sent
+                await self.writer.drain()
+                self._connected()
+            else:
+                hello = protocol.encode_hello(self.identifier, self.args.features)
+                self.writer.write(protocol.MAGIC + protocol.encode_frame(protocol.HELLO, hello))
+            if self.args.ping: pinger = asyncio.ensure_future(self._ping())
+            if self.args.protocol == 'legacy': await self._read_legacy(reader)
+            else: await self._read_framed(reader)
+        except (OSError, asyncio.IncompleteReadError, protocol.FrameError):
+            pass
+        finally:
+            if pinger: pinger.cancel()
+            if self.connected.is_set():
+                self.connected.clear()
+                stats.disconnected += 1
+                self.started = time.perf_counter()
+            elif not self.admitted: self._failed()
+            self.writer.close()
+
+    def drop(self):
+        """Close the connection as a network failure would, the client comes back by --reconnect"""
+        self.connected.clear()
+        self.started = time.perf_counter()
+        self.writer.close()
+
+    def _connected(self):
+        now = time.perf_counter()
+        self.admitted = True
+        self.stats.handshakes.append(now - self.started)
+        self.stats.last_connect = now
+        self.connected.set()
+        self.settled.set()
+
+    def _failed(self):
+        if self.args.reconnect != 'none': return
+        self.stats.connect_failed += 1
+        self.settled.set()
+
+    async def _read_framed(self, reader: asyncio.StreamReader):
+        decoder = protocol.FrameDecoder()
+        encoder = protocol.FrameEncoder()
+        while True:
+            data = await reader.read(65536)
+            if not data: return
+            decoder.feed(data)
+            for ftype, payload in decoder.frames():
+                if ftype == protocol.HELLO_ACK:
+                    if protocol.FEATURE_ZLIB in protocol.decode_features(payload):
+                        decoder.inflate = encoder.compress = True
+                    self._connected()
+                elif ftype == protocol.RETRY_AFTER:
+                    self.retry_after = protocol.decode_retry_after(payload)
+                    self.stats.retry_after += 1
+                elif ftype == protocol.HEARTBEAT:
+                    self.writer.write(protocol.encode_frame(protocol.HEARTBEAT_RESPONSE))
+                    self.stats.heartbeats_answered += 1
+                elif ftype == protocol.HEARTBEAT_RESPONSE: self._pong()
+                elif ftype in (protocol.COMMAND, protocol.RUN):
+                    rid, _ = protocol.decode_request(payload)
+                    self.writer.write(encoder.encode(protocol.COMMAND_RESULT, protocol.encode_request(rid, self.args.reply)))
+                    self.stats.commands_answered += 1
+                elif ftype == protocol.MESSAGE and bytes(payload[:4]) == b'cmd ':
+                    self.writer.write(encoder.encode(protocol.CMDRES, self.args.reply))
+                    self.stats.commands_answered += 1
+
+    async def _read_legacy(self, reader: asyncio.StreamReader):
+        while True:
+            data = await reader.read(65536)
+            if not data: return
+            if data == b'HEARTBEAT':
+                self.writer.write(b'HEARTBEAT_RESPONSE')
+                self.stats.heartbeats_answered += 1
+            elif data == b'HEARTBEAT_RESPONSE': self._pong()
+            elif data.startswith(b'cmd '):
+                self.writer.write(b'CMDRES:' + self.args.reply)
+                self.stats.commands_answered += 1
+
+    async def _ping(self):
+        await self.connected.wait()
+        # Spread the pings of all clients over the interval
+        await asyncio.sleep(self.args.ping * (int(self.identifier, 16) % 1000) / 1000)
+        while True:
+            self.ping_sent = time.perf_counter()
+            self.stats.pings_sent += 1
+            if self.args.protocol == 'legacy': self.writer.write(b'HEARTBEAT')
+            else: self.writer.write(protocol.encode_frame(protocol.HEARTBEAT))
+            await asyncio.sleep(self.args.ping)
+
+    def _pong(self):
+        if self.ping_sent is None: return
+        self.stats.ping_rtts.append(time.perf_counter() - self.ping_sent)
+        self.ping_sent = None
+
+class ApiSession:
+    """SESSION connection to the server console, see ApiSession in server.py"""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 0
+
+    @classmethod
+    async def open(cls, host: str, port: int, password: str) -> 'ApiSession':
+        reader, writer = await asyncio.open_connection(host, port, limit=1 << 20)
+        writer.write(f"SESSION:{password}\n".encode('utf-8'))
+        return cls(reader, writer)
+
+    async def run(self, command: str, timeout: float = 120) -> list:
+        """Output lines of one console command"""
+        self.next_id += 1
+        rid = str(self.next_id)
+        self.writer.write(f"{rid} {command}\n".encode('utf-8'))
+        lines = []
+        deadline = time.monotonic() + timeout
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), max(deadline - time.monotonic(), 0.001))
+            if not line: raise ConnectionError("API session closed")
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            if line == f"{rid} END": return lines
+            if line.startswith(f"{rid} | "): lines.append(line[len(rid) + 3:])
+            elif line.startswith("ERROR"): raise ConnectionError(line)
+
+    def close(self):
+        self.writer.close()
+
+async def restart_server(api: ApiSession, args) -> float:
+    """Seconds from the restart command until the new server answers"""
+    started = time.perf_counter()
+    api.writer.write(b"0 restart\n")
+    # The exec closes the session
+    while await asyncio.wait_for(api.reader.readline(), args.timeout): pass
+    deadline = time.monotonic() + args.timeout
+    while True:
+        try:
+            session = await ApiSession.open(args.host, args.port, args.password)
+            try: await session.run("now", 5)
+            finally: session.close()
+            return time.perf_counter() - started
+        except (OSError, asyncio.TimeoutError):
+            if time.monotonic() > deadline: raise
+            await asyncio.sleep(0.05)
+
+def spawn_server(args, port: int = None, extra: list = ()) -> subprocess.Popen:
+    """Start server.py in a scratch directory, its data file must not touch the real one"""
+    port = port or args.port
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in ('server.py', 'protocol.py'): shutil.copy(os.path.join(here, name), workdir)
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    command = [sys.executable, 'server.py', '--port', str(port), '--mode', args.mode] + list(extra) + args.server_args
+    # The console keeps reading stdin, the pipe stays open until the end
+    process = subprocess.Popen(command, cwd=workdir, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+    process.workdir = workdir
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None: raise RuntimeError(f"Server exited, see {log.name}")
+        try:
+            socket.create_connection((args.host, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start listening")
+
+def raise_file_limit(needed: int):
+    try: import resource
+    except ImportError: return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        try: resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard) if hard != resource.RLIM_INFINITY else needed, hard))
+        except (ValueError, OSError): pass
+
+async def connect_clients(args, stats: Stats) -> list:
+    """Connect storm: start every client at --connect-rate per second, 0 for all at once"""
+    clients = [SimClient(index, args, stats) for index in range(args.clients)]
+    started = time.perf_counter()
+    for index, client in enumerate(clients):
+        client.task = asyncio.ensure_future(client.run())
+        if args.connect_rate:
+            ahead = started + (index + 1) / args.connect_rate - time.perf_counter()
+            if ahead > 0: await asyncio.sleep(ahead)
+        elif index % 256 == 255: await asyncio.sleep(0)
+    waits = [asyncio.ensure_future(client.settled.wait()) for client in clients]
+    _, pending = await asyncio.wait(waits, timeout=args.timeout)
+    for wait in pending: wait.cancel()
+    return clients
+
+async def drop_clients(clients: list, stats: Stats, args) -> dict:
+    """Reconnect storm: every connected client loses its connection at once"""
+    dropped = [client for client in clients if client.connected.is_set()]
+    handshakes, retries, retry_after = len(stats.handshakes), stats.connect_retries, stats.retry_after
+    started = time.perf_counter()
+    for client in dropped: client.drop()
+    waits = [asyncio.ensure_future(client.connected.wait()) for client in dropped]
+    _, pending = await asyncio.wait(waits, timeout=args.timeout)
+    for wait in pending: wait.cancel()
+    return {
+        'dropped': len(dropped), 'reconnected': len(dropped) - len(pending),
+        'seconds': round(stats.last_connect - started, 3) if stats.last_connect and stats.last_connect > started else None,
+        'retries': stats.connect_retries - retries, 'retry_after': stats.retry_after - retry_after,
+        'handshake_ms': percentiles(stats.handshakes[handshakes:]),
+    }
+
+async def fan_out(api: ApiSession, args, count: int = None) -> tuple:
+    """Rounds of one command to every simulated client, (seconds per round, ok results)"""
+    rounds, ok = [], 0
+    for _ in range(args.rounds if count is None else count):
+        started = time.perf_counter()
+        lines = await api.run(f"group -q -c {args.concurrency} -t {args.command_timeout:g} {args.id_prefix}* {args.command}",
+                              args.command_timeout + 30)
+        rounds.append(time.perf_counter() - started)
+        for line in lines:
+            match = re.search(r'(\d+) ok', line)
+            if line.startswith("Group command finished") and match: ok += int(match.group(1))
+    return rounds, ok
+
+async def federate(args) -> dict:
+    """Clients connect to node b, each gets a "send" given to node a, which forwards it"""
+    stats = Stats()
+    node_b = argparse.Namespace(**vars(args))
+    node_b.port = args.port + 1
+    clients = await connect_clients(node_b, stats)
+    connected = [client for client in clients if client.connected.is_set()]
+    report = {'clients': args.clients, 'connected': len(connected)}
+    api = await ApiSession.open(args.host, args.port, args.password)
+    try:
+        # Node b writes its clients to the directory in batches
+        deadline = time.monotonic() + args.timeout
+        while not any(re.match(rf"\s*b .* {len(connected)} client", line) for line in await api.run("nodes")):
+            if time.monotonic() > deadline: raise RuntimeError("The clients of node b did not show up in the directory")
+            await asyncio.sleep(0.2)
+        answered, forwarded, sends = stats.commands_answered, 0, []
+        for client in connected:
+            started = time.perf_counter()
+            lines = await api.run(f"send {client.identifier} cmd {args.command}")
+            sends.append(time.perf_counter() - started)
+            if any(line.startswith("Forwarded to node b") for line in lines): forwarded += 1
+        while stats.commands_answered - answered < forwarded and time.monotonic() < deadline: await asyncio.sleep(0.1)
+        report.update({'forwarded': forwarded, 'delivered': stats.commands_answered - answered, 'send_ms': percentiles(sends)})
+        report['lookup'] = next((line.strip() for line in await api.run("nodes") if 'lookup' in line), None)
+    finally:
+        api.close()
+    for client in clients: client.task.cancel()
+    await asyncio.gather(*(client.task for client in clients), return_exceptions=True)
+    return report
+
+def parse_status(lines: list) -> dict:
+    status = {}
+    for line in lines:
+        line = line.strip()
+        if line.startswith("Threads:"): status['server_threads'] = int(line.split()[1])
+        elif line.startswith("Memory:") and 'MiB' in line: status['server_memory_mib'] = float(line.split()[1])
+        elif line.startswith("Round trip:"): status['server_round_trip'] = line[len("Round trip:"):].strip()
+    return status
+
+async def run(args) -> dict:
+    stats = Stats()
+    clients = await connect_clients(args, stats)
+    connected = sum(1 for client in clients if client.connected.is_set())
+    connect_seconds = (stats.last_connect - stats.first_connect) if stats.last_connect else 0
+    report = {
+        'protocol': args.protocol, 'clients': args.clients, 'connected': connected, 'connect_failed': stats.connect_failed,
+        'connect_pending': sum(1 for client in clients if not client.settled.is_set()),
+        'connect_seconds': round(connect_seconds, 3),
+        'connect_rate': round(connected / connect_seconds, 1) if connect_seconds else None,
+        'connect_retries': stats.connect_retries, 'retry_after': stats.retry_after,
+        'handshake_ms': percentiles(stats.handshakes),
+    }
+    api = await ApiSession.open(args.host, args.port, args.password)
+    try:
+        if args.duration: await asyncio.sleep(args.duration)
+        if args.drop:
+            report['reconnect'] = await drop_clients(clients, stats, args)
+            connected = sum(1 for client in clients if client.connected.is_set())
+        if args.restart:
+            # Compressed streams are under way when the clients are handed over
+            if args.rounds: await fan_out(api, args, 1)
+            report['restart_seconds'] = round(await restart_server(api, args), 3)
+            api = await ApiSession.open(args.host, args.port, args.password)
+        rounds, ok = await fan_out(api, args) if args.rounds else ([], 0)
+        report['fanout_ms'] = percentiles(rounds)
+        report['fanout_ok'] = ok
+        report['fanout_expected'] = connected * len(rounds)
+        report.update(parse_status(await api.run("pending")))
+        report.update(parse_status(await api.run("status")))
+    finally:
+        api.close()
+    report['heartbeats_answered'] = stats.heartbeats_answered
+    report['commands_answered'] = stats.commands_answered
+    report['pings_sent'] = stats.pings_sent
+    report['ping_rtt_ms'] = percentiles(stats.ping_rtts)
+    # Connections the server dropped while the run was still going
+    report['disconnected'] = stats.disconnected
+    for client in clients: client.task.cancel()
+    await asyncio.gather(*(client.task for client in clients), return_exceptions=True)
+    return report
+
+def flatten(report: dict, prefix: str = '') -> dict:
+    values = {}
+    for key, value in report.items():
+        if isinstance(value, dict): values.update(flatten(value, f"{prefix}{key}."))
+        else: values[prefix + key] = value
+    return values
+
+def print_report(report: dict, baseline: dict = None):
+    values = flatten(report)
+    old = flatten(baseline) if baseline else {}
+    width = max(len(key) for key in values)
+    for key, value in values.items():
+        line = f"  {key.ljust(width)}  {value}"
+        before = old.get(key)
+        if isinstance(value, (int, float)) and isinstance(before, (int, float)) and not isinstance(value, bool):
+            change = f", {(value - before) / before * 100:+.1f}%" if before else ""
+            line += f"  (baseline {before}{change})"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many clients against server.py")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=30003)
+    parser.add_argument('--password', default='frank666', help="API password of the server")
+    parser.add_argument('--spawn', action='store_true', help="Start server.py for the run and stop it afterwards")
+    parser.add_argument('--mode', choices=('thread', 'loop'), default='thread', help="Server mode with --spawn")
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[], help="More arguments for the spawned server")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--protocol', choices=('framed', 'legacy'), default='framed')
+    parser.add_argument('--features', default='rid', help="Features announced by framed clients, comma separated")
+    parser.add_argument('--id-prefix', default='BE', help="Hex prefix of the simulated identifiers")
+    parser.add_argument('--connect-rate', type=float, default=0, help="Connects per second, 0 for a storm")
+    parser.add_argument('--timeout', type=float, default=30, help="Seconds to wait for one connect / handshake")
+    parser.add_argument('--ping', type=float, default=0, help="Clients send HEARTBEAT every N seconds")
+    parser.add_argument('--duration', type=float, default=0, help="Seconds to hold the connections before the commands")
+    parser.add_argument('--restart', action='store_true', help="Restart the server before the commands, the clients should stay connected")
+    parser.add_argument('--reconnect', choices=('none', 'fixed', 'jitter'), default='none',
+                        help="How clients retry a failed or rejected connect: not at all, every 5 seconds, jittered backoff as client.py")
+    parser.add_argument('--backoff-base', type=float, default=1, help="First backoff of --reconnect jitter, doubled per attempt")
+    parser.add_argument('--backoff-cap', type=float, default=60, help="Longest backoff of --reconnect jitter")
+    parser.add_argument('--drop', action='store_true', help="Drop every connection at once before the commands, they reconnect by --reconnect")
+    parser.add_argument('--rounds', type=int, default=5, help="Command fan-out rounds")
+    parser.add_argument('--command', default='echo bench')
+    parser.add_argument('--reply-size', type=int, default=2, help="Bytes of output the clients answer a command with")
+    parser.add_argument('--concurrency', type=int, default=256, help="Clients running the command at once (group -c)")
+    parser.add_argument('--command-timeout', type=float, default=60)
+    parser.add_argument('--federation', action='store_true',
+                        help="With --spawn: start nodes a (--port) and b (--port + 1) sharing a directory, connect the clients to b and send to them through a")
+    parser.add_argument('--json', help="Write the report to this file, e.g. as a baseline")
+    parser.add_argument('--baseline', help="Compare with a report written by --json")
+    args = parser.parse_args()
+    if not all(c in '0123456789ABCDEF' for c in args.id_prefix) or len(args.id_prefix) > 8:
+        parser.error("--id-prefix has to be at most 8 upper case hex digits")
+    if args.drop and args.reconnect == 'none': parser.error("--drop needs --reconnect")
+    if args.federation and not args.spawn: parser.error("--federation needs --spawn")
+    args.features = {feature for feature in args.features.split(',') if feature}
+    args.reply = (b'ok\n' + b''.join(b'line %d of the command output\n' % i for i in range(args.reply_size // 20 + 1)))[:max(args.reply_size, 2)]
+    raise_file_limit(args.clients + 256)
+
+    processes, directory = [], None
+    try:
+        if args.federation:
+            directory = tempfile.mkdtemp(prefix='bench-directory-')
+            for index, node in enumerate('ab'):
+                processes.append(spawn_server(args, args.port + index, ['--node', node, '--directory', os.path.join(directory, 'clients.db')]))
+            report = asyncio.get_event_loop().run_until_complete(federate(args))
+        else:
+            if args.spawn: processes.append(spawn_server(args))
+            report = asyncio.get_event_loop().run_until_complete(run(args))
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+            shutil.rmtree(process.workdir, ignore_errors=True)
+        if directory: shutil.rmtree(directory, ignore_errors=True)
+    report['server_mode'] = args.mode if args.spawn else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f: baseline = json.load(f)
+    print(f"Benchmark of {args.host}:{args.port}:")
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -8,26 +8,207 @@ import random
 import json
 import logging
 import subprocess
+import codecs
+import locale
+import signal
+import hashlib
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from datetime import datetime
 import requests
 import winreg
 import re
 
-def download_file(url, filename=None):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36",
-        "Cookie": "__test=ffa305912029c869f9773fb4d23809a4"
-    }
-    response = requests.get(url, headers=headers)
-    if not filename:
-        content_disposition = response.headers.get('Content-Disposition')
-        if content_disposition:
-            fname = re.findall("filename=\"(.+)\"   ", content_disposition)
-            if fname: filename = fname[0].strip('"\'')
-    if not filename: filename = os.path.basename(url)
-    if not filename: filename = "downloaded_file"
-    with open(filename, 'wb') as f:
-        f.write(response.content)
+import protocol
+
+DOWNLOAD_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36",
+    "Cookie": "__test=ffa305912029c869f9773fb4d23809a4",
+    # Offsets of Range requests count the bytes as they are stored
+    "Accept-Encoding": "identity",
+}
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_RETRIES = 5
+# Smaller files are fetched over one connection
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+PROGRESS_INTERVAL = 2
+
+class DownloadStopped(Exception):
+    pass
+
+class Download:
+    """Streams a URL to "<file>.part" and renames it when it is complete
+
+    A broken connection goes on with a Range request, so does a later download
+    of the same file. With several connections a large file is fetched as that
+    many ranges at once, their positions are kept in "<file>.part.json".
+    """
+    def __init__(self, url, filename=None, sha256=None, size=None, connections=1, progress=None):
+        self.url = url
+        self.filename = filename
+        self.sha256 = sha256.lower() if sha256 else None
+        self.size = size
+        self.connections = max(1, connections)
+        # Called with (bytes in the file, total bytes or None, bytes per second) every PROGRESS_INTERVAL
+        self.progress = progress
+        self.total = None
+        self.received = 0
+        # Bytes fetched by this run, for the speed
+        self.fetched = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self) -> str:
+        """Download the file, return a summary"""
+        started = time.monotonic()
+        with requests.Session() as session:
+            session.headers.update(DOWNLOAD_HEADERS)
+            self.session = session
+            ranges_ok = self._probe()
+            part = self.filename + '.part'
+            state = part + '.json'
+            # Item: [start, position, end], end is None while the size is unknown
+            ranges = self._load_ranges(part, state, ranges_ok)
+            self.received = sum(position - start for start, position, _ in ranges)
+            if not self.received:
+                with open(part, 'wb') as file:
+                    if len(ranges) > 1: file.truncate(self.total)
+            try:
+                with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                    futures = [executor.submit(self._fetch, part, rng, len(ranges) == 1) for rng in ranges]
+                    try:
+                        while True:
+                            done, running = wait(futures, PROGRESS_INTERVAL, FIRST_EXCEPTION)
+                            for future in done: future.result()
+                            if not running: break
+                            if len(ranges) > 1: self._save(state, ranges)
+                            self._report(started)
+                    except BaseException:
+                        # Stop the other ranges as well
+                        self.stopped.set()
+                        raise
+            finally:
+                if len(ranges) > 1: self._save(state, ranges)
+        self._report(started)
+        return self._finish(part, state, time.monotonic() - started)
+
+    def _probe(self) -> bool:
+        """Learn the file name and size, True if the server answers range requests"""
+        with self.session.get(self.url, headers={'Range': 'bytes=0-'}, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            if response.status_code == 206: total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            else: total = response.headers.get('Content-Length', '')
+            self.total = int(total) if total.isdigit() else None
+            if not self.filename:
+                content_disposition = response.headers.get('Content-Disposition')
+                if content_disposition:
+                    fname = re.findall('filename="?([^";]+)"?', content_disposition)
+                    if fname: self.filename = os.path.basename(fname[0].strip())
+            if not self.filename: self.filename = os.path.basename(self.url.split('?')[0])
+            if not self.filename: self.filename = "downloaded_file"
+            return response.status_code == 206
+
+    def _load_ranges(self, part, state, ranges_ok) -> list:
+        if ranges_ok and os.path.exists(part) and os.path.exists(state):
+            try:
+                with open(state, 'r') as f:
+                    saved = json.load(f)
+                if saved['url'] == self.url and saved['total'] == self.total: return saved['ranges']
+            except (OSError, ValueError, KeyError):
+                pass
+        if ranges_ok and self.total and self.connections > 1 and self.total >= PARALLEL_MIN_SIZE:
+            step = -(-self.total // self.connections)
+            return [[start, start, min(start + step, self.total)] for start in range(0, self.total, step)]
+        # One range, goes on after what an earlier download left in the part file
+        done = 0
+        if ranges_ok and os.path.exists(part) and not os.path.exists(state): done = os.path.getsize(part)
+        if self.total is not None and done > self.total: done = 0
+        return [[0, done, self.total]]
+
+    def _save(self, state, ranges):
+        with open(state + '.tmp', 'w') as f:
+            json.dump({'url': self.url, 'total': self.total, 'ranges': ranges}, f)
+        os.replace(state + '.tmp', state)
+
+    def _fetch(self, part, rng, restartable):
+        """Fetch one range into the part file, retrying broken connections"""
+        failures = 0
+        # Unbuffered, the saved positions never run ahead of the file
+        with open(part, 'r+b', buffering=0) as file:
+            while rng[2] is None or rng[1] < rng[2]:
+                if self.stopped.is_set(): raise DownloadStopped("Download stopped")
+                start = rng[1]
+                headers = {}
+                if start or rng[2] is not None: headers['Range'] = f"bytes={start}-{rng[2] - 1 if rng[2] is not None else ''}"
+                try:
+                    with self.session.get(self.url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                        response.raise_for_status()
+                        if start and response.status_code != 206:
+                            if not restartable: raise ValueError("The server stopped answering range requests")
+                            # The whole file again
+                            with self.lock:
+                                self.received -= start
+                            start = rng[1] = 0
+                            file.truncate(0)
+                        file.seek(start)
+                        for data in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            if self.stopped.is_set(): raise DownloadStopped("Download stopped")
+                            if rng[2] is not None: data = data[:rng[2] - rng[1]]
+                            file.write(data)
+                            rng[1] += len(data)
+                            with self.lock:
+                                self.received += len(data)
+                                self.fetched += len(data)
+                    # Without a known size the end of the body is the end of the file
+                    if rng[2] is None: return
+                    if rng[1] < rng[2]: raise requests.ConnectionError("Connection closed early")
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    failures = failures + 1 if rng[1] == start else 1
+                    if failures > DOWNLOAD_RETRIES: raise
+                    logger.warning(f"Download of {self.url} broken at {rng[1]}, retry {failures}: {str(e)}")
+                    self.stopped.wait(min(2 ** failures, 30))
+
+    def _report(self, started):
+        if not self.progress: return
+        with self.lock:
+            received, fetched = self.received, self.fetched
+        self.progress(received, self.total, fetched / max(time.monotonic() - started, 0.001))
+
+    def _finish(self, part, state, seconds) -> str:
+        size = os.path.getsize(part)
+        if self.total is not None and size != self.total: raise ValueError(f"Got {size} of {self.total} bytes")
+        if self.size is not None and size != self.size: raise ValueError(f"Got {size} bytes, expected {self.size}")
+        if self.sha256:
+            digest = file_sha256(part)
+            if digest != self.sha256:
+                # The same bytes would come again, start over next time
+                os.remove(part)
+                if os.path.exists(state): os.remove(state)
+                raise ValueError(f"SHA-256 mismatch, got {digest}")
+        if os.path.exists(state): os.remove(state)
+        os.replace(part, self.filename)
+        return (f"Saved {os.path.abspath(self.filename)} ({size} bytes in {seconds:.1f}s, "
+                f"{self.fetched / max(seconds, 0.001) / 1048576:.1f} MiB/s{', SHA-256 ok' if self.sha256 else ''})")
+
+def file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''): digest.update(block)
+    return digest.hexdigest()
+
+def format_progress(received, total, speed) -> str:
+    done = f"{received / 1048576:.1f}"
+    if total: done += f"/{total / 1048576:.1f} MiB ({received * 100 // total}%)"
+    else: done += " MiB"
+    return f"{done}, {speed / 1048576:.1f} MiB/s"
+
+def download_file(url, filename=None, sha256=None, size=None, connections=1):
+    download = Download(url, filename, sha256, size, connections,
+                        progress=lambda *progress: logger.info(f"Downloading {url}: {format_progress(*progress)}"))
+    return download.run()
 
 class DailyFileHandler(logging.FileHandler):
     def __init__(self, mode='a', encoding='utf-8'):
@@ -111,7 +292,366 @@ def setup_autostart():
         logger.error(f"Failed to set up autostart: {e}")
         return False
 
+# The current connection got HELLO_ACK / seconds the server asked us to stay away with RETRY_AFTER
+admitted = False
+retry_after = None
+
+class FrameSender:
+    """Sends the frames of one connection, commands run by several workers share it
+
+    Every connection has its own, threads still finishing work of an old connection
+    must not write into the compression stream of the new one.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        # Compression is switched on by HELLO_ACK
+        self.encoder = protocol.FrameEncoder()
+        self.lock = threading.Lock()
+
+    def send_frame(self, ftype, payload=b''):
+        with self.lock:
+            self.sock.sendall(self.encoder.encode(ftype, payload))
+
+def accept_features(sender, decoder, payload):
+    """HELLO_ACK arrived, use the features the server accepted"""
+    global admitted
+    admitted = True
+    features = protocol.decode_features(payload)
+    if protocol.FEATURE_ZLIB in features:
+        with sender.lock:
+            sender.encoder.compress = True
+        decoder.inflate = True
+    logger.info(f"Server accepted features: {', '.join(sorted(features)) or 'none'}")
+
+def server_busy(payload):
+    """RETRY_AFTER arrived, the server closes the connection"""
+    global retry_after
+    retry_after = protocol.decode_retry_after(payload)
+    logger.warning(f"Server is busy, asked to retry in {retry_after:.1f} seconds")
+
+OUTPUT_CHUNK_SIZE = 65536
+MAX_RUNNING_COMMANDS = 4
+MAX_QUEUED_COMMANDS = 32
+
+def kill_process(process):
+    """Kill a shell command together with the programs it started"""
+    if sys.platform.startswith('win'):
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+    else:
+        try: os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError: pass
+
+class Job:
+    """A command from the server, queued or running"""
+    def __init__(self, rid, command, stream):
+        self.rid = rid
+        self.command = command
+        self.stream = stream
+        self.process = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the process, None if the job was cancelled before"""
+        with self.lock:
+            if self.cancelled: return None
+            # Own process group (POSIX), so cancel can kill everything the shell started
+            self.process = subprocess.Popen(self.command, shell=True, stdin=subprocess.DEVNULL,
+                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                            start_new_session=True)
+            return self.process
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.process and self.process.poll() is None: kill_process(self.process)
+
+class CommandRunner:
+    """Runs the commands of one connection on a bounded worker pool
+
+    The receive loop only queues jobs, so it keeps answering heartbeats while commands run.
+    """
+    def __init__(self, sender, max_running=MAX_RUNNING_COMMANDS, max_queued=MAX_QUEUED_COMMANDS):
+        self.sender = sender
+        self.max_jobs = max_running + max_queued
+        self.pool = ThreadPoolExecutor(max_workers=max_running)
+        # Key: request id, Value: Job
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, rid, command, stream=False):
+        with self.lock:
+            busy = len(self.jobs) >= self.max_jobs
+            if not busy:
+                job = Job(rid, command, stream)
+                self.jobs[rid] = job
+        if busy:
+            self.sender.send_frame(protocol.COMMAND_ERROR, protocol.encode_request(rid, b'Client busy, too many commands'))
+            return
+        self.pool.submit(self._run, job)
+
+    def cancel(self, rid):
+        with self.lock:
+            job = self.jobs.get(rid)
+        if job:
+            logger.info(f"Cancel command #{rid}")
+            job.cancel()
+
+    def shutdown(self):
+        """Connection closed, nobody waits for the results any more"""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs: job.cancel()
+        self.pool.shutdown(wait=False)
+
+    def _run(self, job):
+        try:
+            if job.stream: self._stream(job)
+            else: self._execute(job)
+        except Exception as e:
+            # The server dropped cancelled requests already
+            if not job.cancelled:
+                try: self.sender.send_frame(protocol.COMMAND_ERROR, protocol.encode_request(job.rid, str(e).encode('utf-8')))
+                except OSError: pass
+        finally:
+            with self.lock:
+                self.jobs.pop(job.rid, None)
+
+    def _execute(self, job):
+        """COMMAND frame, the whole output is sent when the command exits"""
+        logger.info(f"Execute command #{job.rid}: {job.command}")
+        process = job.start()
+        if process is None: return
+        output, _ = process.communicate()
+        if job.cancelled: return
+        result = output.decode(locale.getpreferredencoding(False), 'replace')
+        # Same as subprocess.getoutput
+        if result.endswith('\n'): result = result[:-1]
+        self.sender.send_frame(protocol.COMMAND_RESULT, protocol.encode_request(job.rid, result.encode('utf-8')))
+
+    def _stream(self, job):
+        """RUN frame, output is sent in OUTPUT frames while the command runs"""
+        logger.info(f"Stream command #{job.rid}: {job.command}")
+        process = job.start()
+        if process is None: return
+        # Re-encode to UTF-8, a chunk may end inside a character
+        decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))('replace')
+        try:
+            with process.stdout:
+                while True:
+                    # Returns what is available, the command blocks on a full pipe while a send waits for the server
+                    chunk = process.stdout.read1(OUTPUT_CHUNK_SIZE)
+                    text = decoder.decode(chunk, final=not chunk)
+                    if text and not job.cancelled:
+                        self.sender.send_frame(protocol.OUTPUT, protocol.encode_request(job.rid, text.encode('utf-8')))
+                    if not chunk: break
+        except Exception:
+            kill_process(process)
+            raise
+        exit_code = process.wait()
+        if not job.cancelled:
+            self.sender.send_frame(protocol.EXIT, protocol.encode_request(job.rid, protocol.EXIT_CODE.pack(exit_code)))
+
+class FileTransfers:
+    """put / get transfers of one connection, resumed from the ".part" file / the server offset"""
+    def __init__(self, sender):
+        self.sender = sender
+        # Key: request id, Value: protocol.ChunkReceiver (put) or protocol.ChunkSender (get)
+        self.transfers = {}
+        self.lock = threading.Lock()
+
+    def open(self, rid, info):
+        try:
+            info = json.loads(info)
+            if info['op'] == 'put': self._open_put(rid, info['path'], int(info['size']))
+            elif info['op'] == 'get': self._open_get(rid, info['path'], int(info['offset']))
+            else: raise ValueError(f"Unknown transfer {info['op']}")
+        except (OSError, KeyError, ValueError, TypeError) as e:
+            logger.error(f"File transfer #{rid} failed: {str(e)}")
+            self.sender.send_frame(protocol.COMMAND_ERROR, protocol.encode_request(rid, str(e).encode('utf-8')))
+
+    def _open_put(self, rid, path, size):
+        receiver = protocol.ChunkReceiver(rid, path)
+        # The old part is longer than the file, start over
+        if receiver.offset > size: receiver.restart()
+        receiver.size = size
+        with self.lock:
+            self.transfers[rid] = receiver
+        logger.info(f"Receive file #{rid} {path}, {receiver.offset} of {size} bytes already there")
+        self.sender.send_frame(protocol.FILE_READY, protocol.encode_request(rid, json.dumps({'offset': receiver.offset}).encode('utf-8')))
+        if receiver.complete: self._finish_put(receiver)
+
+    def chunk(self, rid, offset, data, ok):
+        with self.lock:
+            receiver = self.transfers.get(rid)
+        if not isinstance(receiver, protocol.ChunkReceiver): return
+        ack = receiver.write(offset, data, ok)
+        if ack: self.sender.send_frame(protocol.FILE_ACK, ack)
+        if receiver.complete: self._finish_put(receiver)
+
+    def _finish_put(self, receiver):
+        with self.lock:
+            self.transfers.pop(receiver.rid, None)
+        receiver.finish()
+        logger.info(f"Received file #{receiver.rid} {receiver.path}")
+        result = f"Saved {os.path.abspath(receiver.path)} ({receiver.size} bytes)"
+        self.sender.send_frame(protocol.COMMAND_RESULT, protocol.encode_request(receiver.rid, result.encode('utf-8')))
+
+    def _open_get(self, rid, path, offset):
+        file = open(path, 'rb')
+        size = os.fstat(file.fileno()).st_size
+        # The part on the server is longer than the file, start over
+        if offset > size: offset = 0
+        sender = protocol.ChunkSender(size, offset)
+        with self.lock:
+            self.transfers[rid] = sender
+        logger.info(f"Send file #{rid} {path} from {offset} of {size} bytes")
+        self.sender.send_frame(protocol.FILE_READY, protocol.encode_request(rid, json.dumps({'offset': offset, 'size': size}).encode('utf-8')))
+        threading.Thread(target=self._send_loop, args=(rid, file, sender), daemon=True).start()
+
+    def _send_loop(self, rid, file, sender):
+        try:
+            with file:
+                while True:
+                    chunk = sender.next_chunk()
+                    if chunk is None: break
+                    offset, count = chunk
+                    file.seek(offset)
+                    data = file.read(count)
+                    self.sender.send_frame(protocol.FILE_CHUNK, protocol.encode_chunk_header(rid, offset, data) + data)
+        except OSError as e:
+            logger.error(f"Send file #{rid} stopped: {str(e)}")
+        finally:
+            with self.lock:
+                if self.transfers.get(rid) is sender: del self.transfers[rid]
+
+    def ack(self, rid, offset, ok):
+        with self.lock:
+            sender = self.transfers.get(rid)
+        if isinstance(sender, protocol.ChunkSender): sender.ack(offset, ok)
+
+    def cancel(self, rid):
+        with self.lock:
+            transfer = self.transfers.pop(rid, None)
+        if isinstance(transfer, protocol.ChunkReceiver): transfer.close()
+        elif transfer: transfer.stop()
+
+    def shutdown(self):
+        with self.lock:
+            rids = list(self.transfers)
+        for rid in rids: self.cancel(rid)
+
+class Downloads:
+    """DOWNLOAD requests of one connection, each runs in its own thread"""
+    def __init__(self, sender):
+        self.sender = sender
+        # Key: request id, Value: Download
+        self.downloads = {}
+        self.lock = threading.Lock()
+
+    def start(self, rid, info):
+        try:
+            info = json.loads(info)
+            size = info.get('size')
+            download = Download(info['url'], info.get('path'), info.get('sha256'), int(size) if size is not None else None,
+                                int(info.get('connections') or 1), progress=lambda *progress: self._progress(rid, *progress))
+        except (KeyError, ValueError, TypeError) as e:
+            self.sender.send_frame(protocol.COMMAND_ERROR, protocol.encode_request(rid, f"Invalid download: {str(e)}".encode('utf-8')))
+            return
+        with self.lock:
+            self.downloads[rid] = download
+        threading.Thread(target=self._run, args=(rid, download), daemon=True).start()
+
+    def _run(self, rid, download):
+        logger.info(f"Downloading #{rid} {download.url}")
+        try:
+            result = download.run()
+            ftype = protocol.COMMAND_RESULT
+            logger.info(f"Download #{rid}: {result}")
+        except DownloadStopped:
+            # The server dropped the request, the part file is kept for the next try
+            logger.info(f"Download #{rid} stopped")
+            return
+        except Exception as e:
+            result = f"Download of {download.url} failed: {str(e)}"
+            ftype = protocol.COMMAND_ERROR
+            logger.error(result)
+        finally:
+            with self.lock:
+                self.downloads.pop(rid, None)
+        try: self.sender.send_frame(ftype, protocol.encode_request(rid, result.encode('utf-8')))
+        except OSError: pass
+
+    def _progress(self, rid, received, total, speed):
+        try: self.sender.send_frame(protocol.OUTPUT, protocol.encode_request(rid, (format_progress(received, total, speed) + '\n').encode('utf-8')))
+        except OSError: pass
+
+    def cancel(self, rid):
+        with self.lock:
+            download = self.downloads.pop(rid, None)
+        if download: download.stop()
+
+    def shutdown(self):
+        with self.lock:
+            downloads = list(self.downloads.values())
+            self.downloads.clear()
+        for download in downloads: download.stop()
+
+def handle_message(sender, message):
+    if message.startswith("cmd "):
+        # Execute command
+        command = message[4:]
+        logger.info(f"Execute command: {command}")
+        try:
+            result = subprocess.getoutput(command)
+            sender.send_frame(protocol.CMDRES, result.encode('utf-8'))
+        except Exception as e:
+            sender.send_frame(protocol.CMDERR, str(e).encode('utf-8'))
+    elif message.startswith("wget "):
+        info = message[5:].split()
+        if len(info) == 0:
+            logging.error(f"Wrong wget command: {message[5:]}")
+            return
+        url = info[0]
+        file_name = None
+        if len(info) >= 2:
+            file_name = info[1]
+
+        logger.info(f"Downloading file at {url}")
+        try:
+            logger.info(download_file(url, file_name))
+        except Exception as e:
+            logger.error(f"While download {url}, {str(e)}")
+
+    elif message.startswith("open "):
+        try:
+            path = message[5:]
+            subprocess.Popen(
+                path.split(),
+                close_fds=True
+            )
+        except Exception as e:
+            logger.error(f"Open program error {str(e)}")
+    else:
+        logger.info(f"Received: {message}")
+
 def receive_messages(sock):
+    sender = FrameSender(sock)
+    decoder = protocol.FrameDecoder()
+    runner = CommandRunner(sender)
+    transfers = FileTransfers(sender)
+    downloads = Downloads(sender)
+    # Plain messages keep their order, but must not block the receive loop either
+    messages = ThreadPoolExecutor(max_workers=1)
+    try:
+        receive_frames(sock, sender, decoder, runner, transfers, downloads, messages)
+    finally:
+        runner.shutdown()
+        transfers.shutdown()
+        downloads.shutdown()
+        messages.shutdown(wait=False)
+
+def receive_frames(sock, sender, decoder, runner, transfers, downloads, messages):
     while True:
         try:
             sock.settimeout(60)
@@ -119,57 +659,55 @@ def receive_messages(sock):
             if not data:
                 logger.error("Server disconnected")
                 break
-            # Handle regular messages
-            try:
-                message = data.decode('utf-8')
-                if message == "HEARTBEAT":
-                    sock.send("HEARTBEAT_RESPONSE".encode("utf-8"))
-                elif message.startswith("cmd "):
-                    # Execute command
-                    command = message[4:]
-                    logger.info(f"Execute command: {command}")
+            decoder.feed(data)
+            for ftype, payload in decoder.frames():
+                if ftype == protocol.HEARTBEAT:
+                    sender.send_frame(protocol.HEARTBEAT_RESPONSE)
+                elif ftype == protocol.MESSAGE:
+                    # Handle regular messages
                     try:
-                        result = subprocess.getoutput(command)
-                        sock.send(f"CMDRES:{result}".encode('utf-8'))
-                    except Exception as e:
-                        sock.send(f"CMDERR:{str(e)}".encode('utf-8'))
-                elif message.startswith("wget "):
-                    info = message[5:].split()
-                    if len(info) == 0:
-                        logging.error(f"Wrong wget command: {message[5:]}")
+                        message = str(payload, 'utf-8')
+                    except UnicodeDecodeError:
+                        logger.info(f"Received binary data: {bytes(payload)}")
                         continue
-                    url = info[0]
-                    file_name = None
-                    if len(info) >= 2:
-                        file_name = info[1]
-
-                    logger.info(f"Downloading file at {url}")
-                    try:
-                        download_file(url, file_name)
-                        logger.info(f"Download {url} successfully")
-                    except Exception as e:
-                        logger.error(f"While download {url}, {str(e)}")
-
-                elif message.startswith("open "):
+                    messages.submit(handle_message, sender, message)
+                elif ftype in (protocol.COMMAND, protocol.RUN):
+                    rid, command = protocol.decode_request(payload)
                     try:
-                        path = message[5:]
-                        subprocess.Popen(
-                            path.split(),
-                            close_fds=True
-                        )
-                    except Exception as e:
-                        logger.error(f"Open program error {str(e)}")
-                elif message != "HEARTBEAT_RESPONSE":
-                    logger.info(f"Received: {message}")
-            except UnicodeDecodeError:
-                logger.info(f"Received binary data: {data}")
+                        command = str(command, 'utf-8')
+                    except UnicodeDecodeError:
+                        sender.send_frame(protocol.COMMAND_ERROR, protocol.encode_request(rid, b'Command is not valid UTF-8'))
+                        continue
+                    runner.submit(rid, command, stream=ftype == protocol.RUN)
+                elif ftype == protocol.CANCEL:
+                    rid, _ = protocol.decode_request(payload)
+                    runner.cancel(rid)
+                    transfers.cancel(rid)
+                    downloads.cancel(rid)
+                elif ftype == protocol.FILE_OPEN:
+                    transfers.open(*protocol.decode_request(payload))
+                elif ftype == protocol.FILE_CHUNK:
+                    transfers.chunk(*protocol.decode_chunk(payload))
+                elif ftype == protocol.FILE_ACK:
+                    transfers.ack(*protocol.decode_ack(payload))
+                elif ftype == protocol.DOWNLOAD:
+                    downloads.start(*protocol.decode_request(payload))
+                elif ftype == protocol.HELLO_ACK:
+                    accept_features(sender, decoder, payload)
+                elif ftype == protocol.RETRY_AFTER:
+                    server_busy(payload)
+                elif ftype != protocol.HEARTBEAT_RESPONSE:
+                    logger.info(f"Received unknown frame type {ftype}")
 
         except socket.timeout:
             # Send heart beat check
             try:
-                sock.send("HEARTBEAT".encode('utf-8'))
+                sender.send_frame(protocol.HEARTBEAT)
             except:
                 break
+        except protocol.FrameError as e:
+            logger.error(f"Protocol error: {str(e)}")
+            break
         except ConnectionResetError:
             logger.error("Connection lost with server (Connection reset error)")
             break
@@ -179,6 +717,7 @@ def receive_messages(sock):
 
 
 def start_client(debug=True):
+    global admitted, retry_after
     # Setup autostart on first run
     if debug:
         host = '127.0.0.1'
@@ -194,8 +733,11 @@ def start_client(debug=True):
     
     reconnect_delay = 5  # 初始重连延迟
     max_reconnect_delay = 60  # 最大重连延迟
+    # Attempts since the server last accepted us, the delay grows with them
+    attempt = 0
     
     while True:
+        admitted, retry_after = False, None
         try:
             # 创建TCP socket
             client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -206,10 +748,10 @@ def start_client(debug=True):
             client_socket.connect((host, port))
             
             # Send client identifier first
-            client_socket.send(f"IDENTIFIER:{client_id}".encode('utf-8'))
+            hello = protocol.encode_hello(client_id, protocol.FEATURES)
+            client_socket.sendall(protocol.MAGIC + protocol.encode_frame(protocol.HELLO, hello))
             
             logger.info("Connected to server successfully")
-            reconnect_delay = 5  # 重置重连延迟
             
             # 启动接收线程
             receiver = threading.Thread(
@@ -221,30 +763,29 @@ def start_client(debug=True):
             
             try:
                 while receiver.is_alive():
-                    time.sleep(1)  # 主线程保持运行
+                    receiver.join(1)  # 主线程保持运行
                     
             except (ConnectionResetError, BrokenPipeError):
                 logger.error("Connection lost while sending")
             finally:
                 client_socket.close()
-                logger.error(f"Connection closed, reconnecting in {reconnect_delay} seconds...")
-                time.sleep(reconnect_delay)
-                reconnect_delay = min(reconnect_delay * 2, max_reconnect_delay)  # 指数退避
                 
-        except ConnectionRefusedError:
-            try: time.sleep(5)
-            except KeyboardInterrupt: os._exit(0)
-        except socket.timeout:
-            try: time.sleep(5)
-            except KeyboardInterrupt: os._exit(0)
+        except (ConnectionRefusedError, socket.timeout):
+            pass
         except KeyboardInterrupt:
              os._exit(0)
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}")
-            try:
-                time.sleep(10)
-            except KeyboardInterrupt:
-                os._exit(0)
+
+        # 指数退避 with full jitter, see protocol.backoff_delay
+        if admitted: attempt = 0
+        delay = protocol.backoff_delay(attempt, reconnect_delay, max_reconnect_delay, retry_after)
+        attempt += 1
+        logger.info(f"Reconnecting in {delay:.1f} seconds...")
+        try:
+            time.sleep(delay)
+        except KeyboardInterrupt:
+            os._exit(0)
 
 if __name__ == "__main__":
     start_client(debug=True)
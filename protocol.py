@@ -0,0 +1,438 @@
+"""Wire protocol shared by server.py and client.py
+
+A framed connection starts with MAGIC, after that every message is a frame:
+
+    | length (4 bytes, big endian) | type (1 byte) | payload (length bytes) |
+
+The first frame from the client is HELLO with "IDENTIFIER:<identifier>" as payload,
+optionally followed by a line "FEATURES:<name>,<name>", the server answers with
+HELLO_ACK. Clients that start with the plain text "IDENTIFIER:<identifier>" keep
+using the old unframed protocol.
+
+Clients with the "rid" feature get commands as COMMAND frames and answer with
+COMMAND_RESULT / COMMAND_ERROR, each payload starts with the 4 byte request id.
+Everybody else gets "cmd ..." messages and answers with CMDRES / CMDERR.
+
+Clients with the "stream" feature also take RUN frames, the output of the command
+comes back in OUTPUT frames as it is produced and EXIT carries the exit code.
+With the "cancel" feature the server sends CANCEL when it gives up on a request,
+the client kills the command and sends nothing more for it.
+
+HELLO_ACK carries "FEATURES:<name>,<name>", the features the server accepted.
+After "zlib" is accepted both sides may set the COMPRESSED bit in the type byte,
+the payload of such frames is the next piece of one zlib stream per direction,
+ended with a sync flush. Small frames are sent as they are.
+
+Files move with the "files" feature: FILE_OPEN starts a put (server to client)
+or get (client to server), the client answers FILE_READY with the offset to
+start from, so a transfer continues where the receiver's ".part" file ends.
+Every FILE_CHUNK carries its offset and crc32, the receiver answers each with
+FILE_ACK; a bad chunk is answered with a negative ack and sent again. The
+client ends a put with COMMAND_RESULT / COMMAND_ERROR, errors on either side
+use COMMAND_ERROR / CANCEL as for commands.
+
+With the "download" feature DOWNLOAD asks the client to fetch a URL itself,
+progress lines come back as OUTPUT and the request ends with COMMAND_RESULT /
+COMMAND_ERROR. Clients without it only understand the "wget ..." message.
+
+A server over its accept rate answers the HELLO of a new client with RETRY_AFTER
+instead of HELLO_ACK and closes the connection. The payload is the delay in milliseconds; clients
+wait at least that long, see backoff_delay. Older clients only see the close.
+"""
+import math
+import os
+import random
+import struct
+import threading
+import zlib
+
+MAGIC = b'CTRL\x02'
+HEADER = struct.Struct('!IB')
+REQUEST_ID = struct.Struct('!I')
+EXIT_CODE = struct.Struct('!i')
+DELAY_MS = struct.Struct('!I')
+# Request id, offset, crc32 of the data
+CHUNK_HEADER = struct.Struct('!IQI')
+# Request id, bytes received so far, False to send again from there
+ACK = struct.Struct('!IQ?')
+FILE_CHUNK_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Flag in the type byte, the payload is compressed
+COMPRESSED = 0x80
+COMPRESS_THRESHOLD = 512
+# Deflate refers back at most this far, a stream can go on from this much history
+ZLIB_WINDOW = 32768
+
+# Frame types
+HELLO = 1               # client -> server, "IDENTIFIER:<identifier>"
+HELLO_ACK = 2           # server -> client
+HEARTBEAT = 3
+HEARTBEAT_RESPONSE = 4
+MESSAGE = 5             # server -> client, same text as the legacy protocol ("cmd ...", "wget ...")
+CMDRES = 6              # client -> server, command output
+CMDERR = 7              # client -> server, command error
+COMMAND = 8             # server -> client, request id + command
+COMMAND_RESULT = 9      # client -> server, request id + command output
+COMMAND_ERROR = 10      # client -> server, request id + command error
+RUN = 11                # server -> client, request id + command, output is streamed
+OUTPUT = 12             # client -> server, request id + chunk of UTF-8 output
+EXIT = 13               # client -> server, request id + exit code (4 bytes, signed)
+CANCEL = 14             # server -> client, request id
+FILE_OPEN = 15          # server -> client, request id + JSON {"op": "put" / "get", "path", "size" / "offset"}
+FILE_READY = 16         # client -> server, request id + JSON {"offset", "size"}
+FILE_CHUNK = 17         # sender -> receiver, CHUNK_HEADER + data
+FILE_ACK = 18           # receiver -> sender, ACK
+DOWNLOAD = 19           # server -> client, request id + JSON {"url", "path", "sha256", "size", "connections"}
+RETRY_AFTER = 20        # server -> client, milliseconds to wait before connecting again (4 bytes)
+
+# Features announced in HELLO
+FEATURE_REQUEST_ID = 'rid'
+FEATURE_STREAM = 'stream'
+FEATURE_CANCEL = 'cancel'
+FEATURE_ZLIB = 'zlib'
+FEATURE_FILES = 'files'
+FEATURE_DOWNLOAD = 'download'
+FEATURES = {FEATURE_REQUEST_ID, FEATURE_STREAM, FEATURE_CANCEL, FEATURE_ZLIB, FEATURE_FILES, FEATURE_DOWNLOAD}
+
+FRAME_NAMES = {
+    HELLO: 'HELLO', HELLO_ACK: 'HELLO_ACK', HEARTBEAT: 'HEARTBEAT',
+    HEARTBEAT_RESPONSE: 'HEARTBEAT_RESPONSE', MESSAGE: 'MESSAGE',
+    CMDRES: 'CMDRES', CMDERR: 'CMDERR', COMMAND: 'COMMAND',
+    COMMAND_RESULT: 'COMMAND_RESULT', COMMAND_ERROR: 'COMMAND_ERROR',
+    RUN: 'RUN', OUTPUT: 'OUTPUT', EXIT: 'EXIT', CANCEL: 'CANCEL',
+    FILE_OPEN: 'FILE_OPEN', FILE_READY: 'FILE_READY', FILE_CHUNK: 'FILE_CHUNK', FILE_ACK: 'FILE_ACK',
+    DOWNLOAD: 'DOWNLOAD', RETRY_AFTER: 'RETRY_AFTER',
+}
+
+class FrameError(ValueError):
+    pass
+
+def encode_frame(ftype: int, payload: bytes = b'') -> bytes:
+    return HEADER.pack(len(payload), ftype) + payload
+
+def encode_hello(identifier: str, features=()) -> bytes:
+    hello = f"IDENTIFIER:{identifier}"
+    if features: hello += "\n" + encode_features(features).decode('utf-8')
+    return hello.encode('utf-8')
+
+def decode_hello(payload) -> tuple:
+    """Return (identifier, set of features) of a HELLO payload"""
+    lines = str(payload, 'utf-8').split('\n')
+    if not lines[0].startswith('IDENTIFIER:'): raise FrameError("Invalid hello frame")
+    features = set()
+    for line in lines[1:]: features |= decode_features(line.encode('utf-8'))
+    return lines[0][11:], features
+
+def encode_retry_after(seconds: float) -> bytes:
+    # Rounded up, a client back a moment early is turned away again
+    return DELAY_MS.pack(min(math.ceil(seconds * 1000), 0xFFFFFFFF))
+
+def decode_retry_after(payload) -> float:
+    if len(payload) != DELAY_MS.size: raise FrameError("Invalid retry after frame")
+    return DELAY_MS.unpack(payload)[0] / 1000
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: float = None) -> float:
+    """Seconds to wait before connection attempt number attempt + 1 (counted from 0)
+
+    Full jitter: uniform between 0 and base * 2 ** attempt, at most cap, so clients
+    dropped together do not come back together. The server spreads the clients it
+    sends RETRY_AFTER itself, those come back up to 10% after the hint instead.
+    """
+    if retry_after is not None: return random.uniform(retry_after, retry_after * 1.1)
+    return random.uniform(0, min(cap, base * 2 ** min(attempt, 32)))
+
+def encode_features(features) -> bytes:
+    return ("FEATURES:" + ','.join(sorted(features))).encode('utf-8')
+
+def decode_features(payload) -> set:
+    line = str(payload, 'utf-8')
+    if not line.startswith('FEATURES:'): return set()
+    return {name for name in line[9:].split(',') if name}
+
+def encode_request(rid: int, payload: bytes = b'') -> bytes:
+    return REQUEST_ID.pack(rid) + payload
+
+def decode_request(payload) -> tuple:
+    """Split a COMMAND / COMMAND_RESULT / COMMAND_ERROR payload into (request id, rest)"""
+    if len(payload) < REQUEST_ID.size: raise FrameError("Frame too short for a request id")
+    # A copy, a view would keep the receive buffer of the decoder locked
+    return REQUEST_ID.unpack_from(payload)[0], bytes(payload[REQUEST_ID.size:])
+
+def decode_exit(payload) -> tuple:
+    """Split an EXIT payload into (request id, exit code)"""
+    rid, code = decode_request(payload)
+    if len(code) != EXIT_CODE.size: raise FrameError("Invalid exit frame")
+    return rid, EXIT_CODE.unpack(code)[0]
+
+def encode_chunk_header(rid: int, offset: int, data) -> bytes:
+    return CHUNK_HEADER.pack(rid, offset, zlib.crc32(data))
+
+def decode_chunk(payload) -> tuple:
+    """Split a FILE_CHUNK payload into (request id, offset, data, crc32 matches)"""
+    if len(payload) < CHUNK_HEADER.size: raise FrameError("Frame too short for a chunk header")
+    rid, offset, crc = CHUNK_HEADER.unpack_from(payload)
+    # A copy, a view would keep the receive buffer of the decoder locked
+    data = bytes(payload[CHUNK_HEADER.size:])
+    return rid, offset, data, zlib.crc32(data) == crc
+
+def decode_ack(payload) -> tuple:
+    """Split a FILE_ACK payload into (request id, offset, ok)"""
+    if len(payload) != ACK.size: raise FrameError("Invalid ack frame")
+    return ACK.unpack(payload)
+
+def encode_legacy(ftype: int, payload: bytes = b'') -> bytes:
+    """Encode a frame for a client speaking the unframed text protocol"""
+    if ftype == HEARTBEAT: return b'HEARTBEAT'
+    if ftype == HEARTBEAT_RESPONSE: return b'HEARTBEAT_RESPONSE'
+    if ftype == CMDRES: return b'CMDRES:' + payload
+    if ftype == CMDERR: return b'CMDERR:' + payload
+    if ftype == MESSAGE: return payload
+    raise FrameError(f"Frame type {FRAME_NAMES.get(ftype, ftype)} not supported by legacy clients")
+
+class CompressionStats:
+    """Bytes before and after compression, shared by the encoders / decoders of many connections"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.frames_out = self.raw_out = self.packed_out = 0
+        self.frames_in = self.raw_in = self.packed_in = 0
+
+    def add_out(self, raw: int, packed: int):
+        with self._lock:
+            self.frames_out += 1
+            self.raw_out += raw
+            self.packed_out += packed
+
+    def add_in(self, raw: int, packed: int):
+        with self._lock:
+            self.frames_in += 1
+            self.raw_in += raw
+            self.packed_in += packed
+
+    def summary(self) -> str:
+        with self._lock:
+            parts = []
+            for name, frames, raw, packed in (('sent', self.frames_out, self.raw_out, self.packed_out),
+                                              ('received', self.frames_in, self.raw_in, self.packed_in)):
+                if not frames: parts.append(f"nothing {name}"); continue
+                parts.append(f"{name} {frames} frames {raw} -> {packed} bytes "
+                             f"(ratio {raw / max(packed, 1):.1f}, saved {raw - packed} bytes)")
+        return ', '.join(parts)
+
+def _remember(history: bytearray, data):
+    history += data
+    if len(history) > ZLIB_WINDOW: del history[:-ZLIB_WINDOW]
+
+class FrameEncoder:
+    """Frame writer of one connection
+
+    With compress set, payloads from threshold bytes up go through one zlib
+    stream, the compressor is only created for the first of them. Not thread
+    safe, frames have to be encoded in the order they are sent.
+    """
+    def __init__(self, compress: bool = False, threshold: int = COMPRESS_THRESHOLD, stats: CompressionStats = None):
+        self.compress = compress
+        self.threshold = threshold
+        self.stats = stats
+        self._zlib = None
+        self._history = bytearray()
+
+    def history(self) -> bytes:
+        """The last ZLIB_WINDOW bytes that went through the zlib stream, None before it started"""
+        return bytes(self._history) if self._zlib is not None else None
+
+    def continue_stream(self, history: bytes):
+        """Go on with the stream of another encoder, e.g. in a new process, from its history()
+
+        The zlib header went out with the first compressed frame and every frame ends
+        with a sync flush, so raw deflate blocks with the history as dictionary follow
+        on seamlessly. The checksum is only checked at the end, a stream never ends.
+        """
+        self._zlib = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15, zdict=history)
+        self._history = bytearray(history)
+
+    def encode(self, ftype: int, payload: bytes = b'') -> bytes:
+        if not self.compress or len(payload) < self.threshold: return encode_frame(ftype, payload)
+        if self._zlib is None: self._zlib = zlib.compressobj()
+        packed = self._zlib.compress(payload) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        _remember(self._history, payload)
+        if self.stats: self.stats.add_out(len(payload), len(packed))
+        return encode_frame(ftype | COMPRESSED, packed)
+
+class FrameDecoder:
+    """Incremental frame parser
+
+    Feed it whatever recv returned, then iterate frames(). Payloads are memoryviews
+    into the receive buffer, they are only valid until the next call of frames().
+    A slice of one kept longer keeps the old buffer, the decoder goes on with a copy.
+    Compressed frames are only accepted after inflate is set, their payloads are bytes.
+    """
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._pos = 0
+        self.inflate = False
+        self.stats: CompressionStats = None
+        self._zlib = None
+        self._history = bytearray()
+
+    def feed(self, data: bytes):
+        self._buffer += data
+
+    def buffered(self) -> bytes:
+        """Bytes received but not parsed yet"""
+        return bytes(self._buffer[self._pos:])
+
+    def history(self) -> bytes:
+        """The last ZLIB_WINDOW bytes that came out of the zlib stream, None before it started"""
+        return bytes(self._history) if self._zlib is not None else None
+
+    def continue_stream(self, history: bytes):
+        """Go on with the stream of another decoder from its history(), see FrameEncoder.continue_stream"""
+        self._zlib = zlib.decompressobj(-15, zdict=history)
+        self._history = bytearray(history)
+
+    def frames(self):
+        buffer = self._buffer
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - self._pos >= HEADER.size:
+                length, ftype = HEADER.unpack_from(buffer, self._pos)
+                if length > self.max_frame_size:
+                    raise FrameError(f"Frame of {length} bytes exceeds limit")
+                start = self._pos + HEADER.size
+                end = start + length
+                if end > len(buffer): break
+                self._pos = end
+                payload = view[start:end]
+                try:
+                    if ftype & COMPRESSED: yield ftype & ~COMPRESSED, self._decompress(payload)
+                    else: yield ftype, payload
+                finally: payload.release()
+        finally:
+            view.release()
+            if self._pos:
+                try: del buffer[:self._pos]
+                except BufferError: self._buffer = bytearray(buffer[self._pos:])
+                self._pos = 0
+
+    def _decompress(self, packed) -> bytes:
+        if not self.inflate: raise FrameError("Compressed frame without negotiated compression")
+        if self._zlib is None: self._zlib = zlib.decompressobj()
+        try: payload = self._zlib.decompress(packed, self.max_frame_size)
+        except zlib.error as e: raise FrameError(f"Invalid compressed frame: {str(e)}")
+        if self._zlib.unconsumed_tail: raise FrameError("Decompressed frame exceeds limit")
+        _remember(self._history, payload)
+        if self.stats: self.stats.add_in(len(payload), len(packed))
+        return payload
+
+class ChunkSender:
+    """Sending side of a file transfer, keeps a window of chunks in flight and moves on with the acks"""
+    def __init__(self, size: int, offset: int = 0, window: int = 8, chunk_size: int = FILE_CHUNK_SIZE):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.window = window * chunk_size
+        # Acknowledged by the receiver / handed out to be sent
+        self.offset = offset
+        self.sent = offset
+        self.paused = False
+        self.running = True
+        self._cond = threading.Condition()
+
+    def next_chunk(self):
+        """Wait for room in the window, (offset, count) of the next chunk or None when stopped or complete"""
+        with self._cond:
+            while self.running and (self.paused or self.sent >= self.size or self.sent - self.offset >= self.window):
+                if self.offset >= self.size: return None
+                self._cond.wait()
+            if not self.running: return None
+            offset = self.sent
+            count = min(self.chunk_size, self.size - offset)
+            self.sent += count
+            return offset, count
+
+    def ack(self, offset: int, ok: bool):
+        with self._cond:
+            if ok: self.offset = max(self.offset, offset)
+            # Bad chunk, everything from there is sent again
+            else: self.offset = self.sent = offset
+            self._cond.notify_all()
+
+    def pause(self):
+        with self._cond:
+            self.paused = True
+            self.sent = self.offset
+
+    def resume(self, offset: int):
+        with self._cond:
+            self.offset = self.sent = offset
+            self.paused = False
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+
+class ChunkReceiver:
+    """Receiving side of a file transfer, data goes to "<path>.part" until the file is complete"""
+    def __init__(self, rid: int, path: str):
+        self.rid = rid
+        self.path = path
+        self.size: int = None
+        self.file = open(path + '.part', 'ab')
+        self.offset = self.file.tell()
+        self._nacked = False
+
+    def restart(self):
+        self.file.seek(0)
+        self.file.truncate()
+        self.offset = 0
+
+    def write(self, offset: int, data: bytes, ok: bool) -> bytes:
+        """Write one chunk, return the FILE_ACK payload to answer with, None for no answer"""
+        # Chunks that followed a bad one, they come again
+        if offset != self.offset: return None
+        if not ok:
+            if self._nacked: return None
+            self._nacked = True
+            return ACK.pack(self.rid, self.offset, False)
+        self._nacked = False
+        self.file.write(data)
+        self.offset += len(data)
+        return ACK.pack(self.rid, self.offset, True)
+
+    @property
+    def complete(self) -> bool:
+        return self.size is not None and self.offset >= self.size
+
+    def finish(self):
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+
+    def close(self):
+        """Stop without finishing, the ".part" file stays for a later resume"""
+        self.file.close()
+
+class LegacyDecoder:
+    """Decoder for the unframed text protocol, every read is taken as one message"""
+    def __init__(self):
+        self._data = b''
+
+    def feed(self, data: bytes):
+        self._data = data
+
+    def buffered(self) -> bytes:
+        return self._data
+
+    def history(self) -> bytes:
+        return None
+
+    def frames(self):
+        data, self._data = self._data, b''
+        if not data: return
+        view = memoryview(data)
+        if data == b'HEARTBEAT': yield HEARTBEAT, view[:0]
+        elif data == b'HEARTBEAT_RESPONSE': yield HEARTBEAT_RESPONSE, view[:0]
+        elif data.startswith(b'CMDRES:'): yield CMDRES, view[7:]
+        elif data.startswith(b'CMDERR:'): yield CMDERR, view[7:]
+        else: yield MESSAGE, view
@@ -1,62 +1,579 @@
 import socket
 import sys
+import argparse
 import os
 import threading
 import time
 import json
 import errno
 import bisect
+import fnmatch
+import ipaddress
+import heapq
+import itertools
+import pickle
+import queue
+import random
+import signal
+import struct
+import sqlite3
+import uuid
+import selectors
+import tempfile
+from array import array
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
 
+import protocol
+
+class RotatingFile:
+    """Appends lines to a file, renames it to .1, .2... when it grows beyond max_bytes"""
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, backups: int = 5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, text: str):
+        if self.file.tell() + len(text) > self.max_bytes and self.file.tell(): self.rotate()
+        self.file.write(text)
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"): os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups: os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, 'w', encoding='utf-8')
+
+    def close(self):
+        self.file.close()
+
 class Logger:
-    __get_time = lambda: datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f')[:-3]
-    def __init__(self, sock:socket.socket=None):
+    """Console and API output plus an optional log file
+
+    Callers only put records on a bounded queue, one writer thread takes all
+    queued records at once and writes them to every sink in one go. When the
+    queue is full the overflow policy decides: "block" waits for the writer,
+    "drop_new" drops the new record, "drop_oldest" drops the oldest queued one.
+    An event loop thread never waits, it drops its new record under "block".
+    Leveled records go to the log file as JSON lines with their fields,
+    e.g. logging.warning("...", client=identifier).
+
+    What a thread logs inside output(target) goes to that API request instead
+    of the shared API socket, see ApiSession.
+    """
+    OVERFLOW_POLICIES = ('block', 'drop_new', 'drop_oldest')
+
+    def __init__(self, sock: socket.socket = None, max_queue: int = 10000, overflow: str = 'block'):
         self.sock = sock
+        self.file: RotatingFile = None
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.dropped = 0
         self.__lock = threading.Lock()
+        # Item: (time.time(), level or None for plain output, message, fields)
+        self.__records = deque()
+        self.__cond = threading.Condition()
+        self.__writing = False
+        self.__unreported = 0
+        self.__local = threading.local()
+        self.__thread = threading.Thread(target=self.__write_loop, name='logger', daemon=True)
+        self.__thread.start()
 
     def set_sock(self, client_socket: socket.socket):
         with self.__lock:
             self.sock = client_socket
 
-    def __sender(self, mess: str):
-        if self.sock: self.sock.send((mess+'\n').encode('utf-8'))
-        print(mess)
+    def set_file(self, path: str, max_bytes: int = 10 * 1024 * 1024, backups: int = 5):
+        log_file = RotatingFile(path, max_bytes, backups) if path else None
+        with self.__lock:
+            old_file, self.file = self.file, log_file
+        if old_file: old_file.close()
+
+    @contextmanager
+    def output(self, target: 'ApiRequest'):
+        """Route what this thread logs meanwhile to target"""
+        previous = getattr(self.__local, 'target', None)
+        self.__local.target = target
+        try: yield
+        finally: self.__local.target = previous
+
+    def never_block(self):
+        """The calling thread serves an event loop, it must not wait for the writer when the queue is full"""
+        self.__local.nonblocking = True
+
+    def bind(self, callback):
+        """callback with the output target of the calling thread, for work that ends on other threads"""
+        target = getattr(self.__local, 'target', None)
+        if target is None: return callback
+        def bound(*args, **kwargs):
+            with self.output(target): return callback(*args, **kwargs)
+        return bound
+
+    def end(self, target: 'ApiRequest'):
+        """Mark the end of a request's output, after everything logged for it so far"""
+        self.__sender('END', None, target=target)
+
+    def __sender(self, level: str, mess: str, fields: dict = None, target: 'ApiRequest' = None):
+        if target is None: target = getattr(self.__local, 'target', None)
+        record = (time.time(), level, mess, fields, target)
+        with self.__cond:
+            if len(self.__records) >= self.max_queue and threading.current_thread() is not self.__thread:
+                if self.overflow == 'block' and not getattr(self.__local, 'nonblocking', False):
+                    while len(self.__records) >= self.max_queue: self.__cond.wait()
+                elif self.overflow != 'drop_oldest':
+                    self.dropped += 1
+                    self.__unreported += 1
+                    return
+                else:
+                    self.__records.popleft()
+                    self.dropped += 1
+                    self.__unreported += 1
+            self.__records.append(record)
+            if len(self.__records) == 1: self.__cond.notify_all()
+
+    def flush(self, timeout: float = 5):
+        """Wait until the queued records are written"""
+        deadline = time.monotonic() + timeout
+        with self.__cond:
+            while self.__records or self.__writing:
+                left = deadline - time.monotonic()
+                if left <= 0: return
+                self.__cond.wait(left)
+
+    def __write_loop(self):
+        while True:
+            with self.__cond:
+                while not self.__records: self.__cond.wait()
+                records = list(self.__records)
+                self.__records.clear()
+                unreported, self.__unreported = self.__unreported, 0
+                self.__writing = True
+                # Blocked callers can go on
+                self.__cond.notify_all()
+            try: self.__write(records, unreported)
+            except Exception as e: sys.stderr.write(f"Logger error: {str(e)}\n")
+            with self.__cond:
+                self.__writing = False
+                self.__cond.notify_all()
+
+    def __write(self, records: list, unreported: int):
+        with self.__lock:
+            sock, log_file = self.sock, self.file
+        # Lines for the console, for the shared API socket and per API session
+        lines, shared, routed = [], [], {}
+        for record in records:
+            target = record[4]
+            if record[1] == 'END':
+                routed.setdefault(target.session, []).append(target.end_line())
+                continue
+            line = Logger.__format(record)
+            lines.append(line)
+            if target is None: shared.append(line)
+            else: routed.setdefault(target.session, []).extend(target.format(line))
+        if unreported:
+            lines.append(f"[{unreported} log lines dropped, the log queue was full]")
+            shared.append(lines[-1])
+        if lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
+            sys.stdout.flush()
+        for session, session_lines in routed.items(): session.send('\n'.join(session_lines) + '\n')
+        if sock and shared:
+            # Written completely before the next batch, a connection that cannot take it in time is given up
+            try: sock.send(('\n'.join(shared) + '\n').encode('utf-8')).result(SEND_TIMEOUT)
+            except (OSError, FutureTimeoutError) as e:
+                # Stop writing to a broken or stuck API connection
+                with self.__lock:
+                    if self.sock is sock: self.sock = None
+                sys.stdout.write(f"API output stopped: {str(e) or 'timed out'}\n")
+        if log_file:
+            entries = []
+            for created, level, mess, fields, _ in records:
+                if level is None or level == 'END': continue
+                entry = {'time': datetime.fromtimestamp(created).isoformat(timespec='milliseconds'), 'level': level, 'message': mess}
+                if fields: entry.update(fields)
+                entries.append(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+            if entries: log_file.write(''.join(entries))
+
+    @staticmethod
+    def __format(record) -> str:
+        created, level, mess = record[:3]
+        if level is None: return mess
+        return datetime.fromtimestamp(created).strftime('%Y-%m-%d %H:%M:%S,%f')[:-3] + f' - {level} - ' + mess
 
     def rint(self, mess: str = ''):
-        self.__sender(mess)
-    
-    def info(self, mess: str):
-        message = Logger.__get_time() + ' - INFO - ' + mess
-        self.__sender(message)
-    
-    def warning(self, mess: str):
-        message = Logger.__get_time() + ' - WARNING - ' + mess
-        self.__sender(message)
-    
-    def error(self, mess: str):
-        message = Logger.__get_time() + ' - ERROR - ' + mess
-        self.__sender(message)
+        self.__sender(None, mess)
+
+    def info(self, mess: str, **fields):
+        self.__sender('INFO', mess, fields)
+
+    def warning(self, mess: str, **fields):
+        self.__sender('WARNING', mess, fields)
+
+    def error(self, mess: str, **fields):
+        self.__sender('ERROR', mess, fields)
 
 logging = Logger()
 
+class Counter:
+    """Value that only goes up"""
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, fn=None):
+        self.name = name
+        self.help = help
+        # Read the value from fn instead, for counts kept somewhere else
+        self.fn = fn
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        if self.fn: return self.fn()
+        return self._value
+
+class Gauge(Counter):
+    """Value that goes up and down"""
+    kind = 'gauge'
+
+    def set(self, value: float):
+        self._value = value
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+class Histogram:
+    """Observations counted in fixed buckets, cheap enough for every message"""
+    kind = 'histogram'
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # The last one counts everything above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - started)
+
+    def snapshot(self) -> tuple:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def percentile(self, q: float, counts: list, count: int) -> float:
+        """Upper bound of the bucket the q quantile falls in, inf above the largest bucket"""
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= rank: return bound
+        return float('inf')
+
+def format_number(value: float) -> str:
+    # Whole numbers without exponent, byte counts get large
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+class MetricsRegistry:
+    """Counters, gauges and histograms by name, as text for stats or Prometheus"""
+    def __init__(self, prefix: str = 'controller_'):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, fn=None) -> Counter:
+        return self._add(Counter(name, help, fn))
+
+    def gauge(self, name: str, help: str, fn=None) -> Gauge:
+        return self._add(Gauge(name, help, fn))
+
+    def histogram(self, name: str, help: str, buckets=Histogram.LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def summary(self) -> list:
+        """One line per metric, latencies in ms"""
+        return [self.describe(metric) for metric in self.metrics]
+
+    @staticmethod
+    def describe(metric) -> str:
+        if metric.kind != 'histogram': return f"{metric.name}: {format_number(metric.value)}"
+        counts, total, count = metric.snapshot()
+        if not count: return f"{metric.name}: no samples"
+        def ms(value): return f"{value * 1000:g} ms" if value != float('inf') else f"> {metric.buckets[-1] * 1000:g} ms"
+        return (f"{metric.name}: {count} samples, avg {total / count * 1000:.2f} ms, p50 <= {ms(metric.percentile(0.5, counts, count))}, "
+                f"p95 <= {ms(metric.percentile(0.95, counts, count))}, p99 <= {ms(metric.percentile(0.99, counts, count))}")
+
+    def prometheus(self) -> str:
+        """Text exposition format 0.0.4"""
+        out = []
+        for metric in self.metrics:
+            name = self.prefix + metric.name
+            out.append(f"# HELP {name} {metric.help}")
+            out.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind != 'histogram':
+                out.append(f"{name} {format_number(metric.value)}")
+                continue
+            counts, total, count = metric.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(metric.buckets, counts):
+                cumulative += bucket_count
+                out.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+            out.append(f'{name}_bucket{{le="+Inf"}} {count}')
+            out.append(f"{name}_sum {format_number(total)}")
+            out.append(f"{name}_count {count}")
+        return '\n'.join(out) + '\n'
+
+class ServerMetrics:
+    """Every metric of the server, shown by stats and on the metrics port"""
+    def __init__(self):
+        self.registry = registry = MetricsRegistry()
+        self.connections_accepted = registry.counter('connections_accepted_total', "Accepted connections")
+        self.connections_rejected = registry.counter('connections_rejected_total', "Connections closed at accept, banned addresses")
+        self.connections_throttled = registry.counter('connections_throttled_total', "Clients sent RETRY_AFTER over the accept rate")
+        self.connections = registry.gauge('connections', "Open connections", lambda: Connection.count()[2])
+        self.clients = registry.gauge('clients', "Connected clients", lambda: Connection.count()[0])
+        self.api_sessions = registry.gauge('api_sessions', "Open API connections", lambda: ApiSession.active)
+        self.bytes_in = registry.counter('bytes_received_total', "Bytes received from clients")
+        self.bytes_out = registry.counter('bytes_sent_total', "Bytes sent on every connection")
+        self.frames_in = registry.counter('frames_received_total', "Messages received from clients")
+        self.client_data = registry.histogram('client_data_seconds', "Handling of one receive from a client")
+        self.send_message = registry.histogram('send_message_seconds', "ClientManager.send_message")
+        self.send_errors = registry.counter('send_errors_total', "Sends to clients that failed or timed out")
+        self.slow_consumers = registry.counter('slow_consumers_total', "Connections closed for a full outbound queue")
+        self.outbound_queued = registry.gauge('outbound_queued_bytes', "Bytes waiting to be sent on all connections", Connection.queued_bytes)
+        self.command_rtt = registry.histogram('command_rtt_seconds', "Command sent to result received",
+                                              Histogram.LATENCY_BUCKETS + (120, 300, 600))
+        self.commands_pending = registry.gauge('commands_pending', "Commands waiting for their result",
+                                               lambda: len(client_manager.requests.pending()))
+        self.commands_timed_out = registry.counter('commands_timed_out_total', "Commands without a result in time",
+                                                   lambda: client_manager.requests.timed_out)
+        self.commands_failed = registry.counter('commands_failed_total', "Commands failed by a disconnect or send error",
+                                                lambda: client_manager.requests.failed)
+        self.save_data = registry.histogram('save_data_seconds', "save / exit / restart writing the data file")
+        self.scheduler_lag = registry.histogram('scheduler_lag_seconds', "How late scheduled callbacks start")
+        self.heartbeats_sent = registry.counter('heartbeats_sent_total', "Pings sent to idle clients", lambda: client_manager.liveness.pings)
+        self.clients_evicted = registry.counter('clients_evicted_total', "Clients closed after missed heartbeats", lambda: client_manager.liveness.evicted)
+        self.log_dropped = registry.counter('log_records_dropped_total', "Log records dropped by the overflow policy", lambda: logging.dropped)
+        self.memory = registry.gauge('memory_bytes', "Resident memory of the server", get_memory_usage)
+
+def serve_metrics(host: str, port: int):
+    """Prometheus text dump of the metrics on http://host:port/metrics"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.registry.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f"Metrics on http://{host}:{port}/metrics")
+
+class StackSampler:
+    """Samples the stacks of every thread with sys._current_frames, cheap enough to leave on during an incident
+
+    cProfile only sees the thread that enabled it, the connections run on their
+    own threads or the event loop, so the sampler looks at all of them instead.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+        self._stop = threading.Event()
+        # (function, ...) from the outermost call -> samples
+        self.stacks = {}
+        # The same for samples where the thread moved on since the last one, blocked threads never do
+        self.busy = {}
+        self.samples = 0
+        self.interval = 0.01
+        self.started = 0.0
+        self.stopped = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float, duration: float) -> bool:
+        with self._lock:
+            if self.running: return False
+            self.stacks, self.busy, self.samples, self.interval = {}, {}, 0, interval
+            self.started = self.stopped = time.monotonic()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop, duration), name='profiler', daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self) -> bool:
+        with self._lock:
+            if not self.running: return False
+            self._stop.set()
+            self._thread.join()
+        return True
+
+    def _run(self, stop: threading.Event, duration: float):
+        own = threading.get_ident()
+        # Thread id -> (top frame, instruction, stack) of the last sample, blocked threads are not walked again
+        last = {}
+        deadline = self.started + duration
+        while not stop.wait(self.interval):
+            current = {}
+            for ident, frame in sys._current_frames().items():
+                if ident == own: continue
+                cached = last.get(ident)
+                if cached and cached[0] is frame and cached[1] == frame.f_lasti:
+                    self.stacks[cached[2]] = self.stacks.get(cached[2], 0) + 1
+                    current[ident] = cached
+                    continue
+                top, calls = frame, []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append((os.path.basename(code.co_filename), code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack = tuple(reversed(calls))
+                current[ident] = (top, top.f_lasti, stack)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.busy[stack] = self.busy.get(stack, 0) + 1
+            last = current
+            self.samples += 1
+            self.stopped = time.monotonic()
+            if self.stopped >= deadline:
+                logging.info(f"Profiler stopped after {duration:g}s, 'profile stop' shows the result")
+                return
+
+    def top(self, count: int, idle: bool = False) -> list:
+        """Summary lines of the count functions seen most, by own samples and with callees"""
+        own, total, samples = {}, {}, 0
+        all_samples = sum(list(self.stacks.values()))
+        for stack, hits in list((self.stacks if idle else self.busy).items()):
+            samples += hits
+            own[stack[-1]] = own.get(stack[-1], 0) + hits
+            for function in set(stack): total[function] = total.get(function, 0) + hits
+        lines = [f"{self.samples} samples of {all_samples / max(self.samples, 1):.1f} threads every {self.interval * 1000:g} ms "
+                 f"over {self.stopped - self.started:.1f}s, {(all_samples - sum(list(self.busy.values()))) / max(all_samples, 1) * 100:.1f}% "
+                 f"idle in one call" + (" (counted)" if idle else "")]
+        if not samples: return lines
+        lines.append(f"{'Own':>7} {'Total':>7}  Function")
+        for function, hits in sorted(own.items(), key=lambda item: item[1], reverse=True)[:count]:
+            filename, line, name = function
+            lines.append(f"{hits / samples * 100:6.1f}% {total[function] / samples * 100:6.1f}%  {name} ({filename}:{line})")
+        return lines
+
+    def write(self, path: str):
+        """Collapsed stacks, one "a;b;c count" line each, for flamegraph.pl or speedscope"""
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, hits in list(self.stacks.items()):
+                f.write(';'.join(f"{name} ({filename}:{line})" for filename, line, name in stack) + f" {hits}\n")
+
+class AllocationTracer:
+    """tracemalloc snapshots, compared with the one taken at start"""
+    def __init__(self):
+        self.baseline = None
+
+    def start(self, frames: int) -> bool:
+        import tracemalloc
+        if tracemalloc.is_tracing(): return False
+        tracemalloc.start(frames)
+        self.baseline = tracemalloc.take_snapshot()
+        return True
+
+    def stop(self) -> bool:
+        import tracemalloc
+        if not tracemalloc.is_tracing(): return False
+        tracemalloc.stop()
+        self.baseline = None
+        return True
+
+    def top(self, count: int, path: str = None) -> list:
+        """Summary lines of the count largest allocation sites and of the growth since start"""
+        import tracemalloc
+        if not tracemalloc.is_tracing(): return ["Not tracing, use 'memprofile start'"]
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        if path: snapshot.dump(path)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Traced: {current / 1048576:.1f} MiB, peak {peak / 1048576:.1f} MiB, "
+                 f"tracing overhead {tracemalloc.get_tracemalloc_memory() / 1048576:.1f} MiB"]
+        lines.append("Largest allocation sites:")
+        for stat in snapshot.statistics('lineno')[:count]:
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size / 1024:10.1f} KiB {stat.count:8} blocks  {os.path.basename(frame.filename)}:{frame.lineno}")
+        lines.append("Growth since start:")
+        for stat in snapshot.compare_to(self.baseline, 'lineno')[:count]:
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8} blocks  {os.path.basename(frame.filename)}:{frame.lineno}")
+        return lines
+
 class HelpingManager:
     __COMMANDS = {
         "?": ("", "Show help text", {}),
         "help": ("[command]", "Show help text about this command", {"-a": "Show whole help infomation"}),
         "now": ("", "Show now time", {}),
-        "ls": ("", "List clients", {"-o": "List online clients", "-h": "List history clients", "-b": "List banned IP addresses", "-s": "List scheduled command","-a": "List all"}),
+        "ls": ("", "List clients", {"-o": "List online clients", "-h": "List history clients", "-b": "List banned IP addresses", "-s": "List scheduled command","-a": "List all",
+                                    "--match [text]": "Identifier or nickname contains text", "--address [text]": "Address contains text",
+                                    "--since [time]": "Last seen at or after time, a date, date and time or an age like 30m / 2h / 7d", "--until [time]": "Last seen at or before time",
+                                    "--sort [key]": "name / id / seen / address (name)", "-r": "Reverse the order",
+                                    "--limit [n]": "Clients shown per list, 0 for all (100)", "--offset [n]": "Skip the first n clients"}),
         "send": ("[client] [message]", "Send message to client", {}),
+        "run": ("[client] [command]", "Run a command and show its output while it runs", {"-t [seconds]": "Cancel the command after some seconds (600)"}),
+        "cancel": ("[id](using pending to show)", "Cancel a pending command, the client kills it", {}),
+        "put": ("[client] [local path] [remote path]", "Send a file to a client, continues after reconnects and from an earlier partial upload", {}),
+        "get": ("[client] [remote path] [local path]", "Fetch a file from a client, continues after reconnects and from an earlier partial download", {}),
+        "wget": ("[client] [url] [path]", "Let a client download a URL, resumes an earlier partial download of the same file", {"-n [n]": "Connections for large files (1)", "-s [sha256]": "Check the hash of the file", "-z [bytes]": "Check the size of the file"}),
+        "pending": ("", "List commands waiting for their result and the command round trip times", {}),
+        "group": ("[clients] [command]", "Run a command on many clients at once, clients: * / a,b,c / glob", {"-c [n]": "Clients running at once (32)", "-t [seconds]": "Deadline for all results, later commands are cancelled (60)", "-q": "Only show the summary"}),
         "sche": ("[client] [date] [time]", "Schedule message execution", {}),
         "rmsche": ("[id](using ls -s to show)", "Remove scheduled message execution", {}),
         "nkname": ("[identifier] [nickname]", "Set nickname for client", {}),
         "kick": ("[client]", "Kick an online client", {}),
-        "ban": ("[IPaddress]", "Ban an IP address", {}),
-        "unban": ("[IPaddress]","Unban an IP address", {}),
+        "ban": ("[IPaddress|CIDR] [seconds]", "Ban an IP address or range and kick its clients, optionally for some seconds", {}),
+        "unban": ("[IPaddress|CIDR]","Unban an IP address or range", {}),
         "rm": ("[client]", "Remove client in history clients", {}),
-        "save": ("", "Save server data to controler_data.json", {}),
+        "save": ("", "Write pending server data to controler_data.db and compact it", {}),
+        "stats": ("", "Show counters and latency histograms, also on --metrics-port", {}),
+        "status": ("", "Show server mode, connection count and memory per connection", {}),
+        "profile": ("[start|stop] [file]", "Sample the stacks of all threads, stop shows the hottest functions and writes collapsed stacks to file", {"-i [ms]": "Sample interval (10)", "-t [seconds]": "Stop by itself after some seconds (60)", "-n [n]": "Functions shown (20)", "-a": "Also count threads blocked in one call"}),
+        "memprofile": ("[start|stop] [file]", "Trace allocations, without start/stop shows the largest allocation sites and writes a snapshot to file", {"-f [n]": "Frames kept per allocation at start (1)", "-n [n]": "Sites shown (20)"}),
+        "nodes": ("[client]", "List the nodes of the federation, optionally look up the node holding a client", {}),
+        "local": ("[command]", "Run a command on this node only, send / run / sche / kick are otherwise forwarded to the node holding the client", {}),
         "kapi": ("", "Turn on/off api connection allow", {}),
         "debug": ("[python code]", "Run python code to debug", {}),
-        "restart": ("", "Restart server", {}),
+        "restart": ("", "Restart server, the client connections are handed over to the new process", {}),
         "exit": ("", "Shutdown server", {})
     }
 
@@ -70,121 +587,2215 @@ class HelpingManager:
         for option, opdes in des[2].items():
             logging.rint(f"    {option} - |{opdes}|")
 
-    @staticmethod
-    def output_all_command_helper():
-        logging.rint("Controler commands:")
-        for cmd in HelpingManager.__COMMANDS:
-            HelpingManager.output_command_helper(cmd)
+    @staticmethod
+    def output_all_command_helper():
+        logging.rint("Controler commands:")
+        for cmd in HelpingManager.__COMMANDS:
+            HelpingManager.output_command_helper(cmd)
+
+class ScheduledMessage:
+    def __init__(self, identifier: str, message: str, execute_time: datetime, id: str = None):
+        self.identifier: str = identifier
+        self.message: str = message
+        self.execute_time: datetime = execute_time
+        # Key in DataStore
+        self.id: str = id or uuid.uuid4().hex
+        # Handle in ClientManager.scheduler
+        self.timer: int = None
+
+    def __lt__(self, other):
+        if not isinstance(other, ScheduledMessage):
+            return NotImplemented
+        return self.execute_time < other.execute_time
+
+    def dict(self):
+        return {"identifier": self.identifier, "message": self.message, "execute_time": self.execute_time.__str__()}
+
+def get_memory_usage() -> int:
+    """Resident memory of the server process in bytes, 0 if unknown"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        # Peak value only, but better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return 0
+
+def resolve_futures(entries: list, error: Exception = None):
+    """Finish the send Futures of (data, size, Future) entries"""
+    for _, size, future in entries:
+        if future.done(): continue
+        if error is None: future.set_result(size)
+        else: future.set_exception(error)
+
+class Connection:
+    """Socket-like handle of one accepted connection (threaded mode)
+
+    Sends only queue the data and return a Future. A writer thread, started while
+    there is something to write, sends what is queued in as few syscalls as it can.
+    A connection whose queue grows past MAX_OUTBOUND_BYTES is closed.
+    """
+    _lock = threading.Lock()
+    instances = set()
+    use_sendfile = hasattr(os, 'sendfile')
+
+    def __init__(self, sock: socket.socket, address):
+        self.sock = sock
+        self.address = address
+        # pending / client / api
+        self.kind = 'pending'
+        self.identifier = None
+        self.closed = False
+        # Handed over to a new process by HandOff, the socket lives on there
+        self.taken = False
+        # Framed clients use protocol.FrameDecoder, legacy ones protocol.LegacyDecoder
+        self.framed = False
+        self.decoder = None
+        # Features announced in the HELLO frame
+        self.features = set()
+        self.encoder = protocol.FrameEncoder()
+        # Set by LivenessTracker.add once the connection is a client
+        self.liveness = None
+        # ApiSession of an API connection
+        self.session = None
+        # Items: (bytes or (header, file, offset, count), size, Future)
+        self.outq = deque()
+        self.out_bytes = 0
+        self._writing = False
+        self._out_lock = threading.Lock()
+        self._out_ready = threading.Condition(self._out_lock)
+        self._frame_lock = threading.Lock()
+        # Held while received data is taken and handled, HandOff keeps it to stop the receiving thread
+        self.recv_lock = threading.Lock()
+        with Connection._lock:
+            Connection.instances.add(self)
+
+    def send(self, data: bytes) -> Future:
+        """Queue data, the Future gets the byte count once it is written or the error"""
+        return self._enqueue(data, len(data))
+
+    def send_frame(self, ftype: int, payload: bytes = b'') -> Future:
+        if not self.framed: return self.send(protocol.encode_legacy(ftype, payload))
+        # The compression stream has to see the frames in the order they are queued
+        with self._frame_lock:
+            return self.send(self.encoder.encode(ftype, payload))
+
+    def send_file_chunk(self, rid: int, file, offset: int, count: int) -> Future:
+        """FILE_CHUNK frame with count bytes of file from offset, file has to stay open until the Future is done"""
+        file.seek(offset)
+        data = file.read(count)
+        header = protocol.encode_chunk_header(rid, offset, data)
+        if not self.use_sendfile or not self.framed: return self.send_frame(protocol.FILE_CHUNK, header + data)
+        # Sent uncompressed, the writer moves the data from the page cache to the socket
+        with self._frame_lock:
+            header = protocol.HEADER.pack(len(header) + len(data), protocol.FILE_CHUNK) + header
+            return self._enqueue((header, file, offset, len(data)), len(header) + len(data))
+
+    def _enqueue(self, item, size: int) -> Future:
+        future = Future()
+        with self._out_lock:
+            if self.closed: raise OSError(errno.EBADF, "Connection closed")
+            # One large message still fits into an empty queue
+            overflow = self.out_bytes > 0 and self.out_bytes + size > MAX_OUTBOUND_BYTES
+            if not overflow:
+                self.outq.append((item, size, future))
+                self.out_bytes += size
+                start, self._writing = not self._writing, True
+                self._out_ready.notify()
+        if overflow:
+            self._drop_slow_consumer()
+            raise OSError(errno.ENOBUFS, "Outbound queue full")
+        if start: threading.Thread(target=self._write_loop, name='writer', daemon=True).start()
+        return future
+
+    def _drop_slow_consumer(self):
+        metrics.slow_consumers.inc()
+        logging.warning(f"Closing {self.identifier or self.address}, more than {MAX_OUTBOUND_BYTES} bytes are waiting to be sent",
+                        client=self.identifier)
+        self.close()
+
+    def _write_loop(self):
+        while True:
+            with self._out_lock:
+                # Stay around a little, messages tend to come in bursts
+                if not self.outq and not self.closed: self._out_ready.wait(WRITER_LINGER)
+                if not self.outq or self.closed:
+                    self._writing = False
+                    return
+                # Everything queued up to WRITE_BATCH_BYTES, or one file chunk
+                batch = [self.outq.popleft()]
+                size = batch[0][1]
+                if isinstance(batch[0][0], bytes):
+                    while self.outq and isinstance(self.outq[0][0], bytes) and size < WRITE_BATCH_BYTES:
+                        batch.append(self.outq.popleft())
+                        size += batch[-1][1]
+            try:
+                self._write(batch)
+            except OSError as e:
+                metrics.send_errors.inc()
+                if not self.closed: logging.error(f"Send error for {self.identifier or self.address}: {str(e) or 'timeout'}", client=self.identifier)
+                self.close()
+                resolve_futures(batch, e)
+                continue
+            finally:
+                with self._out_lock: self.out_bytes -= size
+            metrics.bytes_out.inc(size)
+            resolve_futures(batch)
+
+    def _write(self, batch: list):
+        # Gives up after SEND_TIMEOUT, partly written data cannot be taken back so a timeout closes the connection.
+        # The socket timeout is not used for this, the receiving thread waits in recv without one
+        deadline = time.monotonic() + SEND_TIMEOUT
+        item = batch[0][0]
+        if isinstance(item, bytes):
+            self._send_all(item if len(batch) == 1 else b''.join(entry[0] for entry in batch), deadline)
+        else:
+            header, file, offset, count = item
+            self._send_all(header, deadline)
+            self._send_file(file, offset, count, deadline)
+
+    def _send_all(self, data: bytes, deadline: float):
+        view = memoryview(data)
+        while view:
+            if time.monotonic() >= deadline: raise socket.timeout("Send timed out")
+            # A blocking send returns what it got out when SO_SNDTIMEO expires, or EAGAIN if that was nothing
+            try: view = view[self.sock.send(view):]
+            except BlockingIOError: raise socket.timeout("Send timed out")
+
+    def _send_file(self, file, offset: int, count: int, deadline: float):
+        while count > 0:
+            if time.monotonic() >= deadline: raise socket.timeout("Send timed out")
+            try: sent = os.sendfile(self.sock.fileno(), file.fileno(), offset, count)
+            except BlockingIOError: raise socket.timeout("Send timed out")
+            if not sent: raise OSError(errno.EIO, "File ended before the chunk")
+            offset, count = offset + sent, count - sent
+
+    def accept_client(self, identifier: str, decoder, features: set):
+        """Turn a pending connection into a client connection after its handshake"""
+        self.kind = 'client'
+        self.identifier = identifier
+        self.framed = isinstance(decoder, protocol.FrameDecoder)
+        self.decoder = decoder
+        self.features = features & protocol.FEATURES
+        if self.framed and protocol.FEATURE_ZLIB in self.features:
+            self.encoder = protocol.FrameEncoder(compress=True, stats=compression_stats)
+            decoder.inflate = True
+            decoder.stats = compression_stats
+
+    def send_hello_ack(self):
+        # Compressed frames are allowed only after this one
+        if self.framed: self.send_frame(protocol.HELLO_ACK, protocol.encode_features(self.features))
+
+    def recv(self, size: int) -> bytes:
+        return self.sock.recv(size)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def set_send_timeout(self, timeout: float):
+        """Let a blocking send give up after timeout (SO_SNDTIMEO), a recv waiting at the same time is not affected"""
+        if os.name == 'nt': value = struct.pack('L', int(timeout * 1000))
+        else: value = struct.pack('ll', int(timeout), int(timeout % 1 * 1000000))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+
+    def getsockname(self):
+        return self.sock.getsockname()
+
+    def getpeername(self):
+        return self.address
+
+    def _take_pending(self) -> list:
+        # Caller holds self._out_lock
+        pending = list(self.outq)
+        self.outq.clear()
+        return pending
+
+    def close(self):
+        with self._out_lock:
+            self.closed = True
+            pending = self._take_pending()
+        with Connection._lock:
+            Connection.instances.discard(self)
+        # Wakes up a thread blocked in recv on it. Shutdown acts on the socket, not the descriptor, it would cut off a taken one
+        if not self.taken:
+            try: self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+        self.sock.close()
+        resolve_futures(pending, ConnectionError("Connection closed"))
+
+    @staticmethod
+    def queued_bytes() -> int:
+        with Connection._lock:
+            connections = list(Connection.instances)
+        return sum(len(conn.outbuf) if isinstance(conn, LoopConnection) else conn.out_bytes for conn in connections)
+
+    @staticmethod
+    def count():
+        with Connection._lock:
+            connections = list(Connection.instances)
+        return (sum(1 for conn in connections if conn.kind == 'client'),
+                sum(1 for conn in connections if conn.kind == 'api'),
+                len(connections))
+
+class LoopConnection(Connection):
+    """Connection owned by EventLoopServer, writes are buffered and flushed by the loop"""
+    use_sendfile = False
+
+    def __init__(self, sock: socket.socket, address, loop):
+        super().__init__(sock, address)
+        self.loop = loop
+        self.outbuf = bytearray()
+        # Bytes queued / written since the connection was opened
+        self.queued = 0
+        self.written = 0
+        # Items: (self.queued after the data, size, Future)
+        self.waiters = deque()
+        self._flush_scheduled = False
+        # Id of the connection between a worker process and the coordinator
+        self.cid: int = None
+        # Handshake bytes received so far
+        self.inbuf = b''
+        self.last_recv = time.monotonic()
+
+    def send(self, data: bytes) -> Future:
+        future = Future()
+        with self._out_lock:
+            if self.closed:
+                raise OSError(errno.EBADF, "Connection closed")
+            overflow = len(self.outbuf) > 0 and len(self.outbuf) + len(data) > MAX_OUTBOUND_BYTES
+            if not overflow:
+                self.outbuf += data
+                self.queued += len(data)
+                self.waiters.append((self.queued, len(data), future))
+                # Sends until the loop gets to it go out with the same syscall
+                schedule, self._flush_scheduled = not self._flush_scheduled, True
+        if overflow:
+            self._drop_slow_consumer()
+            raise OSError(errno.ENOBUFS, "Outbound queue full")
+        if schedule: self.loop.call_soon_threadsafe(self.loop.flush, self)
+        return future
+
+    def _take_pending(self) -> list:
+        self.outbuf.clear()
+        pending = [(None, size, future) for _, size, future in self.waiters]
+        self.waiters.clear()
+        return pending
+
+    def settimeout(self, timeout):
+        # Timeouts are handled by the loop
+        pass
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.close_connection, self)
+
+class EventLoopServer:
+    """Runs every client and API connection on one selectors based event loop"""
+    HANDSHAKE_TIMEOUT = 10
+    API_IDLE_TIMEOUT = 60
+
+    def __init__(self, server_socket: socket.socket, client_manager: 'ClientManager'):
+        self.server_socket = server_socket
+        self.client_manager = client_manager
+        self.bans = client_manager.banned_ipaddresses if client_manager else BanList()
+        self.selector = selectors.DefaultSelector()
+        self._callbacks = deque()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._thread_id = None
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._callbacks.append((callback, args))
+        if threading.get_ident() != self._thread_id:
+            try: self._wakeup_send.send(b'\0')
+            except (BlockingIOError, OSError): pass
+
+    def serve_forever(self):
+        self._thread_id = threading.get_ident()
+        logging.never_block()
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+        last_check = time.monotonic()
+        while True:
+            for key, mask in self.selector.select(timeout=1):
+                if key.fileobj is self.server_socket:
+                    self._accept()
+                elif key.fileobj is self._wakeup_recv:
+                    self._drain_wakeup()
+                elif callable(key.data):
+                    key.data()
+                else:
+                    conn: LoopConnection = key.data
+                    if mask & selectors.EVENT_WRITE: self.flush(conn)
+                    if mask & selectors.EVENT_READ: self._on_readable(conn)
+            while self._callbacks:
+                callback, args = self._callbacks.popleft()
+                try: callback(*args)
+                except Exception as e: logging.error(f"In event loop callback: {str(e)}")
+            now = time.monotonic()
+            if now - last_check >= 1:
+                last_check = now
+                self._check_timeouts(now)
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_recv.recv(4096): pass
+        except (BlockingIOError, OSError): pass
+
+    def _accept(self):
+        # Take a batch of pending connections per wakeup
+        for _ in range(64):
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.error(f"Accept error: {str(e)}")
+                return
+            if client_address[0] in self.bans:
+                metrics.connections_rejected.inc()
+                client_socket.close()
+                continue
+            metrics.connections_accepted.inc()
+            client_socket.setblocking(False)
+            conn = LoopConnection(client_socket, client_address, self)
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+
+    def _throttle(self, conn: LoopConnection, decoder) -> bool:
+        """True if the new client is over --accept-rate, it has been sent RETRY_AFTER and closed"""
+        delay = throttle()
+        if not delay: return False
+        self._throttled(conn)
+        # Legacy clients do not know the frame, they only see the close
+        if isinstance(decoder, protocol.FrameDecoder):
+            conn.send(protocol.encode_frame(protocol.RETRY_AFTER, protocol.encode_retry_after(delay)))
+            self.flush(conn)
+        self.close_connection(conn)
+        return True
+
+    def _throttled(self, conn: LoopConnection):
+        metrics.connections_throttled.inc()
+
+    def flush(self, conn: LoopConnection):
+        if conn.closed: return
+        with conn._out_lock:
+            conn._flush_scheduled = False
+            try:
+                while conn.outbuf:
+                    sent = conn.sock.send(conn.outbuf)
+                    del conn.outbuf[:sent]
+                    conn.written += sent
+                    metrics.bytes_out.inc(sent)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as e:
+                metrics.send_errors.inc()
+                logging.error(f"Send error for {conn.identifier or conn.address}: {str(e)}", client=conn.identifier)
+                self.call_soon_threadsafe(self.close_connection, conn)
+                return
+            done = []
+            while conn.waiters and conn.waiters[0][0] <= conn.written: done.append(conn.waiters.popleft())
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if conn.outbuf else selectors.EVENT_READ
+        resolve_futures(done)
+        try: self.selector.modify(conn.sock, events, conn)
+        except (KeyError, ValueError): pass
+
+    def close_connection(self, conn: LoopConnection):
+        if conn.closed: return
+        try: self.selector.unregister(conn.sock)
+        except (KeyError, ValueError): pass
+        Connection.close(conn)
+        if conn.kind == 'client':
+            if self.client_manager.get_socket(conn.identifier) is conn:
+                self.client_manager.close_client(conn.identifier)
+        elif conn.kind == 'api':
+            if logging.sock is conn: logging.set_sock(None)
+            conn.session.close()
+            logging.warning(f"API from {conn.address} disconnected")
+
+    def _on_readable(self, conn: LoopConnection):
+        if conn.closed: return
+        try:
+            # Same size as the threaded handler while the handshake is not done
+            data = conn.sock.recv(27 if conn.kind == 'pending' else 65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close_connection(conn)
+            return
+        conn.last_recv = time.monotonic()
+
+        if conn.kind == 'pending':
+            self._handshake(conn, data)
+        elif conn.kind == 'client':
+            if not self._client_data(conn, data):
+                self.close_connection(conn)
+        elif conn.kind == 'api':
+            if not self._api_data(conn, data): self.close_connection(conn)
+
+    def _client_data(self, conn: LoopConnection, data: bytes) -> bool:
+        return receive_client_data(conn, data)
+
+    def _api_data(self, conn: LoopConnection, data: bytes) -> bool:
+        # Commands run on the session's own thread, they may block
+        return conn.session.feed(data)
+
+    def _handshake(self, conn: LoopConnection, data: bytes):
+        conn.inbuf += data
+        try: handshake = read_handshake(conn.inbuf)
+        except ValueError: self.close_connection(conn); return
+        if not handshake: return
+        conn.inbuf = b''
+        kind, value, decoder, features = handshake
+
+        if kind == 'client':
+            if not valid_identifier(value):
+                self.close_connection(conn)
+                return
+            if self._throttle(conn, decoder): return
+            conn.accept_client(value, decoder, features)
+            conn.send_hello_ack()
+            self.client_manager.add_client(value, conn)
+            # The handshake read may already contain the first messages
+            if not self._client_data(conn, b''):
+                self.close_connection(conn)
+
+        elif kind in ('api', 'session'):
+            if not API_ALLOW or value != PASSWORD:
+                self.close_connection(conn)
+                return
+            session = ApiSession.open(conn, kind == 'session')
+            if session is None:
+                conn.send(b"ERROR too many API sessions\n")
+                self.flush(conn)
+                self.close_connection(conn)
+                return
+            conn.kind = 'api'
+            conn.session = session
+            logging.warning(f"API from {conn.address} interrupt")
+            if not session.framed: logging.set_sock(conn)
+            if decoder and not session.feed(decoder): self.close_connection(conn)
+
+    def _check_timeouts(self, now: float):
+        for conn in self._connections():
+            if conn.kind == 'pending':
+                if now - conn.last_recv > self.HANDSHAKE_TIMEOUT: self.close_connection(conn)
+            elif conn.kind == 'api':
+                if now - conn.last_recv > self.API_IDLE_TIMEOUT: self.close_connection(conn)
+            # Clients are watched by client_manager.liveness
+
+    def _connections(self):
+        with Connection._lock:
+            return [conn for conn in Connection.instances if isinstance(conn, LoopConnection) and conn.loop is self]
+
+class WorkerChannel:
+    """Length prefixed pickles over the socketpair between the coordinator and one worker process
+
+    The coordinator queues its messages for a writer thread, it must never block on
+    a worker that is busy sending to it. Workers write directly from their loop.
+    """
+    HEADER = struct.Struct('!I')
+
+    def __init__(self, sock: socket.socket, queued: bool):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.closed = False
+        self._out = deque()
+        self._ready = threading.Condition()
+        if queued: threading.Thread(target=self._write_loop, name='channel', daemon=True).start()
+
+    @staticmethod
+    def pack(message) -> bytes:
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        return WorkerChannel.HEADER.pack(len(data)) + data
+
+    def send(self, message):
+        """Queue a message for the writer thread"""
+        with self._ready:
+            if self.closed: raise OSError(errno.EPIPE, "Worker channel closed")
+            self._out.append(WorkerChannel.pack(message))
+            self._ready.notify()
+
+    def send_many(self, messages: list):
+        self.sock.sendall(b''.join(WorkerChannel.pack(message) for message in messages))
+
+    def _write_loop(self):
+        while True:
+            with self._ready:
+                while not self._out: self._ready.wait()
+                data = b''.join(self._out)
+                self._out.clear()
+            try: self.sock.sendall(data)
+            except OSError:
+                with self._ready:
+                    self.closed = True
+                    self._out.clear()
+                return
+
+    def feed(self, data: bytes) -> list:
+        """Messages completed by data"""
+        self.inbuf += data
+        messages, offset = [], 0
+        while len(self.inbuf) - offset >= 4:
+            size = WorkerChannel.HEADER.unpack_from(self.inbuf, offset)[0]
+            if len(self.inbuf) - offset - 4 < size: break
+            messages.append(pickle.loads(self.inbuf[offset + 4:offset + 4 + size]))
+            offset += 4 + size
+        del self.inbuf[:offset]
+        return messages
+
+class WorkerLogger:
+    """Logger of a worker process, the records are logged by the coordinator"""
+    sock = None
+
+    def __init__(self, loop: 'WorkerLoop'):
+        self.loop = loop
+
+    def rint(self, mess: str = ''):
+        self.loop.post(('log', None, mess, {}))
+
+    def info(self, mess: str, **fields):
+        self.loop.post(('log', 'INFO', mess, fields))
+
+    def warning(self, mess: str, **fields):
+        self.loop.post(('log', 'WARNING', mess, fields))
+
+    def error(self, mess: str, **fields):
+        self.loop.post(('log', 'ERROR', mess, fields))
+
+    def flush(self, timeout: float = None):
+        pass
+
+class WorkerLoop(EventLoopServer):
+    """Event loop of a worker process
+
+    Accepts on its own SO_REUSEPORT socket, does the handshakes and decodes the
+    client frames. Everything but heartbeats goes to the coordinator, which owns
+    the ClientManager and sends back frames, raw bytes and closes per connection.
+    """
+    def __init__(self, server_socket: socket.socket, channel: WorkerChannel):
+        super().__init__(server_socket, None)
+        self.channel = channel
+        # Key: cid, Value: LoopConnection of a client or API connection
+        self.connections = {}
+        self._ids = itertools.count(1)
+        self._outbox = []
+
+    def serve_forever(self):
+        self.selector.register(self.channel.sock, selectors.EVENT_READ, self._on_channel)
+        super().serve_forever()
+
+    def post(self, message):
+        """Message to the coordinator, written together with the others of this loop iteration"""
+        self._outbox.append(message)
+        if len(self._outbox) == 1: self.call_soon_threadsafe(self._flush_outbox)
+
+    def _flush_outbox(self):
+        messages, self._outbox = self._outbox, []
+        self.channel.send_many(messages)
+
+    def _throttled(self, conn: LoopConnection):
+        self.post(('throttled',))
+
+    def _on_channel(self):
+        try: data = self.channel.sock.recv(1048576)
+        except (BlockingIOError, InterruptedError): return
+        except OSError: data = b''
+        # The coordinator is gone
+        if not data: os._exit(0)
+        for message in self.channel.feed(data): self._on_message(message)
+
+    def _on_message(self, message: tuple):
+        if message[0] == 'bans':
+            bans = BanList()
+            for ban, expires in message[1].items(): bans.add(ban, expires)
+            self.bans = bans
+            return
+        op, cid = message[0], message[1]
+        conn = self.connections.get(cid)
+        if conn is None or conn.closed: return
+        try:
+            if op == 'frame': conn.send_frame(message[2], message[3])
+            elif op == 'raw': conn.send(message[2])
+            # After the sends before it, they are flushed first
+            elif op == 'close': conn.close()
+        except OSError:
+            pass
+
+    def _handshake(self, conn: LoopConnection, data: bytes):
+        conn.inbuf += data
+        try: handshake = read_handshake(conn.inbuf)
+        except ValueError: self.close_connection(conn); return
+        if not handshake: return
+        conn.inbuf = b''
+        kind, value, decoder, features = handshake
+        conn.cid = next(self._ids)
+
+        if kind == 'client':
+            if not valid_identifier(value):
+                self.close_connection(conn)
+                return
+            if self._throttle(conn, decoder): return
+            conn.accept_client(value, decoder, features)
+            conn.send_hello_ack()
+            self.connections[conn.cid] = conn
+            self.post(('open', conn.cid, value, conn.address, sorted(conn.features), conn.framed))
+            if not self._client_data(conn, b''): self.close_connection(conn)
+        else:
+            # The password is checked by the coordinator
+            conn.kind = 'api'
+            self.connections[conn.cid] = conn
+            self.post(('api', conn.cid, kind, value, conn.address, decoder or b''))
+
+    def _client_data(self, conn: LoopConnection, data: bytes) -> bool:
+        conn.decoder.feed(data)
+        frames = []
+        try:
+            for ftype, payload in conn.decoder.frames():
+                # Answered here, the coordinator only has to know the client is alive
+                if ftype == protocol.HEARTBEAT: conn.send_frame(protocol.HEARTBEAT_RESPONSE)
+                else: frames.append((ftype, bytes(payload)))
+        except protocol.FrameError:
+            return False
+        if data or frames: self.post(('frames', conn.cid, frames, len(data)))
+        return True
+
+    def _api_data(self, conn: LoopConnection, data: bytes) -> bool:
+        self.post(('data', conn.cid, data))
+        return True
+
+    def close_connection(self, conn: LoopConnection):
+        if conn.closed: return
+        try: self.selector.unregister(conn.sock)
+        except (KeyError, ValueError): pass
+        Connection.close(conn)
+        if self.connections.pop(conn.cid, None) is not None: self.post(('closed', conn.cid))
+
+def throttle() -> float:
+    """0 if a new client may come in, otherwise the seconds it is told to wait (--accept-rate)
+
+    Checked after the handshake, API connections are not limited so the console
+    and the other nodes stay usable during a reconnect storm.
+    """
+    return admission.take() if admission else 0
+
+def open_listener(host: str, port: int, reuse_port: bool = False) -> socket.socket:
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # A restart binds again while the connections of the old process are in TIME_WAIT, on Windows this would allow stealing the port
+    if os.name != 'nt': server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port: server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(LISTEN_BACKLOG)
+    return server_socket
+
+def run_worker(host: str, port: int, channel: WorkerChannel, workers: int = 1):
+    """Body of a forked worker process, never returns"""
+    global logging, metrics, compression_stats, admission
+    # Locks of the parent may have been held by its other threads at the fork
+    Connection._lock = threading.Lock()
+    Connection.instances = set()
+    metrics = ServerMetrics()
+    compression_stats = protocol.CompressionStats()
+    # The kernel spreads the connections evenly over the workers
+    if admission: admission = admission.share(workers)
+    # Ctrl+C goes to the whole process group, the coordinator decides
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        loop = WorkerLoop(open_listener(host, port, reuse_port=True), channel)
+        logging = WorkerLogger(loop)
+        loop.serve_forever()
+    except BaseException as e:
+        try: channel.send_many([('log', 'ERROR', f"Worker stopped: {e}", {})])
+        except OSError: pass
+    finally:
+        os._exit(1)
+
+class RemoteConnection(Connection):
+    """Coordinator side of a connection held by a worker process
+
+    Sends go to the worker over its channel, the Future is done once they are
+    handed over. The worker encodes frames, the compression stream lives there.
+    """
+    use_sendfile = False
+
+    def __init__(self, worker: 'WorkerProcess', cid: int, address):
+        super().__init__(None, address)
+        self.worker = worker
+        self.cid = cid
+
+    def send(self, data: bytes) -> Future:
+        return self._post(('raw', self.cid, bytes(data)), len(data))
+
+    def send_frame(self, ftype: int, payload: bytes = b'') -> Future:
+        return self._post(('frame', self.cid, ftype, bytes(payload)), len(payload))
+
+    def _post(self, message: tuple, size: int) -> Future:
+        if self.closed: raise OSError(errno.EBADF, "Connection closed")
+        self.worker.channel.send(message)
+        metrics.bytes_out.inc(size)
+        future = Future()
+        future.set_result(size)
+        return future
+
+    def close(self):
+        with self._out_lock:
+            if self.closed: return
+            self.closed = True
+        with Connection._lock:
+            Connection.instances.discard(self)
+        try: self.worker.channel.send(('close', self.cid))
+        except OSError: pass
+
+class WorkerProcess:
+    def __init__(self, index: int, pid: int, channel: WorkerChannel):
+        self.index = index
+        self.pid = pid
+        self.channel = channel
+        self.alive = True
+        self.reader: threading.Thread = None
+
+class WorkerPool:
+    """Worker processes accepting on one SO_REUSEPORT port, this process keeps the ClientManager
+
+    Each worker runs a WorkerLoop. Its connections show up here as RemoteConnection,
+    their messages are handled by one reader thread per worker.
+    """
+    def __init__(self, count: int, host: str, port: int):
+        self.count = count
+        self.host = host
+        self.port = port
+        self.workers = []
+        # Key: (worker index, cid), Value: RemoteConnection
+        self.connections = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        # All pairs first, so every worker can close the ends that are not its own
+        pairs = [socket.socketpair() for _ in range(self.count)]
+        # Nothing of the parent's writer is half done in the children
+        logging.flush()
+        for index, (ours, theirs) in enumerate(pairs):
+            pid = os.fork()
+            if pid == 0:
+                for other_ours, other_theirs in pairs:
+                    other_ours.close()
+                    if other_theirs is not theirs: other_theirs.close()
+                run_worker(self.host, self.port, WorkerChannel(theirs, queued=False), self.count)
+            theirs.close()
+            self.workers.append(WorkerProcess(index, pid, WorkerChannel(ours, queued=True)))
+        for worker in self.workers:
+            worker.reader = threading.Thread(target=self._read_loop, args=(worker,), name=f'worker-{worker.index}', daemon=True)
+            worker.reader.start()
+        self.sync_bans()
+
+    def wait(self):
+        """Until every worker has exited"""
+        for worker in self.workers: worker.reader.join()
+
+    def sync_bans(self):
+        """Send the whole ban list to every worker, they check it at accept"""
+        with client_manager.lock:
+            entries = dict(client_manager.banned_ipaddresses.entries)
+        for worker in self.workers:
+            try: worker.channel.send(('bans', entries))
+            except OSError: pass
+
+    def _read_loop(self, worker: WorkerProcess):
+        while True:
+            try: data = worker.channel.sock.recv(1048576)
+            except OSError: data = b''
+            if not data: break
+            for message in worker.channel.feed(data):
+                try: self._on_message(worker, message)
+                except Exception as e: logging.error(f"Handling a message of worker {worker.index}: {str(e)}")
+        worker.alive = False
+        try: os.waitpid(worker.pid, 0)
+        except OSError: pass
+        logging.error(f"Worker {worker.index} (pid {worker.pid}) exited, its connections are closed")
+        with self._lock:
+            lost = [cid for index, cid in self.connections if index == worker.index]
+        for cid in lost: self._closed(worker, cid)
+
+    def _on_message(self, worker: WorkerProcess, message: tuple):
+        op = message[0]
+        if op == 'frames':
+            _, cid, frames, size = message
+            conn = self.connections.get((worker.index, cid))
+            if conn is not None and not conn.closed: self._frames(conn, frames, size)
+
+        elif op == 'open':
+            _, cid, identifier, address, features, framed = message
+            conn = RemoteConnection(worker, cid, address)
+            conn.kind, conn.identifier, conn.framed, conn.features = 'client', identifier, framed, set(features)
+            with self._lock: self.connections[(worker.index, cid)] = conn
+            metrics.connections_accepted.inc()
+            client_manager.add_client(identifier, conn)
+
+        elif op == 'throttled':
+            metrics.connections_throttled.inc()
+
+        elif op == 'api':
+            _, cid, kind, password, address, rest = message
+            conn = RemoteConnection(worker, cid, address)
+            with self._lock: self.connections[(worker.index, cid)] = conn
+            if not API_ALLOW or password != PASSWORD:
+                conn.close()
+                return
+            session = ApiSession.open(conn, kind == 'session')
+            if session is None:
+                conn.send(b"ERROR too many API sessions\n")
+                conn.close()
+                return
+            conn.kind = 'api'
+            conn.session = session
+            logging.warning(f"API from {address} interrupt")
+            if not session.framed: logging.set_sock(conn)
+            if rest and not session.feed(rest): conn.close()
+
+        elif op == 'data':
+            conn = self.connections.get((worker.index, message[1]))
+            if conn is not None and conn.session and not conn.session.feed(message[2]): conn.close()
+
+        elif op == 'closed':
+            self._closed(worker, message[1])
+
+        elif op == 'log':
+            _, level, mess, fields = message
+            if level is None: logging.rint(mess)
+            else: getattr(logging, level.lower())(f"Worker {worker.index}: {mess}", **fields)
+
+    def _frames(self, conn: RemoteConnection, frames: list, size: int):
+        LivenessTracker.seen(conn)
+        metrics.bytes_in.inc(size)
+        metrics.frames_in.inc(len(frames))
+        with metrics.client_data.time():
+            try:
+                for ftype, payload in frames:
+                    if not process_client_frame(conn.identifier, ftype, payload):
+                        conn.close()
+                        return
+            except (protocol.FrameError, UnicodeDecodeError):
+                conn.close()
+
+    def _closed(self, worker: WorkerProcess, cid: int):
+        """The worker closed the connection, or the worker is gone"""
+        with self._lock: conn = self.connections.pop((worker.index, cid), None)
+        if conn is None: return
+        if conn.kind == 'client':
+            # Only drop the registry entry if it has not been taken over by a reconnect
+            if client_manager.get_socket(conn.identifier) is conn: client_manager.close_client(conn.identifier)
+            else: conn.close()
+        else:
+            conn.close()
+            if conn.kind == 'api':
+                if logging.sock is conn: logging.set_sock(None)
+                conn.session.close()
+                logging.warning(f"API from {conn.address} disconnected")
+
+    def summary(self) -> str:
+        with self._lock:
+            counts = [sum(1 for index, _ in self.connections if index == worker.index) for worker in self.workers]
+        parts = []
+        for worker, count in zip(self.workers, counts):
+            if not worker.alive:
+                parts.append(f"#{worker.index} exited")
+                continue
+            try:
+                with open(f'/proc/{worker.pid}/statm', 'r') as f: memory = f" {int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576:.1f} MiB"
+            except (OSError, ValueError, IndexError, AttributeError):
+                memory = ""
+            parts.append(f"#{worker.index} pid {worker.pid} {count} conn{memory}")
+        return f"{sum(worker.alive for worker in self.workers)}/{len(self.workers)} alive: " + ', '.join(parts)
+
+class HandOff:
+    """Restart that keeps the client connections
+
+    The listening socket and the client sockets are put in flight on a Unix
+    socketpair with SCM_RIGHTS, together with a file holding the identifier,
+    address and protocol state of every client. The process then execs itself,
+    the new image gets the other end of the pair with --takeover and adopts the
+    sockets before it serves. Started zlib streams go on from their last 32 KiB
+    of history, see FrameEncoder.continue_stream.
+    """
+    # Descriptors per message, the kernel takes SCM_MAX_FD (253) at most
+    FDS_PER_MESSAGE = 250
+
+    @staticmethod
+    def supported() -> bool:
+        return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'SCM_RIGHTS') and SERVER_MODE != 'workers' and listen_socket is not None
+
+    @staticmethod
+    def restart(argv: list):
+        """Hand the clients over and exec argv, on the event loop thread in loop mode. Never returns"""
+        try:
+            clients, dropped = HandOff.take_clients()
+            fd = HandOff.send(clients)
+            argv = argv + ['--takeover', str(fd)]
+            logging.info(f"Handing {len(clients)} client(s) over to the new process" + (f", {dropped} will reconnect" if dropped else ""))
+        except OSError as e:
+            logging.error(f"Cannot hand the clients over, they will reconnect: {str(e)}")
+        logging.flush()
+        os.execv(sys.executable, ['python'] + argv)
+
+    @staticmethod
+    def take_clients() -> tuple:
+        """Stop every client connection, returns ([(descriptor, state)], count of those that cannot be handed over)
+
+        A connection is not used any more once it is taken, the exec follows.
+        Everything here shares HANDOFF_DRAIN_TIMEOUT, a connection whose thread is
+        still busy in a handler by then is left out and reconnects.
+        """
+        with Connection._lock:
+            connections = [conn for conn in Connection.instances if conn.kind == 'client' and not conn.closed]
+        deadline = time.monotonic() + HANDOFF_DRAIN_TIMEOUT
+        # Their receiving threads stop before the next read, the locks are never released
+        threaded = [conn for conn in connections if not isinstance(conn, LoopConnection)
+                    and conn.recv_lock.acquire(timeout=max(deadline - time.monotonic(), 0))]
+        busy = sum(1 for conn in connections if not isinstance(conn, LoopConnection)) - len(threaded)
+        if busy: logging.warning(f"{busy} client(s) are busy and cannot be handed over, they will reconnect")
+        # Data a writer thread has taken may be partly written, wait for the queues to run empty
+        while any(conn.out_bytes for conn in threaded) and time.monotonic() < deadline: time.sleep(0.01)
+
+        held = set(threaded)
+        clients = []
+        for conn in connections:
+            if not isinstance(conn, LoopConnection) and conn not in held: continue
+            with conn._out_lock:
+                loop = isinstance(conn, LoopConnection)
+                if conn.closed or (not loop and conn.out_bytes): continue
+                # Loop connections are only written by the loop thread, this one
+                outbound = bytes(conn.outbuf) if loop else b''
+                conn.closed = conn.taken = True
+                # Its own descriptor, the connection may still be closed by another thread meanwhile
+                fd = os.dup(conn.sock.fileno())
+            clients.append((fd, (conn.identifier, conn.address, conn.framed, conn.features, conn.decoder.buffered(), outbound,
+                                 conn.encoder.history(), conn.decoder.history())))
+        return clients, len(connections) - len(clients)
+
+    @staticmethod
+    def send(clients: list) -> int:
+        """Put the sockets in flight, returns the descriptor the new image reads them from"""
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            with tempfile.TemporaryFile() as state:
+                pickle.dump([entry for _, entry in clients], state)
+                state.flush()
+                fds = [state.fileno(), listen_socket.fileno()] + [fd for fd, _ in clients]
+                for start in range(0, len(fds), HandOff.FDS_PER_MESSAGE):
+                    ours.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', fds[start:start + HandOff.FDS_PER_MESSAGE]))])
+        except OSError:
+            theirs.close()
+            raise
+        finally:
+            # What is in flight stays readable on the other end
+            ours.close()
+            for fd, _ in clients: os.close(fd)
+        theirs.set_inheritable(True)
+        return theirs.detach()
+
+    @staticmethod
+    def receive(fd: int) -> tuple:
+        """(listening socket, [(client socket, state)]) put in flight by the old image"""
+        channel = socket.socket(fileno=fd)
+        fds, size = [], array('i').itemsize
+        try:
+            while True:
+                data, ancdata, _, _ = channel.recvmsg(1, socket.CMSG_SPACE(HandOff.FDS_PER_MESSAGE * size))
+                if not data: break
+                for level, kind, payload in ancdata:
+                    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                        fds.extend(array('i', payload[:len(payload) - len(payload) % size]))
+        finally:
+            channel.close()
+        with os.fdopen(fds[0], 'rb') as state:
+            state.seek(0)
+            clients = pickle.load(state)
+        return socket.socket(fileno=fds[1]), [(socket.socket(fileno=client_fd), entry) for client_fd, entry in zip(fds[2:], clients)]
+
+    @staticmethod
+    def adopt(clients: list, loop: 'EventLoopServer' = None):
+        """Serve the clients of the old image like freshly accepted ones, after their handshake"""
+        for sock, (identifier, address, framed, features, inbound, outbound, sent, received) in clients:
+            conn = LoopConnection(sock, address, loop) if loop else Connection(sock, address)
+            decoder = protocol.FrameDecoder() if framed else protocol.LegacyDecoder()
+            decoder.feed(inbound)
+            conn.accept_client(identifier, decoder, features)
+            if sent is not None: conn.encoder.continue_stream(sent)
+            if received is not None: decoder.continue_stream(received)
+            if loop: sock.setblocking(False)
+            else:
+                conn.settimeout(None)
+                conn.set_send_timeout(SEND_TIMEOUT)
+            client_manager.add_client(identifier, conn)
+            if outbound: conn.send(outbound)
+            if loop:
+                loop.selector.register(sock, selectors.EVENT_READ, conn)
+                if not loop._client_data(conn, b''): loop.close_connection(conn)
+            else:
+                threading.Thread(target=handle_client_message, args=(identifier, conn), daemon=True).start()
+        if clients: logging.info(f"Took over {len(clients)} client(s) from the previous process")
+
+class TimerQueue:
+    """Runs callbacks at time.monotonic() deadlines
+
+    One thread keeps the deadlines in a heap and sleeps on a condition variable
+    until the earliest one, due callbacks run on a bounded worker pool.
+    """
+    # Longest wait Condition.wait takes on this platform
+    MAX_DELAY = threading.TIMEOUT_MAX
+
+    def __init__(self, name: str, max_workers: int = 8, lag_histogram: Histogram = None):
+        self.name = name
+        self.lag_histogram = lag_histogram
+        self._heap = []
+        # Handles in the heap / of those, the cancelled ones
+        self._handles = set()
+        self._cancelled = set()
+        self._cond = threading.Condition()
+        self._counter = itertools.count()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        # How late callbacks started, in seconds
+        self.fired = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def call_at(self, deadline: float, callback, *args) -> int:
+        """Raises ValueError if the deadline is further away than the platform can wait"""
+        if not deadline - time.monotonic() < TimerQueue.MAX_DELAY: raise ValueError("Deadline is too far in the future")
+        handle = next(self._counter)
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, handle, callback, args))
+            self._handles.add(handle)
+            # Only wake up the timer thread if the earliest deadline changed
+            if self._heap[0][1] == handle: self._cond.notify()
+        return handle
+
+    def call_later(self, delay: float, callback, *args) -> int:
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def cancel(self, handle: int):
+        with self._cond:
+            # A handle that already fired is not in the heap any more
+            if handle in self._handles: self._cancelled.add(handle)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap) - len(self._cancelled)
+
+    def _run(self):
+        while True:
+            try:
+                with self._cond:
+                    while True:
+                        while self._heap and self._heap[0][1] in self._cancelled:
+                            handle = heapq.heappop(self._heap)[1]
+                            self._cancelled.discard(handle)
+                            self._handles.discard(handle)
+                        if not self._heap:
+                            self._cond.wait()
+                            continue
+                        timeout = self._heap[0][0] - time.monotonic()
+                        if timeout <= 0: break
+                        self._cond.wait(min(timeout, TimerQueue.MAX_DELAY))
+                    deadline, handle, callback, args = heapq.heappop(self._heap)
+                    self._handles.discard(handle)
+                self._pool.submit(self._fire, deadline, callback, args)
+            except Exception as e:
+                logging.error(f"In {self.name} timer: {str(e)}")
+
+    def _fire(self, deadline: float, callback, args):
+        lag = max(time.monotonic() - deadline, 0)
+        with self._cond:
+            self.fired += 1
+            self.lag_last = lag
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_total += lag
+        if self.lag_histogram: self.lag_histogram.observe(lag)
+        try: callback(*args)
+        except Exception as e: logging.error(f"In {self.name} callback: {str(e)}")
+
+    def lag_summary(self) -> str:
+        with self._cond:
+            if not self.fired: return "no message fired yet"
+            return (f"{self.fired} fired, last {self.lag_last * 1000:.1f} ms, "
+                    f"avg {self.lag_total / self.fired * 1000:.1f} ms, max {self.lag_max * 1000:.1f} ms")
+
+class Liveness:
+    """Liveness of one client connection, times are time.monotonic()"""
+    __slots__ = ('identifier', 'conn', 'last_seen', 'deadline', 'ping_sent', 'missed', 'missed_total', 'pings', 'rtt', 'rtt_avg')
+
+    def __init__(self, identifier: str, conn: Connection, now: float):
+        self.identifier = identifier
+        self.conn = conn
+        self.last_seen = now
+        self.deadline = now
+        # Time of the unanswered HEARTBEAT, None if there is none
+        self.ping_sent: float = None
+        # Pings missed in a row / since the client connected
+        self.missed = 0
+        self.missed_total = 0
+        self.pings = 0
+        self.rtt: float = None
+        self.rtt_avg: float = None
+
+class LivenessTracker:
+    """Last seen times of every client on a hashed timer wheel
+
+    Any data from a client proves it is alive, seen() only stores the time.
+    When the wheel reaches a client it is pinged if it has been idle for
+    IDLE_TIMEOUT, otherwise it is put back at its new idle deadline, so busy
+    clients cost one wheel step per IDLE_TIMEOUT. A client that misses
+    MAX_MISSED pings in a row is dead, the dead ones of a tick are handed
+    to on_dead together.
+    """
+    IDLE_TIMEOUT = 30
+    PING_TIMEOUT = 10
+    MAX_MISSED = 3
+
+    def __init__(self, on_dead, tick: float = 1.0, slots: int = 64):
+        self.on_dead = on_dead
+        self.tick = tick
+        self._wheel = [[] for _ in range(slots)]
+        self._position = 0
+        self._start = time.monotonic()
+        # Key: identifier, Value: Liveness of its current connection
+        self._records = {}
+        self._lock = threading.Lock()
+        self.pings = 0
+        self.evicted = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, identifier: str, conn: Connection):
+        now = time.monotonic()
+        record = Liveness(identifier, conn, now)
+        conn.liveness = record
+        with self._lock:
+            self._records[identifier] = record
+            self._schedule(record, now + self.IDLE_TIMEOUT)
+
+    def discard(self, identifier: str, conn: Connection):
+        # Its wheel entry is dropped when the wheel reaches it
+        with self._lock:
+            record = self._records.get(identifier)
+            if record is not None and record.conn is conn: del self._records[identifier]
+
+    @staticmethod
+    def seen(conn: Connection):
+        record = conn.liveness
+        if record is not None: record.last_seen = time.monotonic()
+
+    def pong(self, identifier: str):
+        now = time.monotonic()
+        with self._lock:
+            record = self._records.get(identifier)
+            if record is None or record.ping_sent is None: return
+            record.rtt = now - record.ping_sent
+            record.rtt_avg = record.rtt if record.rtt_avg is None else record.rtt_avg * 0.8 + record.rtt * 0.2
+            record.ping_sent = None
+            record.missed = 0
+
+    def get(self, identifier: str) -> Liveness:
+        with self._lock:
+            return self._records.get(identifier)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def _schedule(self, record: Liveness, deadline: float):
+        # Caller holds self._lock, a deadline beyond one turn waits for more turns
+        record.deadline = deadline
+        tick = max(int(-(-(deadline - self._start) // self.tick)), self._position + 1)
+        self._wheel[tick % len(self._wheel)].append(record)
+
+    def _run(self):
+        while True:
+            time.sleep(max(self._start + (self._position + 1) * self.tick - time.monotonic(), 0))
+            try: self._advance(time.monotonic())
+            except Exception as e: logging.error(f"In liveness tracker: {str(e)}")
+
+    def _advance(self, now: float):
+        ping, dead = [], []
+        with self._lock:
+            while self._start + (self._position + 1) * self.tick <= now:
+                self._position += 1
+                slot = self._position % len(self._wheel)
+                records, self._wheel[slot] = self._wheel[slot], []
+                for record in records:
+                    # Closed, or replaced by a reconnect
+                    if self._records.get(record.identifier) is not record or record.conn.closed: continue
+                    if record.deadline > now: self._schedule(record, record.deadline)
+                    elif record.ping_sent is not None and record.last_seen <= record.ping_sent:
+                        record.missed += 1
+                        record.missed_total += 1
+                        if record.missed >= self.MAX_MISSED:
+                            del self._records[record.identifier]
+                            dead.append(record)
+                            continue
+                        ping.append(record)
+                    elif record.last_seen + self.IDLE_TIMEOUT > now:
+                        # Traffic since the last look, an unanswered ping is answered by it as well
+                        record.ping_sent = None
+                        record.missed = 0
+                        self._schedule(record, record.last_seen + self.IDLE_TIMEOUT)
+                    else:
+                        ping.append(record)
+            for record in ping:
+                record.ping_sent = now
+                record.pings += 1
+                self._schedule(record, now + self.PING_TIMEOUT)
+            self.pings += len(ping)
+            self.evicted += len(dead)
+        for record in ping:
+            # Short timeout, one stuck client must not hold up the others
+            try: record.conn.send_frame(protocol.HEARTBEAT)
+            except OSError: pass
+        if dead: self.on_dead(dead)
+
+    def summary(self) -> str:
+        with self._lock:
+            return f"{len(self._records)} clients tracked, {self.pings} pings sent, {self.evicted} dead clients evicted"
+
+class DataStore:
+    """SQLite storage for nicknames, history, bans and scheduled messages
+
+    Mutations are queued and written by one thread in batched transactions,
+    so callers never wait for the disk while holding ClientManager.lock. A batch
+    that fails is written again statement by statement, flush reports what failed.
+    """
+    COMPACT_INTERVAL = 3600
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS nicknames (identifier TEXT PRIMARY KEY, nickname TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS nicknames_nickname ON nicknames (nickname)",
+        "CREATE TABLE IF NOT EXISTS history (identifier TEXT PRIMARY KEY, last_seen TEXT NOT NULL, host TEXT, port INTEGER)",
+        "CREATE INDEX IF NOT EXISTS history_last_seen ON history (last_seen)",
+        "CREATE TABLE IF NOT EXISTS bans (ipaddress TEXT PRIMARY KEY, expires REAL)",
+        "CREATE TABLE IF NOT EXISTS schedules (id TEXT PRIMARY KEY, identifier TEXT NOT NULL, message TEXT NOT NULL, execute_time TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS schedules_execute_time ON schedules (execute_time)",
+    )
+
+    def __init__(self, db_file: str, json_file: str = None):
+        self.db_file = db_file
+        self.json_file = json_file
+        self._queue = queue.Queue()
+        self._last_compact = time.monotonic()
+
+        db = self._connect()
+        try:
+            with db:
+                for statement in DataStore.SCHEMA: db.execute(statement)
+                # Data files written before bans could expire
+                if 'expires' not in [column[1] for column in db.execute("PRAGMA table_info(bans)")]:
+                    db.execute("ALTER TABLE bans ADD COLUMN expires REAL")
+            if json_file and os.path.exists(json_file) and self._is_empty(db):
+                self._migrate_json(db)
+        finally:
+            db.close()
+
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_file)
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @staticmethod
+    def _is_empty(db: sqlite3.Connection) -> bool:
+        for table in ('nicknames', 'history', 'bans', 'schedules'):
+            if db.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone(): return False
+        return True
+
+    def _migrate_json(self, db: sqlite3.Connection):
+        with open(self.json_file, 'r') as f:
+            data = json.load(f)
+        with db:
+            db.executemany("INSERT OR REPLACE INTO nicknames VALUES (?, ?)", data.get('nicknames', {}).items())
+            db.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)",
+                           ((identifier, last_seen, address[0], address[1])
+                            for identifier, (last_seen, address) in data.get('history', {}).items()))
+            db.executemany("INSERT OR REPLACE INTO bans VALUES (?, NULL)", ((ip,) for ip in data.get('banned-ipaddresses', [])))
+            db.executemany("INSERT OR REPLACE INTO schedules VALUES (?, ?, ?, ?)",
+                           ((uuid.uuid4().hex, mess["identifier"], mess["message"], mess["execute_time"])
+                            for mess in data.get('scheduled-messages', [])))
+        os.replace(self.json_file, self.json_file + '.migrated')
+        logging.info(f"Migrated {os.path.basename(self.json_file)} to {os.path.basename(self.db_file)}")
+
+    def load(self) -> dict:
+        db = self._connect()
+        try:
+            return {
+                'nicknames': dict(db.execute("SELECT identifier, nickname FROM nicknames")),
+                'history': {identifier: (last_seen, (host, port)) for identifier, last_seen, host, port
+                            in db.execute("SELECT identifier, last_seen, host, port FROM history")},
+                'banned-ipaddresses': list(db.execute("SELECT ipaddress, expires FROM bans")),
+                'scheduled-messages': [{"id": sid, "identifier": identifier, "message": message, "execute_time": execute_time}
+                                       for sid, identifier, message, execute_time
+                                       in db.execute("SELECT id, identifier, message, execute_time FROM schedules ORDER BY execute_time")],
+            }
+        finally:
+            db.close()
+
+    def _put(self, sql: str, params=()):
+        self._queue.put((sql, params))
+
+    def set_nickname(self, identifier: str, nickname: str):
+        self._put("INSERT OR REPLACE INTO nicknames VALUES (?, ?)", (identifier, nickname))
+
+    def delete_nickname(self, identifier: str):
+        self._put("DELETE FROM nicknames WHERE identifier = ?", (identifier,))
+
+    def set_history(self, identifier: str, last_seen: str, address):
+        self._put("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)", (identifier, last_seen, address[0], address[1]))
+
+    def delete_history(self, identifier: str):
+        self._put("DELETE FROM history WHERE identifier = ?", (identifier,))
+
+    def add_ban(self, ip_address: str, expires: float = None):
+        self._put("INSERT OR REPLACE INTO bans VALUES (?, ?)", (ip_address, expires))
+
+    def delete_ban(self, ip_address: str):
+        self._put("DELETE FROM bans WHERE ipaddress = ?", (ip_address,))
+
+    def add_schedule(self, sche_mess: 'ScheduledMessage'):
+        self._put("INSERT OR REPLACE INTO schedules VALUES (?, ?, ?, ?)",
+                  (sche_mess.id, sche_mess.identifier, sche_mess.message, str(sche_mess.execute_time)))
+
+    def delete_schedule(self, sche_mess: 'ScheduledMessage'):
+        self._put("DELETE FROM schedules WHERE id = ?", (sche_mess.id,))
+
+    def flush(self, compact: bool = False, timeout: float = None) -> bool:
+        """Wait until everything queued so far is written, raises sqlite3.Error if some of it could not be"""
+        done = Future()
+        self._queue.put((done, compact))
+        try: done.result(timeout)
+        except FutureTimeoutError: return False
+        return True
+
+    def _write_loop(self):
+        db = self._connect()
+        # Statements that failed since the last flush
+        failed = 0
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < 1000: batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            statements = [(sql, params) for sql, params in batch if not isinstance(sql, Future)]
+            try:
+                with db:
+                    for sql, params in statements: db.execute(sql, params)
+            except Exception:
+                # One bad statement must not roll back the others of the batch
+                for sql, params in statements:
+                    try:
+                        with db: db.execute(sql, params)
+                    except Exception as e:
+                        failed += 1
+                        logging.error(f"Error writing data file: {str(e)}", sql=sql)
+
+            flushes = [(done, compact) for done, compact in batch if isinstance(done, Future)]
+            if any(compact for _, compact in flushes) or time.monotonic() - self._last_compact > DataStore.COMPACT_INTERVAL:
+                self._compact(db)
+            for done, _ in flushes:
+                if failed: done.set_exception(sqlite3.Error(f"{failed} change(s) could not be written, see the log"))
+                else: done.set_result(None)
+            if flushes: failed = 0
+
+    def _compact(self, db: sqlite3.Connection):
+        self._last_compact = time.monotonic()
+        try:
+            db.execute("PRAGMA incremental_vacuum")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logging.error(f"Error compacting data file: {str(e)}")
+
+class ForwardSession:
+    """API session to another node of the federation, see ApiSession"""
+    def __init__(self, node: str, address: str):
+        self.node = node
+        host, _, port = address.rpartition(':')
+        self.address = (host, int(port))
+        self.sock: socket.socket = None
+        self._rids = itertools.count(1)
+        # Key: rid, Value: (output lines, done Event) of commands waiting for their END
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def run(self, command: str, timeout: float) -> list:
+        """Output lines of a command run on the node, raises OSError if the node cannot be reached"""
+        with self._lock:
+            if self.sock is None: self._connect()
+            rid = str(next(self._rids))
+            lines, done = [], threading.Event()
+            self._pending[rid] = (lines, done)
+            try: self.sock.sendall(f"{rid} local {command}\n".encode('utf-8'))
+            except OSError:
+                self._pending.pop(rid, None)
+                self._drop()
+                raise
+        if not done.wait(timeout):
+            with self._lock: self._pending.pop(rid, None)
+            raise OSError(errno.ETIMEDOUT, f"No answer from node {self.node}")
+        return lines
+
+    def _connect(self):
+        # Caller holds self._lock
+        sock = socket.create_connection(self.address, timeout=5)
+        sock.settimeout(None)
+        sock.sendall(f"SESSION:{PASSWORD}\n".encode('utf-8'))
+        self.sock = sock
+        threading.Thread(target=self._read_loop, args=(sock,), name=f'node-{self.node}', daemon=True).start()
+
+    def _drop(self):
+        # Caller holds self._lock
+        if self.sock is None: return
+        try: self.sock.close()
+        except OSError: pass
+        self.sock = None
+
+    def _read_loop(self, sock: socket.socket):
+        for raw in sock.makefile('rb'):
+            line = raw.decode('utf-8', 'replace').rstrip('\n')
+            rid, _, text = line.partition(' ')
+            with self._lock: waiting = self._pending.get(rid)
+            if text == 'END':
+                with self._lock: self._pending.pop(rid, None)
+                if waiting: waiting[1].set()
+            elif text.startswith('| '):
+                # Output after END belongs to work the command left running there
+                if waiting: waiting[0].append(text[2:])
+                else: logging.rint(f"[{self.node}] {text[2:]}")
+            else:
+                logging.warning(f"Node {self.node}: {line}")
+        with self._lock:
+            if self.sock is sock: self.sock = None
+            pending, self._pending = list(self._pending.values()), {}
+        for _, done in pending: done.set()
+
+class Federation:
+    """Membership of this server in a federation of nodes sharing one SQLite directory
+
+    Every node writes a heartbeat and the clients connected to it into the
+    directory. Commands for a client held by another node are forwarded to the
+    API of that node, where they run as "local <command>". The nodes share the
+    file through SQLite's file locks, so they have to run on one host.
+    """
+    HEARTBEAT_INTERVAL = 5
+    # Seconds before changes the directory did not take are written again
+    RETRY_INTERVAL = 1
+    # A node without a heartbeat for this long is taken as down
+    NODE_TIMEOUT = 20
+    FORWARD_TIMEOUT = 30
+    # Console commands forwarded to the node of their client argument
+    COMMANDS = ('send', 'run', 'sche', 'kick')
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS nodes (name TEXT PRIMARY KEY, address TEXT NOT NULL, heartbeat REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS clients (identifier TEXT PRIMARY KEY, node TEXT NOT NULL, since REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS clients_node ON clients (node)",
+    )
+
+    def __init__(self, path: str, node: str, address: str):
+        self.path = path
+        self.node = node
+        self.address = address
+        self._queue = queue.Queue()
+        # One reading connection per thread, sqlite3 connections are not shared
+        self._local = threading.local()
+        # Key: node address, Value: ForwardSession
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.lookup_latency = metrics.registry.histogram('federation_lookup_seconds', "Directory lookups of clients that are not connected here")
+        self.forwarded = metrics.registry.counter('federation_forwarded_total', "Commands forwarded to other nodes")
+
+        db = self._connect()
+        try:
+            with db:
+                for statement in Federation.SCHEMA: db.execute(statement)
+                # Left over from an earlier run of this node
+                db.execute("DELETE FROM clients WHERE node = ?", (node,))
+                db.execute("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)", (node, address, time.time()))
+        finally:
+            db.close()
+        threading.Thread(target=self._write_loop, name='federation', daemon=True).start()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Other nodes write to the same file, wait for their transactions
+        db = sqlite3.connect(self.path, timeout=10)
+        # Rollback journal, WAL keeps its index in shared memory
+        db.execute("PRAGMA journal_mode=DELETE")
+        return db
+
+    def _reader(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None: db = self._local.db = self._connect()
+        return db
+
+    def publish(self, identifier: str):
+        self._queue.put(("INSERT OR REPLACE INTO clients VALUES (?, ?, ?)", (identifier, self.node, time.time())))
+
+    def withdraw(self, identifier: str):
+        # Not if the client has moved to another node meanwhile
+        self._queue.put(("DELETE FROM clients WHERE identifier = ? AND node = ?", (identifier, self.node)))
+
+    def _write_loop(self):
+        """Write the queued changes in batches of one transaction together with the heartbeat
+
+        A batch the directory does not take at all (locked by another node, not writable)
+        is written again on the next pass, the heartbeat then comes after RETRY_INTERVAL.
+        If a statement fails, the batch is written one statement at a time and only that one is lost.
+        """
+        db = self._connect()
+        next_heartbeat = 0
+        retry = []
+        while True:
+            batch, retry = retry, []
+            wait = max(next_heartbeat - time.monotonic(), 0)
+            if batch: wait = min(wait, Federation.RETRY_INTERVAL)
+            try:
+                batch.append(self._queue.get(timeout=wait))
+                while len(batch) < 1000: batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            statements = batch
+            heartbeat = time.monotonic() >= next_heartbeat
+            if heartbeat:
+                next_heartbeat = time.monotonic() + Federation.HEARTBEAT_INTERVAL
+                statements = batch + [("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)", (self.node, self.address, time.time()))]
+            try:
+                with db:
+                    for sql, params in statements: db.execute(sql, params)
+            except sqlite3.OperationalError as e:
+                logging.error(f"Error writing federation directory, {len(batch)} change(s) will be retried: {str(e)}")
+                retry = batch
+                if heartbeat: next_heartbeat = time.monotonic() + Federation.RETRY_INTERVAL
+            except Exception:
+                for sql, params in statements:
+                    try:
+                        with db: db.execute(sql, params)
+                    except Exception as e:
+                        logging.error(f"Error writing federation directory: {str(e)}", sql=sql)
+
+    def lookup(self, identifier: str) -> tuple:
+        """(node, address) of a live node holding the client, None if there is none"""
+        with self.lookup_latency.time():
+            return self._reader().execute(
+                "SELECT clients.node, nodes.address FROM clients JOIN nodes ON nodes.name = clients.node "
+                "WHERE clients.identifier = ? AND nodes.heartbeat > ?", (identifier, time.time() - Federation.NODE_TIMEOUT)).fetchone()
+
+    def nodes(self) -> list:
+        """(name, address, seconds since heartbeat, clients) of every node in the directory"""
+        now = time.time()
+        return [(name, address, now - heartbeat, count) for name, address, heartbeat, count in self._reader().execute(
+            "SELECT nodes.name, nodes.address, nodes.heartbeat, COUNT(clients.identifier) FROM nodes "
+            "LEFT JOIN clients ON clients.node = nodes.name GROUP BY nodes.name ORDER BY nodes.name")]
+
+    def forward(self, cmd: str) -> bool:
+        """Run cmd on the node holding its client, False if it has to run here"""
+        index = 3 if cmd.split()[:2] == ['run', '-t'] else 1
+        parts = cmd.split(None, index + 1)
+        if len(parts) <= index: return False
+        identifier = parts[index] = client_manager.get_identifier(parts[index])
+        if client_manager.get_socket(identifier): return False
+        try: owner = self.lookup(identifier)
+        except sqlite3.Error as e:
+            logging.error(f"Federation lookup failed: {str(e)}")
+            return False
+        if owner is None or owner[0] == self.node: return False
+        node, address = owner
+        with self._lock:
+            session = self._sessions.get(address)
+            if session is None: session = self._sessions[address] = ForwardSession(node, address)
+        # Nicknames are per node, the other one gets the identifier
+        try: lines = session.run(' '.join(parts), Federation.FORWARD_TIMEOUT)
+        except OSError as e:
+            logging.error(f"Cannot forward to node {node} ({address}): {str(e)}")
+            return True
+        self.forwarded.inc()
+        logging.rint('\n'.join([f"Forwarded to node {node}"] + lines))
+        return True
+
+    def leave(self):
+        """Take this node and its clients out of the directory, at exit"""
+        db = self._connect()
+        try:
+            with db:
+                db.execute("DELETE FROM clients WHERE node = ?", (self.node,))
+                db.execute("DELETE FROM nodes WHERE name = ?", (self.node,))
+        except sqlite3.Error as e:
+            logging.error(f"Error leaving the federation: {str(e)}")
+        finally:
+            db.close()
+
+class BanList:
+    """Banned IP addresses and CIDR ranges (v4 and v6) with optional expiry
+
+    Exact addresses are kept in a dict, ranges in one binary prefix trie per IP
+    version, so a lookup walks at most 32 / 128 bits.
+    """
+    # Trie node: [child 0, child 1, ban entry]
+    def __init__(self):
+        # Key: ban (normalized address or network), Value: expire timestamp or None
+        self.entries = {}
+        self._exact = {}
+        self._tries = {4: [None, None, None], 6: [None, None, None]}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse(pattern: str):
+        """Normalize an address or CIDR range, raises ValueError if invalid"""
+        network = ipaddress.ip_network(pattern.strip(), strict=False)
+        if network.version == 6 and network.prefixlen >= 96 and network.network_address.ipv4_mapped:
+            network = ipaddress.ip_network(f"{network.network_address.ipv4_mapped}/{network.prefixlen - 96}")
+        return network
+
+    @staticmethod
+    def _address(ip: str):
+        address = ipaddress.ip_address(ip.split('%')[0])
+        if address.version == 6 and address.ipv4_mapped: address = address.ipv4_mapped
+        return address
+
+    @staticmethod
+    def _key(network) -> str:
+        return str(network.network_address) if network.prefixlen == network.max_prefixlen else str(network)
+
+    def add(self, pattern: str, expires: float = None) -> str:
+        """Add a ban and return its normalized key, None if it is already banned"""
+        network = BanList.parse(pattern)
+        key = BanList._key(network)
+        with self._lock:
+            if key in self.entries: return None
+            self.entries[key] = expires
+            if network.prefixlen == network.max_prefixlen:
+                self._exact[network.network_address] = key
+            else:
+                node = self._tries[network.version]
+                value = int(network.network_address)
+                for i in range(network.prefixlen):
+                    bit = (value >> (network.max_prefixlen - 1 - i)) & 1
+                    if node[bit] is None: node[bit] = [None, None, None]
+                    node = node[bit]
+                node[2] = key
+        return key
+
+    def remove(self, pattern: str) -> str:
+        """Remove a ban and return its normalized key, None if it was not banned"""
+        network = BanList.parse(pattern)
+        key = BanList._key(network)
+        with self._lock:
+            if key not in self.entries: return None
+            del self.entries[key]
+            if network.prefixlen == network.max_prefixlen:
+                del self._exact[network.network_address]
+            else:
+                node = self._tries[network.version]
+                value = int(network.network_address)
+                for i in range(network.prefixlen):
+                    node = node[(value >> (network.max_prefixlen - 1 - i)) & 1]
+                # Empty branches are left in place, they are cheap and get reused
+                node[2] = None
+        return key
+
+    def match(self, ip: str) -> str:
+        """Return the ban matching an address, None if it is not banned"""
+        try: address = BanList._address(ip)
+        except ValueError: return None
+        now = time.time()
+        with self._lock:
+            key = self._exact.get(address)
+            candidates = [key] if key is not None else []
+            node = self._tries[address.version]
+            value = int(address)
+            bits = address.max_prefixlen
+            for i in range(bits):
+                if node[2] is not None: candidates.append(node[2])
+                node = node[(value >> (bits - 1 - i)) & 1]
+                if node is None: break
+            # Expired bans are removed by their timer, this only covers the gap until it fires
+            for key in candidates:
+                expires = self.entries[key]
+                if expires is None or expires > now: return key
+        return None
+
+    def __contains__(self, ip: str) -> bool:
+        return self.match(ip) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self.entries)
+
+class TokenBucket:
+    """Accept rate limit: rate connections per second, bursts of up to burst
+
+    A rejected connection is told when to come back. Each one gets the next free
+    slot, 1 / rate seconds after the one before, so a storm returns spread out.
+    Slots are handed out up to MAX_RETRY_AFTER ahead, the rest of a storm is
+    spread at random over the second half of that instead of all coming back at the cap.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        """0 if a connection may be accepted now, otherwise the seconds it should wait"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            # The first slot is when the next token is there
+            self._next_slot = max(self._next_slot, now + (1 - self.tokens) / self.rate)
+            delay = self._next_slot - now
+            if delay > MAX_RETRY_AFTER: return random.uniform(MAX_RETRY_AFTER / 2, MAX_RETRY_AFTER)
+            self._next_slot += 1 / self.rate
+            return delay
+
+    def share(self, count: int) -> 'TokenBucket':
+        """The bucket of one of count processes accepting on the same port"""
+        return TokenBucket(self.rate / count, -(-self.burst // count))
+
+class PeerIndex:
+    """Online clients by peer address, kept sorted so a CIDR range is found with bisect"""
+    def __init__(self):
+        self._keys = []
+        # Key: (version, address as int), Value: set of identifiers
+        self._peers = {}
+
+    @staticmethod
+    def _peer_key(ip: str):
+        address = BanList._address(ip)
+        return address.version, int(address)
+
+    def add(self, ip: str, identifier: str):
+        try: key = PeerIndex._peer_key(ip)
+        except ValueError: return
+        if key not in self._peers:
+            self._peers[key] = set()
+            bisect.insort(self._keys, key)
+        self._peers[key].add(identifier)
+
+    def discard(self, ip: str, identifier: str):
+        try: key = PeerIndex._peer_key(ip)
+        except ValueError: return
+        identifiers = self._peers.get(key)
+        if identifiers is None: return
+        identifiers.discard(identifier)
+        if not identifiers:
+            del self._peers[key]
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def find(self, network) -> list:
+        """Identifiers of every client inside an ip_network"""
+        found = []
+        low = (network.version, int(network.network_address))
+        high = (network.version, int(network.broadcast_address))
+        for position in range(bisect.bisect_left(self._keys, low), len(self._keys)):
+            key = self._keys[position]
+            if key > high: break
+            found.extend(self._peers[key])
+        return found
+
+class LinePrinter:
+    """Prints streamed output line by line, every line prefixed"""
+    MAX_LINE = 65536
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.partial = ''
+
+    def write(self, data: bytes):
+        lines = (self.partial + data.decode('utf-8', 'replace')).split('\n')
+        self.partial = lines.pop()
+        if len(self.partial) > LinePrinter.MAX_LINE:
+            lines.append(self.partial)
+            self.partial = ''
+        # One write for the whole chunk
+        if lines: logging.rint('\n'.join(self.prefix + line.rstrip('\r') for line in lines))
+
+    def close(self):
+        if self.partial: logging.rint(self.prefix + self.partial)
+        self.partial = ''
+
+class Request:
+    """One command sent to one client, the future resolves to (ok, output)"""
+    def __init__(self, rid: int, identifier: str, command: str):
+        self.rid = rid
+        self.identifier = identifier
+        self.command = command
+        self.future = Future()
+        self.sent_at = time.monotonic()
+        # Round trip time in seconds, set when the result arrives
+        self.rtt: float = None
+        self.timer = None
+        # Streamed requests: called with every OUTPUT chunk, exit code set by EXIT
+        self.on_output = None
+        self.exit_code: int = None
+        # File transfers wait for the client to come back instead of failing on a disconnect
+        self.resumable = False
+
+class RequestTable:
+    """Commands waiting for their result
+
+    Framed clients echo the request id, results of legacy clients are matched
+    to their oldest pending request. Requests without a result fail with
+    FutureTimeoutError when their timeout runs out. on_drop is called with
+    every request that timed out or was cancelled, to stop it on the client.
+    """
+    def __init__(self, timers: TimerQueue, samples: int = 1024, on_drop=None):
+        self.timers = timers
+        self.on_drop = on_drop
+        # Key: request id, Value: Request
+        self._requests = {}
+        # Key: identifier, Value: dict of request id -> Request, oldest first
+        self._by_client = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # Round trip times of the latest results
+        self.rtts = deque(maxlen=samples)
+        self.completed = 0
+        self.timed_out = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def create(self, identifier: str, command: str, timeout: float, on_output=None) -> Request:
+        with self._lock:
+            request = Request(next(self._ids) & 0xFFFFFFFF, identifier, command)
+            request.on_output = on_output
+            self._requests[request.rid] = request
+            self._by_client.setdefault(identifier, {})[request.rid] = request
+        request.timer = self.timers.call_later(timeout, self._expire, request.rid, timeout)
+        return request
+
+    def _pop(self, rid: int) -> Request:
+        # Caller holds self._lock
+        request = self._requests.pop(rid, None)
+        if request is None: return None
+        client = self._by_client[request.identifier]
+        del client[rid]
+        if not client: del self._by_client[request.identifier]
+        return request
+
+    def get(self, identifier: str, rid: int) -> Request:
+        with self._lock:
+            request = self._requests.get(rid)
+        return request if request is not None and request.identifier == identifier else None
+
+    def resolve(self, identifier: str, rid: int, ok: bool, output: str) -> Request:
+        """Complete a request with its result, rid None takes the oldest request of the client"""
+        with self._lock:
+            if rid is None:
+                client = self._by_client.get(identifier)
+                if not client: return None
+                rid = next(iter(client))
+            request = self._requests.get(rid)
+            if request is None or request.identifier != identifier: return None
+            self._pop(rid)
+            request.rtt = time.monotonic() - request.sent_at
+            if not request.resumable:
+                self.rtts.append(request.rtt)
+                metrics.command_rtt.observe(request.rtt)
+            self.completed += 1
+        self.timers.cancel(request.timer)
+        request.future.set_result((ok, output))
+        return request
+
+    def fail(self, rid: int, exception: Exception):
+        with self._lock:
+            request = self._pop(rid)
+            if request is None: return
+            self.failed += 1
+        self.timers.cancel(request.timer)
+        request.future.set_exception(exception)
+
+    def fail_client(self, identifier: str, exception: Exception):
+        with self._lock:
+            rids = [rid for rid, request in self._by_client.get(identifier, {}).items() if not request.resumable]
+        for rid in rids:
+            self.fail(rid, exception)
+
+    def _expire(self, rid: int, timeout: float):
+        with self._lock:
+            request = self._pop(rid)
+            if request is None: return
+            self.timed_out += 1
+        request.future.set_exception(FutureTimeoutError(f"No result after {timeout:g}s"))
+        if self.on_drop: self.on_drop(request)
+
+    def cancel(self, rid: int) -> Request:
+        """Cancel a pending request, None if it is not pending"""
+        with self._lock:
+            request = self._pop(rid)
+            if request is None: return None
+            self.cancelled += 1
+        self.timers.cancel(request.timer)
+        request.future.cancel()
+        if self.on_drop: self.on_drop(request)
+        return request
+
+    def pending(self) -> list:
+        with self._lock:
+            return list(self._requests.values())
+
+    def rtt_summary(self) -> str:
+        with self._lock:
+            samples = sorted(self.rtts)
+            counts = f"{self.completed} completed, {self.timed_out} timed out, {self.failed} failed, {self.cancelled} cancelled"
+        if not samples: return counts
+        def percentile(q): return samples[min(int(q * len(samples)), len(samples) - 1)] * 1000
+        return (f"{counts}, p50 {percentile(0.5):.1f} ms, p95 {percentile(0.95):.1f} ms, "
+                f"p99 {percentile(0.99):.1f} ms, max {samples[-1] * 1000:.1f} ms")
+
+class FileTransfer:
+    """A put (server to client) or get (client to server) of one file
+
+    Survives disconnects of the client: when it comes back the transfer is
+    opened again and goes on from the offset the receiving side has.
+    """
+    def __init__(self, table: RequestTable, request: Request, op: str, local_path: str, remote_path: str):
+        self.table = table
+        self.request = request
+        self.op = op
+        self.local_path = local_path
+        self.remote_path = remote_path
+        request.resumable = True
+        # Connection the transfer runs on, None until FILE_READY
+        self.conn = None
+        self.lock = threading.Lock()
+        self._thread = None
+        if op == 'put':
+            self.file = open(local_path, 'rb')
+            self.sender = protocol.ChunkSender(os.fstat(self.file.fileno()).st_size)
+            self.sender.pause()
+        else:
+            self.receiver = protocol.ChunkReceiver(request.rid, local_path)
+
+    def progress(self) -> tuple:
+        if self.op == 'put': return self.sender.offset, self.sender.size
+        return self.receiver.offset, self.receiver.size
+
+    def open(self, conn: Connection):
+        """Start the transfer on a client connection, again after every reconnect"""
+        self.pause()
+        if self.op == 'put': info = {'op': 'put', 'path': self.remote_path, 'size': self.sender.size}
+        else: info = {'op': 'get', 'path': self.remote_path, 'offset': self.receiver.offset}
+        conn.send_frame(protocol.FILE_OPEN, protocol.encode_request(self.request.rid, json.dumps(info).encode('utf-8')))
+
+    def ready(self, conn: Connection, info: dict):
+        if self.op == 'put':
+            with self.lock:
+                self.conn = conn
+                self.sender.resume(min(int(info['offset']), self.sender.size))
+                # The send thread ends once every chunk is acked, a reconnect before the result needs a new one
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._send_loop, daemon=True)
+                    self._thread.start()
+            return
+        with self.lock:
+            # The file on the client is shorter than what we have, start over
+            if int(info['offset']) != self.receiver.offset: self.receiver.restart()
+            self.receiver.size = int(info['size'])
+            self.conn = conn
+            complete = self.receiver.complete
+        if complete: self._finish_get()
 
-class ScheduledMessage:
-    def __init__(self, identifier: str, message: str, execute_time: datetime):
-        self.identifier: str = identifier
-        self.message: str = message
-        self.execute_time: datetime = execute_time
+    def ack(self, offset: int, ok: bool):
+        if self.op == 'put': self.sender.ack(offset, ok)
 
-    def __lt__(self, other):
-        if not isinstance(other, ScheduledMessage):
-            return NotImplemented
-        return self.execute_time < other.execute_time
+    def chunk(self, conn: Connection, offset: int, data: bytes, ok: bool):
+        if self.op != 'get': return
+        with self.lock:
+            if self.receiver.file.closed: return
+            ack = self.receiver.write(offset, data, ok)
+            complete = self.receiver.complete
+        if ack: conn.send_frame(protocol.FILE_ACK, ack)
+        if complete: self._finish_get()
 
-    def dict(self):
-        return {"identifier": self.identifier, "message": self.message, "execute_time": self.execute_time.__str__()}
+    def pause(self):
+        self.conn = None
+        if self.op == 'put': self.sender.pause()
+
+    def close(self):
+        """The request is done, stop sending / receiving"""
+        if self.op == 'put':
+            self.sender.stop()
+            with self.lock:
+                # Otherwise the send thread closes it when it stops
+                if self._thread is None: self.file.close()
+        else:
+            with self.lock:
+                if not self.receiver.file.closed: self.receiver.close()
+
+    def _finish_get(self):
+        with self.lock:
+            if self.receiver.file.closed: return
+            self.receiver.finish()
+        self.table.resolve(self.request.identifier, self.request.rid, True,
+                           f"Saved {self.local_path} ({self.receiver.size} bytes)")
+
+    def _send_loop(self):
+        while True:
+            chunk = self.sender.next_chunk()
+            if chunk is None:
+                with self.lock:
+                    # Resumed by ready() meanwhile
+                    if self.sender.running and self.sender.offset < self.sender.size: continue
+                    self._thread = None
+                    # Complete but not resolved, the file stays open for a reconnect until close()
+                    if not self.sender.running: self.file.close()
+                    return
+            conn = self.conn
+            if conn is None: continue
+            # A failed send closes the connection, the transfer goes on after the reconnect
+            try: conn.send_file_chunk(self.request.rid, self.file, *chunk).result()
+            except OSError: pass
 
 class ClientManager:
     def __init__(self):
+
         # Key: identifier, Value: socket
         self.clients = {}
         
         # Key: identifier, Value: nickname 
         self.nicknames = {}
+        # Key: nickname, Value: identifier, kept in step with nicknames
+        self.nickname_index = {}
 
         # Key: identifier, Value: (last_disconnect_time, last_address)
         self.client_history = {}
 
-        # Item: command: ScheduledMessage
+        # Item: command: ScheduledMessage, sorted by execute_time
         self.scheduled_messages = []  
+        self.scheduler = TimerQueue('scheduler', lag_histogram=metrics.scheduler_lag)
+
+        # Banned addresses and ranges
+        self.banned_ipaddresses = BanList()
+        # Online clients by peer address
+        self.peers = PeerIndex()
 
-        # Item: ipaddress: str
-        self.banned_ipaddresses = []  
+        # Key: request id, Value: FileTransfer
+        self.transfers = {}
+        # Commands waiting for their result
+        self.requests = RequestTable(TimerQueue('requests', max_workers=2), on_drop=self._cancel_on_client)
+        self.liveness = LivenessTracker(self._evict_dead)
 
         # Locker
         self.lock = threading.Lock()
         
         # Load persistent data
-        self._data_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controler_data.json')
+        base_path = os.path.dirname(os.path.abspath(__file__))
+        self.store = DataStore(os.path.join(base_path, 'controler_data.db'), os.path.join(base_path, 'controler_data.json'))
         self._load_persistent_data()
-        
-        # Start message scheduler thread
-        self.scheduler_thread = threading.Thread(target=self._check_scheduled_messages, daemon=True)
-        self.scheduler_thread.start()
+        for sche_mess in self.scheduled_messages:
+            self._arm_scheduled_message(sche_mess)
+        for ban, expires in list(self.banned_ipaddresses.entries.items()):
+            if expires is not None: self._arm_ban_expiry(ban, expires)
 
     def _load_persistent_data(self):
         try:
-            os.makedirs(os.path.dirname(self._data_file), exist_ok=True)
-            if os.path.exists(self._data_file):
-                with open(self._data_file, 'r') as f:
-                    data = json.load(f)
-                    now = datetime.now()
-                    self.nicknames = data.get('nicknames', {})
-                    self.client_history = data.get('history', {})
-                    self.banned_ipaddresses = data.get('banned-ipaddresses', [])
-
-                    temp_messages = data.get('scheduled-messages', [])
-                    for mess in temp_messages:
-                        execute_time = datetime.strptime(mess["execute_time"], "%Y-%m-%d %H:%M:%S.%f")
-                        if (execute_time - now).total_seconds() > -5:
-                            self.scheduled_messages.append(ScheduledMessage(mess["identifier"], mess["message"], execute_time))
-                    
-                    logging.info(f"Loaded {len(self.banned_ipaddresses)} banned IP addresses and {len(self.nicknames)} nicknames and {len(self.client_history)} client records")
-            else:
-                logging.warn("No existing data file, starting fresh")
-                try:
-                    with open(self._data_file, 'w') as f:
-                        json.dump({
-                            'nicknames': {},
-                            'history': {},
-                            'banned-ipaddresses': [],
-                            'scheduled-messages': []
-                        }, f)
-                except Exception as e:
-                    logging.error(f"Error writing to data file: {str(e)}")
-                    logging.info("Starting server with empty data")
-                    self.nicknames = {}
-                    self.client_history = {}
-                    self.scheduled_messages = []
+            data = self.store.load()
+            now = datetime.now()
+            self.nicknames = {}
+            for identifier, nickname in data['nicknames'].items():
+                if nickname in self.nickname_index:
+                    logging.warning(f"Nickname {nickname} of {identifier} is already used by {self.nickname_index[nickname]}, ignored")
+                    continue
+                self.nicknames[identifier] = nickname
+                self.nickname_index[nickname] = identifier
+            self.client_history = data['history']
+            for ip_address, expires in data['banned-ipaddresses']:
+                # Durations were not checked before, inf / nan / far away expiries are kept as permanent bans
+                if expires is not None and not expires < time.time() + MAX_BAN_SECONDS: expires = None
+                try: self.banned_ipaddresses.add(ip_address, expires)
+                except ValueError: logging.warning(f"Invalid banned IP address {ip_address}, ignored")
+
+            for mess in data['scheduled-messages']:
+                # str(datetime) leaves out the microseconds when they are 0
+                time_format = "%Y-%m-%d %H:%M:%S.%f" if '.' in mess["execute_time"] else "%Y-%m-%d %H:%M:%S"
+                sche_mess = ScheduledMessage(mess["identifier"], mess["message"],
+                                             datetime.strptime(mess["execute_time"], time_format), mess["id"])
+                if (sche_mess.execute_time - now).total_seconds() > -5:
+                    self.scheduled_messages.append(sche_mess)
+                else:
+                    self.store.delete_schedule(sche_mess)
+
+            logging.info(f"Loaded {len(self.banned_ipaddresses)} banned IP addresses and {len(self.nicknames)} nicknames and {len(self.client_history)} client records")
                 
         except Exception as e:
             logging.error(f"Error loading persistent data: {str(e)}")
             self.nicknames = {}
+            self.nickname_index = {}
             self.client_history = {}
             self.scheduled_messages = []
     
     def save_data(self):
-        with open(self._data_file, 'w') as f:
-            json.dump({
-                'nicknames': self.nicknames,
-                'history': self.client_history,
-                'banned-ipaddresses': self.banned_ipaddresses,
-                'scheduled-messages': [sche_mess.dict() for sche_mess in self.scheduled_messages]
-            }, f)
+        """Wait for pending writes and compact the data file"""
+        with metrics.save_data.time():
+            self.store.flush(compact=True)
 
     def add_client(self, identifier: str, client_socket: socket.socket):
         with self.lock:
+            old_socket = self.clients.get(identifier)
+            if old_socket: self.peers.discard(old_socket.getpeername()[0], identifier)
             self.clients[identifier] = client_socket
-            self.client_history[identifier] = (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), client_socket.getsockname())
-            self.save_data()
+            self.peers.add(client_socket.getpeername()[0], identifier)
+            self.client_history[identifier] = (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), client_socket.getpeername())
+            self.store.set_history(identifier, *self.client_history[identifier])
+        self.liveness.add(identifier, client_socket)
+        if federation: federation.publish(identifier)
+        # The new connection never saw the commands sent to the old one
+        if old_socket: self.requests.fail_client(identifier, ConnectionError("Client reconnected"))
+        for transfer in self._transfers_of(identifier):
+            try: transfer.open(client_socket)
+            except OSError: pass
             
     def close_client(self, identifier):
         client_socket = self.get_socket(identifier)
         if client_socket:
-            client_socket.close()
             with self.lock:
+                # Closing a loop connection comes back here, only the first call cleans up
+                if self.clients.get(identifier) is not client_socket: return
                 del self.clients[identifier]
+                self.peers.discard(client_socket.getpeername()[0], identifier)
                 if identifier in self.client_history:
                     _, addr = self.client_history[identifier]
                     self.client_history[identifier] = (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), addr)
-                self.save_data()
+                    self.store.set_history(identifier, *self.client_history[identifier])
+            client_socket.close()
+            self.liveness.discard(identifier, client_socket)
+            if federation: federation.withdraw(identifier)
+            # Outside of the lock, failing a request runs its callbacks
+            self.requests.fail_client(identifier, ConnectionError("Client disconnected"))
+            for transfer in self._transfers_of(identifier): transfer.pause()
     
+    def _evict_dead(self, records: list):
+        logging.warning(f"Closing {len(records)} client(s) that missed {LivenessTracker.MAX_MISSED} heartbeats: "
+                        + ', '.join(self.get_name(record.identifier) for record in records),
+                        clients=[record.identifier for record in records])
+        for record in records:
+            if self.get_socket(record.identifier) is record.conn: self.close_client(record.identifier)
+            else: record.conn.close()
+
     def remove_history_client(self, identifier):
         with self.lock:
             if identifier not in self.client_history:
@@ -194,64 +2805,297 @@ class ClientManager:
                 logging.rint("Client is online now, please kick it")
                 return
             del self.client_history[identifier]
-            if self.nicknames.get(identifier):
-                del self.nicknames[identifier]
-            self.save_data()
+            self.store.delete_history(identifier)
+            if identifier in self.nicknames:
+                del self.nickname_index[self.nicknames.pop(identifier)]
+                self.store.delete_nickname(identifier)
+
+    def send_message(self, identifier: str, message: bytes, ftype: int = protocol.MESSAGE):
+        """Queue a message, returns the Request of a command or the send Future to wait on or ignore, None if it failed"""
+        with metrics.send_message.time():
+            return self._send_message(identifier, message, ftype)
 
-    def send_message(self, identifier: str, message: bytes):
+    def _send_message(self, identifier: str, message: bytes, ftype: int):
         try:
             client_socket: socket.socket = self.get_socket(identifier)
             if not client_socket:
                 logging.rint("Client not found")
                 return
             
-            # Send outside of main lock
-            client_socket.settimeout(10)
-            try:
-                client_socket.send(message)
-                if message.startswith('cmd '.encode('utf-8')):
-                    activity.add_command()
-                return True
-            except socket.timeout:
-                logging.error(f"Send timeout for {identifier}")
-            except Exception as e:
-                logging.error(f"Send error for {identifier}: {str(e)}")
-                self.close_client(identifier)
-            finally:
-                client_socket.settimeout(None)
-            
-            return False
+            # Commands are tracked until their result comes back
+            if ftype == protocol.MESSAGE and message.startswith('cmd '.encode('utf-8')):
+                request = self.send_command(identifier, message[4:].decode('utf-8'))
+                if request: request.future.add_done_callback(logging.bind(lambda _: self.output_request_result(request)))
+                return request
+
+            return self._send_frame(identifier, client_socket, ftype, message)
         except Exception as e:
             logging.error(f"\nUnexpected error in send_message: {str(e)}")
-            return False
-    
-    def ban_ipaddress(self, ip_address):
-        with self.lock: self.banned_ipaddresses.append(ip_address); clients = self.clients
-        if ip_address in self.banned_ipaddresses:
-            logging.rint("This IP address has already banned")
-            return
-        for identifier, client_socket in clients.items():
-            ipaddress = client_socket.getsockname()
-            if ipaddress[0] == ip_address:
-                self.close_client(identifier)
+            return None
+
+    def send_command(self, identifier: str, command: str, timeout: float = None, on_output=None) -> Request:
+        """Send a command as a new request, None if the client is offline or the send failed
+
+        With on_output the output is streamed to it in chunks if the client supports that,
+        otherwise request.on_output is None and the output comes with the result.
+        """
+        client_socket: socket.socket = self.get_socket(identifier)
+        if not client_socket: return None
+        # Register before sending, the result may come back before send returns
+        request = self.requests.create(identifier, command, timeout or REQUEST_TIMEOUT, on_output)
+        if protocol.FEATURE_STREAM not in client_socket.features: request.on_output = None
+        if request.on_output:
+            sent = self._send_frame(identifier, client_socket, protocol.RUN,
+                                    protocol.encode_request(request.rid, command.encode('utf-8')))
+        elif protocol.FEATURE_REQUEST_ID in client_socket.features:
+            sent = self._send_frame(identifier, client_socket, protocol.COMMAND,
+                                    protocol.encode_request(request.rid, command.encode('utf-8')))
+        else:
+            sent = self._send_frame(identifier, client_socket, protocol.MESSAGE, f"cmd {command}".encode('utf-8'))
+        if sent: return request
+        self.requests.fail(request.rid, ConnectionError("Send failed"))
+        return None
+
+    def _send_frame(self, identifier: str, client_socket: socket.socket, ftype: int, payload: bytes) -> Future:
+        """Queue a frame outside of the main lock, the Future is done once it is written, None if it cannot be queued"""
+        try:
+            return client_socket.send_frame(ftype, payload)
+        except Exception as e:
+            logging.error(f"Send error for {identifier}: {str(e)}", client=identifier)
+            self.close_client(identifier)
+        metrics.send_errors.inc()
+        return None
+
+    def deliver_result(self, identifier: str, rid: int, ok: bool, output: str):
+        if self.requests.resolve(identifier, rid, ok, output) is None:
+            # Late result of a timed out request, or a result nobody asked for
+            logging.warning(f"Result from {self.get_name(identifier)} for no pending request" + (f" (#{rid})" if rid is not None else ""), client=identifier)
+            logging.rint(output)
+
+    def deliver_output(self, identifier: str, rid: int, data: bytes):
+        request = self.requests.get(identifier, rid)
+        # Output of a request that already timed out is dropped
+        if request and request.on_output: request.on_output(data)
+
+    def deliver_exit(self, identifier: str, rid: int, exit_code: int):
+        request = self.requests.get(identifier, rid)
+        if request: request.exit_code = exit_code
+        self.deliver_result(identifier, rid, exit_code == 0, '')
+
+    def _transfers_of(self, identifier: str) -> list:
         with self.lock:
-            self.save_data()
-        logging.rint("Ban IP successful")
-    
-    def unban_ipaddress(self, ip_address):
+            return [transfer for transfer in self.transfers.values() if transfer.request.identifier == identifier]
+
+    def _transfer(self, identifier: str, rid: int) -> FileTransfer:
         with self.lock:
-            if ip_address in self.banned_ipaddresses:
-                self.banned_ipaddresses.remove(ip_address)
-                self.save_data()
-                logging.rint("Unban IP address successful")
-            else:
-                logging.rint("This IP address not banned")
-    
+            transfer = self.transfers.get(rid)
+        return transfer if transfer is not None and transfer.request.identifier == identifier else None
+
+    def start_transfer(self, op: str, identifier: str, local_path: str, remote_path: str):
+        """put a local file to a client or get a file of a client, the result is printed when it is done"""
+        client_socket = self.get_socket(identifier)
+        if not client_socket:
+            logging.rint("Client not found")
+            return
+        if protocol.FEATURE_FILES not in client_socket.features:
+            logging.rint(f"{self.get_name(identifier)} can not transfer files")
+            return
+        request = self.requests.create(identifier, f"{op} {local_path} {remote_path}", TRANSFER_TIMEOUT)
+        try: transfer = FileTransfer(self.requests, request, op, local_path, remote_path)
+        except OSError as e:
+            self.requests.fail(request.rid, e)
+            logging.rint(f"Can not open {local_path}: {str(e)}")
+            return
+        with self.lock:
+            self.transfers[request.rid] = transfer
+        request.future.add_done_callback(logging.bind(lambda _: self._end_transfer(transfer)))
+        try: transfer.open(client_socket)
+        except OSError: pass
+        logging.info(f"Transfer #{request.rid} started: {request.command}")
+
+    def transfer_ready(self, identifier: str, conn: Connection, rid: int, info: bytes):
+        transfer = self._transfer(identifier, rid)
+        if transfer is None: return
+        try: transfer.ready(conn, json.loads(info))
+        except (ValueError, KeyError, TypeError) as e:
+            self.requests.fail(rid, ConnectionError(f"Invalid FILE_READY: {str(e)}"))
+
+    def transfer_ack(self, identifier: str, rid: int, offset: int, ok: bool):
+        transfer = self._transfer(identifier, rid)
+        if transfer: transfer.ack(offset, ok)
+
+    def transfer_chunk(self, identifier: str, conn: Connection, rid: int, offset: int, data: bytes, ok: bool):
+        transfer = self._transfer(identifier, rid)
+        if transfer: transfer.chunk(conn, offset, data, ok)
+
+    def _end_transfer(self, transfer: FileTransfer):
+        with self.lock:
+            self.transfers.pop(transfer.request.rid, None)
+        transfer.close()
+        request = transfer.request
+        try: ok, output = request.future.result()
+        except CancelledError: return
+        except Exception as e:
+            logging.warning(f"Transfer #{request.rid} failed: {str(e)}")
+            return
+        if not ok:
+            logging.warning(f"Transfer #{request.rid} failed: {output}")
+            return
+        size = transfer.progress()[1] or 0
+        logging.info(f"Transfer #{request.rid} done in {request.rtt:.1f}s, {size / max(request.rtt, 0.001) / 1048576:.1f} MiB/s: {output}")
+
+    def start_download(self, identifier: str, url: str, path: str = None, sha256: str = None, size: int = None, connections: int = 1):
+        """Let a client download a URL itself, its progress is printed as it reports it"""
+        client_socket = self.get_socket(identifier)
+        if not client_socket:
+            logging.rint("Client not found")
+            return
+        name = self.get_name(identifier)
+        if protocol.FEATURE_DOWNLOAD not in client_socket.features:
+            # Old clients download without reporting anything
+            message = f"wget {url}" + (f" {path}" if path else "")
+            if self._send_frame(identifier, client_socket, protocol.MESSAGE, message.encode('utf-8')):
+                logging.info(f"{name} can not report downloads, sent: {message}")
+            return
+        printer = LinePrinter(f"[{name}] ")
+        request = self.requests.create(identifier, f"wget {url}", TRANSFER_TIMEOUT, logging.bind(printer.write))
+        info = {'url': url, 'path': path, 'sha256': sha256, 'size': size, 'connections': connections}
+        if not self._send_frame(identifier, client_socket, protocol.DOWNLOAD,
+                                protocol.encode_request(request.rid, json.dumps(info).encode('utf-8'))):
+            self.requests.fail(request.rid, ConnectionError("Send failed"))
+            logging.rint("Send failed")
+            return
+        request.future.add_done_callback(logging.bind(lambda _: self._end_download(request, printer)))
+        logging.info(f"Download #{request.rid} started on {name}: {url}", client=request.identifier, request=request.rid)
+
+    def _end_download(self, request: Request, printer: 'LinePrinter'):
+        printer.close()
+        try: ok, output = request.future.result()
+        except CancelledError: return
+        except Exception as e:
+            logging.warning(f"Download #{request.rid} failed: {str(e)}")
+            return
+        if ok: logging.info(f"Download #{request.rid} done: {output}")
+        else: logging.warning(f"Download #{request.rid} failed: {output}")
+
+    def _cancel_on_client(self, request: Request):
+        # Legacy clients can not cancel, their command runs to the end
+        client_socket = self.get_socket(request.identifier)
+        if client_socket and protocol.FEATURE_CANCEL in client_socket.features:
+            self._send_frame(request.identifier, client_socket, protocol.CANCEL, protocol.encode_request(request.rid))
+
+    def cancel_request(self, rid: int):
+        request = self.requests.cancel(rid)
+        if request is None: logging.rint("No pending command with this id")
+        else: logging.rint(f"Command #{rid} to {self.get_name(request.identifier)} cancelled")
+
+    def run_command(self, identifier: str, command: str, timeout: float = None):
+        """Run a command on a client and print its output as it arrives"""
+        printer = LinePrinter(f"[{self.get_name(identifier)}] ")
+        request = self.send_command(identifier, command, timeout, on_output=logging.bind(printer.write))
+        if request is None:
+            logging.rint("Client not found or send failed")
+            return
+        if request.on_output is None:
+            logging.info(f"{self.get_name(identifier)} can not stream output, it comes when the command exits")
+            request.future.add_done_callback(logging.bind(lambda _: self.output_request_result(request)))
+        else:
+            request.future.add_done_callback(logging.bind(lambda _: self.output_stream_end(request, printer)))
+
+    def output_stream_end(self, request: Request, printer: 'LinePrinter'):
+        printer.close()
+        name = self.get_name(request.identifier)
+        try: ok, output = request.future.result()
+        except CancelledError: return
+        except (FutureTimeoutError, ConnectionError) as e:
+            logging.warning(f"Command #{request.rid} on {name} stopped waiting: {str(e)}", client=request.identifier, request=request.rid)
+            return
+        if request.exit_code is None:
+            # COMMAND_ERROR, the command could not be started
+            logging.warning(f"Command #{request.rid} on {name} failed: {output}", client=request.identifier, request=request.rid)
+        elif ok:
+            logging.info(f"Command #{request.rid} on {name} exited with code 0 after {request.rtt:.2f}s", client=request.identifier, request=request.rid)
+        else:
+            logging.warning(f"Command #{request.rid} on {name} exited with code {request.exit_code} after {request.rtt:.2f}s", client=request.identifier, request=request.rid)
+
+    def output_request_result(self, request: Request):
+        name = self.get_name(request.identifier)
+        try: ok, output = request.future.result()
+        except CancelledError: return
+        except FutureTimeoutError as e:
+            logging.warning(f"Command #{request.rid} to {name} timed out: {str(e)}", client=request.identifier, request=request.rid)
+            return
+        except ConnectionError as e:
+            logging.warning(f"Command #{request.rid} to {name} failed: {str(e)}", client=request.identifier, request=request.rid)
+            return
+        if ok: logging.info(f"Command result from {name} (#{request.rid}, {request.rtt * 1000:.1f} ms)", client=request.identifier, request=request.rid)
+        else: logging.warning(f"Command error from {name} (#{request.rid}, {request.rtt * 1000:.1f} ms)", client=request.identifier, request=request.rid)
+        logging.rint(output)
+
+    def ban_ipaddress(self, ip_address, duration: float = None):
+        expires = time.time() + duration if duration else None
+        try:
+            with self.lock:
+                ban = self.banned_ipaddresses.add(ip_address, expires)
+                if ban is None:
+                    logging.rint("This IP address has already banned")
+                    return
+                self.store.add_ban(ban, expires)
+                victims = self.peers.find(BanList.parse(ban))
+        except ValueError:
+            logging.rint("Invalid IP address or CIDR range")
+            return
+        if worker_pool: worker_pool.sync_bans()
+        for identifier in victims:
+            self.close_client(identifier)
+        if expires is not None: self._arm_ban_expiry(ban, expires)
+        logging.rint(f"Ban IP successful, {len(victims)} client(s) kicked")
+
+    def _arm_ban_expiry(self, ban: str, expires: float):
+        try: self.scheduler.call_later(expires - time.time(), self._expire_ban, ban, expires)
+        except ValueError: logging.warning(f"Ban of {ban} expires too far in the future, it is kept until unbanned")
+
+    def _expire_ban(self, ban: str, expires: float):
+        with self.lock:
+            # Skip if it was unbanned or banned again meanwhile
+            if self.banned_ipaddresses.entries.get(ban, 0) != expires: return
+            self.banned_ipaddresses.remove(ban)
+            self.store.delete_ban(ban)
+        if worker_pool: worker_pool.sync_bans()
+        logging.info(f"Ban of {ban} expired")
+
+    def unban_ipaddress(self, ip_address):
+        try:
+            with self.lock:
+                ban = self.banned_ipaddresses.remove(ip_address)
+                if ban is not None: self.store.delete_ban(ban)
+        except ValueError:
+            logging.rint("Invalid IP address or CIDR range")
+            return
+        if ban is not None and worker_pool: worker_pool.sync_bans()
+        if ban is not None: logging.rint("Unban IP address successful")
+        else: logging.rint("This IP address not banned")
+
     def set_nickname(self, identifier: str, nickname: str):
+        """Set or, with an empty nickname, remove the nickname of a client"""
         with self.lock:
             try:
-                self.nicknames[identifier] = nickname
-                self.save_data()
+                owner = self.nickname_index.get(nickname)
+                if owner is not None and owner != identifier:
+                    logging.rint(f"Nickname {nickname} is already used by {owner}")
+                    return False
+                if nickname != identifier and (nickname in self.clients or nickname in self.client_history):
+                    logging.rint(f"Nickname {nickname} is the identifier of another client")
+                    return False
+                old_nickname = self.nicknames.pop(identifier, None)
+                if old_nickname is not None:
+                    del self.nickname_index[old_nickname]
+                if nickname:
+                    self.nicknames[identifier] = nickname
+                    self.nickname_index[nickname] = identifier
+                    self.store.set_nickname(identifier, nickname)
+                else:
+                    self.store.delete_nickname(identifier)
                 return True
             except Exception as e:
                 logging.error(f"\nError saving nickname: {str(e)}")
@@ -267,104 +3111,184 @@ class ClientManager:
     
     def get_identifier(self, identifier_or_nickname: str) -> str:
         with self.lock:
-            nknames = self.nicknames.items()
-        for identifier, name in nknames:
-            if name == identifier_or_nickname:
-                return identifier
-        return identifier_or_nickname
+            return self.nickname_index.get(identifier_or_nickname, identifier_or_nickname)
 
-    def get_name(self, identifier) -> str:
-        nickname = self.get_nickname(identifier)
+    def _display_name(self, identifier) -> str:
+        # Caller holds self.lock
+        nickname = self.nicknames.get(identifier)
         return f'{nickname} ({identifier})' if nickname else identifier
 
-    def output_online_clients(self):
+    def get_name(self, identifier) -> str:
         with self.lock:
-            online_clients = list(self.clients.items())
-        logging.rint("Online clients:")
-        if online_clients:
-            for identifier, client_socket in online_clients:
-                address = client_socket.getsockname()
-                display_name = self.get_name(identifier)
-                logging.rint(f"  {display_name}, Address: {address[0]}:{address[1]}")
-        else:
-            logging.rint("  No client online") 
-        logging.rint()
-    
-    def output_history_client(self):
-        history_clients = []
+            return self._display_name(identifier)
+
+    def resolve_targets(self, targets: str) -> list:
+        """Online identifiers for "*", a comma separated list or glob patterns of identifiers / nicknames"""
         with self.lock:
-            history_clients = list(self.client_history.items())
-        logging.rint("History clients (offline):")
-        have_history = False
-        for identifier, (last_disconnect, address) in history_clients:
-            if identifier not in self.clients:
-                have_history = True
-                display_name = self.get_name(identifier)
-                logging.rint(f"  {display_name}, Last online: {last_disconnect}, Address: {address[0]}:{address[1]}")
-        if not have_history:
-            logging.rint(f"  No history client")
-        logging.rint()
+            online = list(self.clients)
+            if targets == '*': return online
+            found = []
+            for pattern in targets.split(','):
+                if not pattern: continue
+                if any(c in pattern for c in '*?['):
+                    found.extend(identifier for identifier in online
+                                 if fnmatch.fnmatchcase(identifier, pattern)
+                                 or fnmatch.fnmatchcase(self.nicknames.get(identifier, ''), pattern))
+                else:
+                    found.append(self.nickname_index.get(pattern, pattern))
+        # Keep the order, drop duplicates
+        return list(dict.fromkeys(found))
+
+    def list_clients(self, online: bool = True, history: bool = True, match: str = None, address: str = None,
+                     since: str = None, until: str = None, sort: str = 'name', reverse: bool = False) -> tuple:
+        """(online rows, history rows) of matching (identifier, nickname, address, last seen, liveness) from one snapshot
+
+        A list not asked for is None. Last seen is a "%Y-%m-%d %H:%M:%S" string as in client_history,
+        ranges compare as text. Liveness is (seconds since seen, missed heartbeats, rtt, average rtt) or None.
+        """
+        now, wall = time.monotonic(), datetime.now()
+        online_rows, history_rows = [], []
+        # Only copy under the lock, filter and sort after
+        with self.lock:
+            if online:
+                for identifier, conn in self.clients.items():
+                    record = conn.liveness
+                    liveness = (now - record.last_seen, record.missed_total, record.rtt, record.rtt_avg) if record else None
+                    online_rows.append((identifier, self.nicknames.get(identifier, ''), conn.address, liveness))
+            if history:
+                history_rows = [(identifier, self.nicknames.get(identifier, ''), address, last_disconnect)
+                                for identifier, (last_disconnect, address) in self.client_history.items() if identifier not in self.clients]
+        online_rows = [(identifier, nickname, peer, (wall - timedelta(seconds=liveness[0] if liveness else 0)).strftime("%Y-%m-%d %H:%M:%S"), liveness)
+                       for identifier, nickname, peer, liveness in online_rows]
+        history_rows = [(identifier, nickname, peer, last_disconnect, None) for identifier, nickname, peer, last_disconnect in history_rows]
+        keys = {'name': lambda row: (row[1] or row[0]).lower(), 'id': lambda row: row[0], 'seen': lambda row: row[3],
+                'address': lambda row: (row[2][0], row[2][1])}
+        lists = []
+        for wanted, rows in ((online, online_rows), (history, history_rows)):
+            if not wanted: lists.append(None); continue
+            if match: rows = [row for row in rows if match.lower() in row[0].lower() or match.lower() in row[1].lower()]
+            if address: rows = [row for row in rows if address in f"{row[2][0]}:{row[2][1]}"]
+            if since: rows = [row for row in rows if row[3] >= since]
+            if until: rows = [row for row in rows if row[3] <= until]
+            rows.sort(key=keys[sort], reverse=reverse)
+            lists.append(rows)
+        return tuple(lists)
+
+    @staticmethod
+    def format_clients(online: bool, rows: list, offset: int = 0, limit: int = None, filtered: bool = False) -> str:
+        """One page of online / history clients"""
+        page = rows[offset:offset + limit] if limit else rows[offset:]
+        lines = ["Online clients:" if online else "History clients (offline):"]
+        for identifier, nickname, address, seen, liveness in page:
+            name = f'{nickname} ({identifier})' if nickname else identifier
+            if not online:
+                lines.append(f"  {name}, Last online: {seen}, Address: {address[0]}:{address[1]}")
+                continue
+            line = f"  {name}, Address: {address[0]}:{address[1]}"
+            if liveness is not None:
+                ago, missed, rtt, rtt_avg = liveness
+                line += f", Last seen: {ago:.0f}s ago, Missed heartbeats: {missed}"
+                if rtt is not None: line += f", RTT: {rtt * 1000:.1f} ms (avg {rtt_avg * 1000:.1f} ms)"
+            lines.append(line)
+        if not rows:
+            if filtered: lines.append("  No client matched")
+            else: lines.append("  No client online" if online else "  No history client")
+        elif len(page) < len(rows):
+            shown = f"{offset + 1}-{offset + len(page)}" if page else "none"
+            lines.append(f"  Showing {shown} of {len(rows)}, use --offset / --limit for more")
+        return '\n'.join(lines) + '\n'
 
-    def output_banned_ipaddresses(self):
-        logging.rint("Banned IPs")
-        if self.banned_ipaddresses:
-            for ipaddress in self.banned_ipaddresses:
-                logging.rint(f"  - {ipaddress}")
+    def format_banned_ipaddresses(self) -> str:
+        lines = ["Banned IPs"]
+        with self.lock:
+            bans = sorted(self.banned_ipaddresses.entries.items())
+        if bans:
+            for ban, expires in bans:
+                until = f" (until {datetime.fromtimestamp(expires).strftime('%Y-%m-%d %H:%M:%S')})" if expires else ""
+                lines.append(f"  - {ban}{until}")
         else:
-            logging.rint("  No IP banned")
-        logging.rint()
+            lines.append("  No IP banned")
+        return '\n'.join(lines) + '\n'
     
-    def output_scheduled_messages(self):
-        logging.rint("Scheduled messages:")
+    def format_scheduled_messages(self) -> str:
+        lines = ["Scheduled messages:"]
         with self.lock:
-            scheduled_messages = self.scheduled_messages
+            scheduled_messages = [(self._display_name(cmd.identifier), cmd) for cmd in self.scheduled_messages]
         
         if scheduled_messages:
-            for i, cmd in enumerate(scheduled_messages):
-                nickname = self.get_nickname(cmd.identifier)
-                display_name = f"{nickname} ({cmd.identifier})" if nickname else cmd.identifier
-                logging.rint(f"  [{i+1}] {display_name}, Message: {cmd.message}, Send time: {cmd.execute_time}")
+            for i, (display_name, cmd) in enumerate(scheduled_messages):
+                lines.append(f"  [{i+1}] {display_name}, Message: {cmd.message}, Send time: {cmd.execute_time}")
         else:
-            logging.rint("  No scheduled messages")
-        logging.rint()
+            lines.append("  No scheduled messages")
+        lines.append(f"  Scheduler lag: {self.scheduler.lag_summary()}")
+        return '\n'.join(lines) + '\n'
     
-    def _check_scheduled_messages(self):
-        while True:
-            time.sleep(0.5)
-            with self.lock:
-                if not self.scheduled_messages:
-                    continue
-                now = datetime.now()
-                changed = False
-                while self.scheduled_messages:
-                    if now >= self.scheduled_messages[0].execute_time:
-                        threading.Thread(target=self.send_scheduled_message, args=(self.scheduled_messages[0],)).start()
-                        del self.scheduled_messages[0]
-                        changed = True
-                    else: break
-                if changed: self.save_data()
-
-                    
+    def output_pending_requests(self):
+        logging.rint("Pending commands:")
+        now = time.monotonic()
+        requests = self.requests.pending()
+        if requests:
+            for request in requests:
+                with self.lock:
+                    transfer = self.transfers.get(request.rid)
+                progress = ""
+                if transfer:
+                    done, size = transfer.progress()
+                    progress = f", {done}/{size if size is not None else '?'} bytes" + ("" if transfer.conn else " (waiting for client)")
+                logging.rint(f"  #{request.rid} {self.get_name(request.identifier)}, {now - request.sent_at:.1f}s{progress}, Command: {request.command}")
+        else:
+            logging.rint("  No pending commands")
+        logging.rint(f"  Round trip: {self.requests.rtt_summary()}")
+        logging.rint()
+
+    def _arm_scheduled_message(self, sche_mess: ScheduledMessage):
+        # Wall clock only decides the delay, waiting is done on the monotonic clock
+        delay = (sche_mess.execute_time - datetime.now()).total_seconds()
+        try: sche_mess.timer = self.scheduler.call_later(delay, self._fire_scheduled_message, sche_mess)
+        except ValueError: logging.warning(f"Scheduled message for {sche_mess.identifier} is too far in the future, it never fires")
+
+    def _fire_scheduled_message(self, sche_mess: ScheduledMessage):
+        with self.lock:
+            position = bisect.bisect_left(self.scheduled_messages, sche_mess)
+            while position < len(self.scheduled_messages) and self.scheduled_messages[position] is not sche_mess:
+                position += 1
+            if position == len(self.scheduled_messages): return
+            del self.scheduled_messages[position]
+            self.store.delete_schedule(sche_mess)
+        self.send_scheduled_message(sche_mess)
+
     def send_scheduled_message(self, scheduling_message: ScheduledMessage):
         if scheduling_message.identifier not in self.clients:
-            logging.error(f"Failed to send scheduled message - Client {scheduling_message.identifier} not online")
+            logging.error(f"Failed to send scheduled message - Client {scheduling_message.identifier} not online", client=scheduling_message.identifier)
         else:
-            for _ in range(3):
-                if self.send_message(scheduling_message.identifier, scheduling_message.message.encode('utf-8')):
-                    logging.info(f"Message {scheduling_message.message} for {scheduling_message.identifier} sent successfully")
-                    break
+            sent = self.send_message(scheduling_message.identifier, scheduling_message.message.encode('utf-8'))
+            if sent is None:
+                logging.error(f"Failed to send scheduled message for {scheduling_message.identifier}", client=scheduling_message.identifier)
+            elif isinstance(sent, Future):
+                # Only queued so far, the outcome is known once it is written
+                sent.add_done_callback(logging.bind(lambda future: self._scheduled_message_sent(scheduling_message, future)))
             else:
-                logging.error(f"Failed to send scheduled message for {scheduling_message.identifier}")
+                # A "cmd ..." message is a request, its result is logged when it comes
+                logging.info(f"Message {scheduling_message.message} for {scheduling_message.identifier} sent as command #{sent.rid}", client=scheduling_message.identifier)
 
+    def _scheduled_message_sent(self, scheduling_message: ScheduledMessage, future: Future):
+        try: future.result()
+        except (CancelledError, Exception) as e:
+            logging.error(f"Failed to send scheduled message for {scheduling_message.identifier}: {str(e) or type(e).__name__}", client=scheduling_message.identifier)
+            return
+        logging.info(f"Message {scheduling_message.message} for {scheduling_message.identifier} sent successfully", client=scheduling_message.identifier)
 
     def schedule_message(self, identifier: str, message, execute_time: datetime):
         try:
+            if (execute_time - datetime.now()).total_seconds() >= TimerQueue.MAX_DELAY:
+                raise ValueError("Execute time is too far in the future")
             sche_mess = ScheduledMessage(identifier, message, execute_time)
             with self.lock:
                 # Insert sort
                 position = bisect.bisect_right(self.scheduled_messages, sche_mess)
                 self.scheduled_messages.insert(position, sche_mess)
-            self.save_data()
+                self.store.add_schedule(sche_mess)
+            self._arm_scheduled_message(sche_mess)
             return True
         except Exception as e:
             logging.rint(str(e))
@@ -373,124 +3297,355 @@ class ClientManager:
     def remove_scheduled_message(self, sche_mess_id: int):
         try:
             with self.lock:
-                del self.scheduled_messages[sche_mess_id-1]
-                self.save_data()
+                if sche_mess_id < 1: raise IndexError
+                sche_mess = self.scheduled_messages.pop(sche_mess_id-1)
+                self.store.delete_schedule(sche_mess)
+            self.scheduler.cancel(sche_mess.timer)
         except IndexError:
             logging.rint("Id out of range")
 
-class activity:
-    _lock = threading.Lock()
-    command = 0
-    def add_command():
-        with activity._lock:
-            activity.command += 1
-    
-    def reduce_command():
-        if activity.check_command():
-            with activity._lock:
-                activity.command -= 1
-        else: logging.error("Server Error: No command to reduce")
-    
-    def check_command():
-        with activity._lock:
-            return bool(activity. command)
+class FanOut:
+    """Sends one command to many clients concurrently and collects every result"""
+    def __init__(self, identifiers: list, command: str, concurrency: int = 32, timeout: float = 60, quiet: bool = False):
+        self.identifiers = identifiers
+        self.command = command
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.quiet = quiet
+        # Item: (identifier, status, seconds, output), status: ok / error / timeout / failed
+        self.results = []
+        self._lock = threading.Lock()
 
-def handle_client_message(identifier: str):
-    while True:
-        try:
-            client_socket = client_manager.get_socket(identifier)
-            if client_socket._closed: return
-            data = client_socket.recv(65536)
-            if not data: client_socket.close(); return
-            try: message = data.decode('utf-8')
-            except UnicodeDecodeError: client_manager.close_client(identifier); return
-                
-            if message == "HEARTBEAT":
-                client_manager.send_message(identifier, 'HEARTBEAT_RESPONSE'.encode('utf-8'))
-            
-            elif message.startswith("CMDRES:"):
-                if activity.check_command():
-                    logging.info(f"Command result from {client_manager.get_name(identifier)}")
-                    logging.rint(message[7:])
-                    activity.reduce_command()
-                
-            elif message.startswith("CMDERR:"):
-                if activity.check_command():
-                    logging.warning(f"Command error from {client_manager.get_name(identifier)}")
-                    logging.rint(message[7:])
-                    activity.reduce_command()
-            
-            elif message == "HEARTBEAT_RESPONSE": pass
+    def run(self):
+        self.deadline = time.monotonic() + self.timeout
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(self.identifiers)) or 1) as executor:
+            for identifier in self.identifiers:
+                executor.submit(logging.bind(self._run_one), identifier)
+        self.output_summary()
 
-            else:
-                client_manager.close_client(identifier)
-                return
+    def _run_one(self, identifier: str):
+        started = time.monotonic()
+        if started >= self.deadline:
+            self._add_result(identifier, 'timeout', 0, '')
+            return
+        # The request times out together with the whole group
+        request = client_manager.send_command(identifier, self.command, self.deadline - started)
+        if request is None:
+            self._add_result(identifier, 'failed', time.monotonic() - started, 'Send failed')
+            return
+        try: ok, output = request.future.result()
+        except FutureTimeoutError: self._add_result(identifier, 'timeout', time.monotonic() - started, '')
+        except ConnectionError as e: self._add_result(identifier, 'failed', time.monotonic() - started, str(e))
+        except CancelledError: self._add_result(identifier, 'failed', time.monotonic() - started, 'Cancelled')
+        else: self._add_result(identifier, 'ok' if ok else 'error', request.rtt, output)
+
+    def _add_result(self, identifier: str, status: str, seconds: float, output: str):
+        with self._lock:
+            self.results.append((identifier, status, seconds, output))
+        if not self.quiet and status != 'timeout':
+            logging.info(f"[{status} {seconds:.2f}s] {client_manager.get_name(identifier)}")
+            if output: logging.rint(output)
+
+    def output_summary(self):
+        counts = {status: 0 for status in ('ok', 'error', 'timeout', 'failed')}
+        for _, status, _, _ in self.results: counts[status] += 1
+        logging.rint(f"Group command finished: {len(self.results)} client(s), " + ', '.join(f"{count} {status}" for status, count in counts.items()))
+        answered = sorted((result for result in self.results if result[1] in ('ok', 'error')), key=lambda result: result[2], reverse=True)
+        if answered:
+            logging.rint("  Slowest clients:")
+            for identifier, status, seconds, _ in answered[:5]:
+                logging.rint(f"    {client_manager.get_name(identifier)}: {seconds:.2f}s ({status})")
+        late = [identifier for identifier, status, _, _ in self.results if status in ('timeout', 'failed')]
+        if late:
+            logging.rint("  No result from: " + ', '.join(client_manager.get_name(identifier) for identifier in late))
+        logging.rint()
+
+def parse_seen_time(value: str) -> str:
+    """Time in the format of client_history from a date, a date and time or an age like 90s / 30m / 2h / 7d"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1:] in units and value[:-1].replace('.', '', 1).isdigit():
+        return (datetime.now() - timedelta(seconds=float(value[:-1]) * units[value[-1]])).strftime("%Y-%m-%d %H:%M:%S")
+    return datetime.fromisoformat(value.replace('_', ' ')).strftime("%Y-%m-%d %H:%M:%S")
+
+def valid_identifier(identifier: str) -> bool:
+    return len(identifier) == 16 and all(c in '0123456789ABCDEF' for c in identifier)
+
+def read_handshake(buffer: bytes):
+    """Parse the first bytes of a connection
+
+    Returns None while more bytes are needed, otherwise (kind, value, decoder, features) where kind is
+    'client' (value: identifier), 'api' (value: password) or 'session' (value: password, decoder: the
+    bytes after the handshake line). Raises ValueError for anything else.
+    """
+    if buffer.startswith(b'IDENTIFIER:'):
+        # Legacy client, 16 characters of identifier, they may come in several reads
+        if len(buffer) < 27: return None
+        return 'client', buffer[11:27].decode('utf-8'), protocol.LegacyDecoder(), set()
+    if buffer.startswith(b'API:'):
+        return 'api', buffer[4:].decode('utf-8'), None, set()
+    if buffer.startswith(b'SESSION:'):
+        password, newline, rest = buffer[8:].partition(b'\n')
+        if not newline:
+            if len(buffer) > 256: raise ValueError("Handshake too long")
+            return None
+        return 'session', password.decode('utf-8').rstrip('\r'), rest, set()
+    if buffer.startswith(protocol.MAGIC):
+        decoder = protocol.FrameDecoder(max_frame_size=1024)
+        decoder.feed(buffer[len(protocol.MAGIC):])
+        for ftype, payload in decoder.frames():
+            if ftype != protocol.HELLO: raise ValueError("Invalid hello frame")
+            identifier, features = protocol.decode_hello(payload)
+            decoder.max_frame_size = protocol.MAX_FRAME_SIZE
+            return 'client', identifier, decoder, features
+        return None
+    if any(len(buffer) < len(prefix) and prefix.startswith(buffer) for prefix in (protocol.MAGIC, b'SESSION:', b'IDENTIFIER:', b'API:')):
+        return None
+    raise ValueError("Unknown handshake")
+
+def process_client_frame(identifier: str, ftype: int, payload: memoryview) -> bool:
+    """Handle one message from a client, return False if the client has to be closed"""
+    if ftype == protocol.HEARTBEAT:
+        client_manager.send_message(identifier, b'', protocol.HEARTBEAT_RESPONSE)
+
+    elif ftype in (protocol.COMMAND_RESULT, protocol.COMMAND_ERROR):
+        rid, output = protocol.decode_request(payload)
+        client_manager.deliver_result(identifier, rid, ftype == protocol.COMMAND_RESULT, str(output, 'utf-8'))
+
+    elif ftype == protocol.OUTPUT:
+        rid, data = protocol.decode_request(payload)
+        client_manager.deliver_output(identifier, rid, data)
+
+    elif ftype == protocol.EXIT:
+        client_manager.deliver_exit(identifier, *protocol.decode_exit(payload))
+
+    elif ftype == protocol.FILE_CHUNK:
+        client_manager.transfer_chunk(identifier, client_manager.get_socket(identifier), *protocol.decode_chunk(payload))
+
+    elif ftype == protocol.FILE_ACK:
+        client_manager.transfer_ack(identifier, *protocol.decode_ack(payload))
+
+    elif ftype == protocol.FILE_READY:
+        client_manager.transfer_ready(identifier, client_manager.get_socket(identifier), *protocol.decode_request(payload))
+
+    elif ftype in (protocol.CMDRES, protocol.CMDERR):
+        # No request id, the result belongs to the oldest pending command of the client
+        client_manager.deliver_result(identifier, None, ftype == protocol.CMDRES, str(payload, 'utf-8'))
+
+    elif ftype == protocol.HEARTBEAT_RESPONSE:
+        client_manager.liveness.pong(identifier)
+
+    else: return False
+    return True
+
+def receive_client_data(conn: Connection, data: bytes) -> bool:
+    """Feed received bytes to the decoder of the connection and handle every complete message"""
+    if data:
+        LivenessTracker.seen(conn)
+        metrics.bytes_in.inc(len(data))
+    started = time.perf_counter()
+    conn.decoder.feed(data)
+    frames = conn.decoder.frames()
+    count = 0
+    try:
+        for ftype, payload in frames:
+            count += 1
+            if not process_client_frame(conn.identifier, ftype, payload): return False
+    except (protocol.FrameError, UnicodeDecodeError):
+        return False
+    finally:
+        frames.close()
+        metrics.frames_in.inc(count)
+        metrics.client_data.observe(time.perf_counter() - started)
+    return True
+
+def handle_client_message(identifier: str, conn: Connection):
+    # Messages that came with the handshake
+    with conn.recv_lock: alive = receive_client_data(conn, b'')
+    while alive:
+        try:
+            # Waits without taking the data, a restart can hand the socket over until it is read.
+            # Closed is only checked under recv_lock, HandOff sets it for the connections it takes
+            if not conn.sock.recv(1, socket.MSG_PEEK): break
+            with conn.recv_lock:
+                if conn.closed: break
+                data = conn.recv(65536)
+                if not data: break
+                alive = receive_client_data(conn, data)
 
         except socket.timeout:
-            try: client_socket.send("HEARTBEAT".encode('utf-8'))
-            except: return
-        except Exception as e: logging.error(f"In function handle_client_message: {str(e)}"); return
+            # Idle clients are pinged by client_manager.liveness
+            continue
+        except Exception as e:
+            if not conn.closed: logging.error(f"In function handle_client_message: {str(e)}")
+            break
+    # Only drop the registry entry if it has not been taken over by a reconnect
+    if client_manager.get_socket(identifier) is conn: client_manager.close_client(identifier)
+    else: conn.close()
+
+class ApiRequest:
+    """Output target of one command of an ApiSession"""
+    def __init__(self, session: 'ApiSession', rid: str):
+        self.session = session
+        self.rid = rid
+
+    def format(self, line: str) -> list:
+        if self.rid is None: return [line]
+        return [f"{self.rid} | {part}" for part in line.split('\n')]
+
+    def end_line(self) -> str:
+        return f"{self.rid} END"
+
+class ApiSession:
+    """Commands and output of one API connection
+
+    Connections opened with a "SESSION:<password>" line send "<id> <command>" lines,
+    every output line of the command comes back as "<id> | <line>", then
+    "<id> END" when the command returns. Output of work it leaves running
+    (run, put, get, wget...) comes later with the same id. "API:<password>"
+    connections send one command per packet and get plain lines, events go to
+    the newest of them. Commands of a session run in order on its own thread.
+    """
+    MAX_LINE = 65536
+    _lock = threading.Lock()
+    active = 0
+
+    @classmethod
+    def open(cls, conn: Connection, framed: bool) -> 'ApiSession':
+        """New session, None if MAX_API_SESSIONS are open"""
+        with cls._lock:
+            if cls.active >= MAX_API_SESSIONS: return None
+            cls.active += 1
+        return cls(conn, framed)
+
+    def __init__(self, conn: Connection, framed: bool):
+        self.conn = conn
+        self.framed = framed
+        self.buffer = b''
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='api')
+
+    def feed(self, data: bytes) -> bool:
+        """Queue the commands in data, False if the connection has to be closed"""
+        if not self.framed:
+            try: self._submit(None, data.decode('utf-8'))
+            except UnicodeDecodeError: return False
+            return True
+        *lines, self.buffer = (self.buffer + data).split(b'\n')
+        if len(self.buffer) > ApiSession.MAX_LINE: return False
+        for line in lines:
+            try: rid, _, command = line.decode('utf-8').strip().partition(' ')
+            except UnicodeDecodeError: return False
+            if rid: self._submit(rid, command)
+        return True
+
+    def _submit(self, rid: str, command: str):
+        try: self.executor.submit(self._run, ApiRequest(self, rid), command)
+        except RuntimeError: pass
+
+    def _run(self, request: ApiRequest, command: str):
+        print('Execute command from API:', command)
+        with logging.output(request):
+            try: handle_command(command)
+            except Exception as e: logging.error(f"API command failed: {str(e)}")
+        if request.rid is not None: logging.end(request)
+
+    def send(self, text: str):
+        if self.closed: return
+        try: self.conn.send(text.encode('utf-8'))
+        except OSError: self.conn.close()
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.executor.shutdown(wait=False)
+        with ApiSession._lock:
+            ApiSession.active -= 1
 
-def handle_api_message(client_socket: socket.socket):
-    global API_ALLOW
+def handle_api_message(conn: Connection):
     while True:
         try:
-            data = client_socket.recv(65536)
-            command = data.decode('utf-8')
-            print('Execute command from API:', command)
-            try: handle_command(command)
-            except: pass
-        except UnicodeDecodeError: client_socket.close(); break
-        except socket.timeout: client_socket.close(); break
+            data = conn.recv(65536)
+            if not data or not conn.session.feed(data): conn.close(); break
+        except socket.timeout: conn.close(); break
         except: break
 
 def handle_client(client_socket: socket.socket, client_address, client_manager: ClientManager):
+    conn = Connection(client_socket, client_address)
     if client_address[0] in client_manager.banned_ipaddresses:
-        client_socket.close()
+        conn.close()
         return
     try:
         # First receive client identifier
-        client_socket.settimeout(10)
-        try: data = client_socket.recv(27)
-        except: client_socket.close(); return
-        if not data: client_socket.close(); return
-
-        # Decode the action
-        try: action = data.decode('utf-8')
-        except UnicodeDecodeError: client_socket.close(); return
-        if action.startswith("IDENTIFIER:"):
-            identifier = action[11:]
-            if len(identifier) != 16 or not all(c in '0123456789ABCDEF' for c in identifier):
-                client_socket.close()
+        conn.settimeout(10)
+        buffer = b''
+        try:
+            while True:
+                data = conn.recv(27)
+                if not data: conn.close(); return
+                buffer += data
+                handshake = read_handshake(buffer)
+                if handshake: break
+        except: conn.close(); return
+        kind, value, decoder, features = handshake
+
+        if kind == 'client':
+            identifier = value
+            if not valid_identifier(identifier):
+                conn.close()
+                return
+            delay = throttle()
+            if delay:
+                metrics.connections_throttled.inc()
+                # Legacy clients do not know the frame, they only see the close
+                if isinstance(decoder, protocol.FrameDecoder):
+                    try: conn.send(protocol.encode_frame(protocol.RETRY_AFTER, protocol.encode_retry_after(delay))).result(SEND_TIMEOUT)
+                    except Exception: pass
+                conn.close()
                 return
             
-            client_manager.add_client(identifier, client_socket)
-            client_socket.settimeout(30)
+            conn.accept_client(identifier, decoder, features)
+            conn.send_hello_ack()
+            client_manager.add_client(identifier, conn)
+            # Waits for data as long as it takes, the writer has its own limit
+            conn.settimeout(None)
+            conn.set_send_timeout(SEND_TIMEOUT)
 
             # Client message handler
-            handle_client_message(identifier)
+            handle_client_message(identifier, conn)
                         
-        elif action.startswith("API:"):
+        elif kind in ('api', 'session'):
             global API_ALLOW
-            if not API_ALLOW: client_socket.close(); return
-            password = action[4:]
-            if password != PASSWORD: client_socket.close(); return
-            client_socket.settimeout(60)
+            if not API_ALLOW: conn.close(); return
+            password = value
+            if password != PASSWORD: conn.close(); return
+            session = ApiSession.open(conn, kind == 'session')
+            if session is None:
+                # Closing drops what is still queued
+                try: conn.send(b"ERROR too many API sessions\n").result(SEND_TIMEOUT)
+                except Exception: pass
+                conn.close()
+                return
+            conn.kind = 'api'
+            conn.session = session
+            conn.settimeout(60)
 
             # API message handler
-            logging.warning(f"API from {client_socket.getsockname()} interrupt")
-            logging.set_sock(client_socket)
-            handle_api_message(client_socket)
-            logging.set_sock(None)
-            logging.warning(f"API from {client_socket.getsockname()} disconnected")
-        
-        else: client_socket.close(); return
+            logging.warning(f"API from {conn.getpeername()} interrupt")
+            if not session.framed: logging.set_sock(conn)
+            if decoder and not session.feed(decoder): conn.close()
+            else: handle_api_message(conn)
+            if logging.sock is conn: logging.set_sock(None)
+            session.close()
+            logging.warning(f"API from {conn.getpeername()} disconnected")
                 
     except: pass
+    finally:
+        if not conn.closed and conn.kind != 'client': conn.close()
 
-def handle_command(cmd: str):
+def handle_command(cmd: str, forward=True):
     parts = cmd.split()
     if not parts: return
+    if forward and federation and parts[0] in Federation.COMMANDS and len(parts) > 1 and federation.forward(cmd): return
 
     if parts[0] == '?':
         HelpingManager.output_all_command_helper()
@@ -505,6 +3660,30 @@ def handle_command(cmd: str):
 
     elif parts[0] == 'now':
         logging.rint(str(datetime.now()))
+
+    elif parts[0] == 'local':
+        handle_command(cmd.split(None, 1)[1] if len(parts) > 1 else '', forward=False)
+
+    elif parts[0] == 'nodes':
+        if not federation:
+            logging.rint("Not in a federation, start with --directory")
+            return
+        try:
+            lines = [f"Nodes in {federation.path}:"]
+            for name, address, age, count in federation.nodes():
+                state = "this node" if name == federation.node else "up" if age < Federation.NODE_TIMEOUT else "down"
+                lines.append(f"  {name} {address} - {count} client(s), heartbeat {age:.1f}s ago ({state})")
+            if len(parts) > 1:
+                identifier = client_manager.get_identifier(parts[1])
+                started = time.perf_counter()
+                owner = federation.lookup(identifier)
+                lines.append(f"{parts[1]}: {owner[0] if owner else 'not connected'} (lookup {(time.perf_counter() - started) * 1000:.2f} ms)")
+        except sqlite3.Error as e:
+            logging.error(f"Cannot read federation directory: {str(e)}")
+            return
+        lines.append(MetricsRegistry.describe(federation.lookup_latency))
+        lines.append(MetricsRegistry.describe(federation.forwarded))
+        logging.rint('\n'.join(lines) + '\n')
         
     elif parts[0] == 'send':
         _, identifier_or_nickname, *message = cmd.split(' ', 2)
@@ -514,6 +3693,82 @@ def handle_command(cmd: str):
         identifier = client_manager.get_identifier(identifier_or_nickname)
         client_manager.send_message(identifier, message.encode('utf-8'))
     
+    elif parts[0] == 'run':
+        args, timeout = parts[1:], None
+        if args[:1] == ['-t']:
+            try: timeout = float(args[1])
+            except (IndexError, ValueError):
+                logging.rint("Invaild option value")
+                return
+            args = args[2:]
+        if len(args) < 2:
+            logging.rint("Usage: run [-t seconds] [client] [command]")
+            return
+        # Keep the original spacing of the command
+        command = cmd.split(None, len(parts) - len(args) + 1)[-1]
+        client_manager.run_command(client_manager.get_identifier(args[0]), command, timeout)
+
+    elif parts[0] in ('put', 'get'):
+        if len(parts) < 3:
+            logging.rint(f"Usage: {parts[0]} [client] [{'local' if parts[0] == 'put' else 'remote'} path] [{'remote' if parts[0] == 'put' else 'local'} path]")
+            return
+        identifier = client_manager.get_identifier(parts[1])
+        if parts[0] == 'put':
+            local_path = parts[2]
+            remote_path = parts[3] if len(parts) > 3 else os.path.basename(local_path)
+        else:
+            remote_path = parts[2]
+            # Basename of a Windows path as well
+            local_path = parts[3] if len(parts) > 3 else os.path.basename(remote_path.replace('\\', '/'))
+        client_manager.start_transfer(parts[0], identifier, local_path, remote_path)
+
+    elif parts[0] == 'wget':
+        args, options = parts[1:], {}
+        try:
+            while args and args[0] in ('-n', '-s', '-z'):
+                option = args.pop(0)
+                if option == '-n': options['connections'] = int(args.pop(0))
+                elif option == '-s': options['sha256'] = args.pop(0)
+                else: options['size'] = int(args.pop(0))
+        except (IndexError, ValueError):
+            logging.rint("Invaild option value")
+            return
+        if len(args) < 2:
+            logging.rint("Usage: wget [-n connections] [-s sha256] [-z bytes] [client] [url] [path]")
+            return
+        client_manager.start_download(client_manager.get_identifier(args[0]), args[1], args[2] if len(args) > 2 else None, **options)
+
+    elif parts[0] == 'cancel':
+        try: client_manager.cancel_request(int(parts[1]))
+        except (IndexError, ValueError): logging.rint("Usage: cancel [id](using pending to show)")
+
+    elif parts[0] == 'pending':
+        client_manager.output_pending_requests()
+
+    elif parts[0] == 'group':
+        concurrency, timeout, quiet = 32, 60.0, False
+        args = parts[1:]
+        try:
+            while args and args[0] in ('-c', '-t', '-q'):
+                option = args.pop(0)
+                if option == '-q': quiet = True
+                elif option == '-c': concurrency = int(args.pop(0))
+                else: timeout = float(args.pop(0))
+        except (IndexError, ValueError):
+            logging.rint("Invaild option value")
+            return
+        if len(args) < 2:
+            logging.rint("Usage: group [-c concurrency] [-t seconds] [-q] [clients] [command]")
+            return
+        identifiers = client_manager.resolve_targets(args[0])
+        if not identifiers:
+            logging.rint("No client matched")
+            return
+        # Keep the original spacing of the command
+        command = cmd.split(None, len(parts) - len(args) + 1)[-1]
+        logging.info(f"Sending to {len(identifiers)} client(s): {command}")
+        FanOut(identifiers, command, concurrency, timeout, quiet).run()
+
     elif parts[0] == 'sche':
         try:
             if len(parts) < 4:
@@ -566,7 +3821,7 @@ def handle_command(cmd: str):
         if client_manager.set_nickname(identifier, nickname):
             logging.rint(f"Nickname set for {identifier}")
         else:
-            logging.rint(f"Client {identifier} not found")
+            logging.rint(f"Failed to set nickname for {identifier}")
 
     elif parts[0] == 'kick':
         identifier_or_nickname = parts[1]
@@ -575,12 +3830,18 @@ def handle_command(cmd: str):
         logging.rint(f"Kick {identifier_or_nickname} successfully")
 
     elif parts[0] == 'ban':
-        ipaddress = parts[1]
-        client_manager.ban_ipaddress(ipaddress)
+        ip_address = parts[1]
+        try: duration = float(parts[2]) if len(parts) > 2 else None
+        except ValueError: logging.rint("Duration is not a number"); return
+        # Also false for nan
+        if duration is not None and not 0 < duration <= MAX_BAN_SECONDS:
+            logging.rint(f"Duration has to be more than 0 and at most {MAX_BAN_SECONDS} seconds, leave it out for a permanent ban")
+            return
+        client_manager.ban_ipaddress(ip_address, duration)
 
     elif parts[0] == 'unban':
-        ipaddress = parts[1]
-        client_manager.unban_ipaddress(ipaddress)
+        ip_address = parts[1]
+        client_manager.unban_ipaddress(ip_address)
 
     elif parts[0] == 'rm':
         _, identifier_or_nickname = cmd.split(' ', 2)
@@ -588,34 +3849,125 @@ def handle_command(cmd: str):
         client_manager.remove_history_client(identifier)
         
     elif parts[0] == 'ls':
-        # Get snapshots to minimize lock time
-        if len(parts) == 1:
-            client_manager.output_online_clients()
-            client_manager.output_history_client()
-        elif parts[1] == '-a':
-            client_manager.output_online_clients()
-            client_manager.output_history_client()
-            client_manager.output_banned_ipaddresses()
-        elif parts[1] == '-b':
-            client_manager.output_banned_ipaddresses()
-        elif parts[1] == '-o':
-            client_manager.output_online_clients()
-        elif parts[1] == '-h':
-            client_manager.output_history_client()
-        elif parts[1] == '-s':
-            client_manager.output_scheduled_messages()
-        else:
-            logging.rint("Unknow option: " + parts[1])
-    
+        sections, query, args = [], {'limit': LS_PAGE_SIZE}, parts[1:]
+        try:
+            while args:
+                option = args.pop(0)
+                if option in ('-o', '-h', '-b', '-s'): sections.append(option)
+                elif option == '-a': sections.extend(('-o', '-h', '-b'))
+                elif option == '-r': query['reverse'] = True
+                elif option in ('--limit', '--offset'): query[option[2:]] = max(int(args.pop(0)), 0)
+                elif option in ('--match', '--address'): query[option[2:]] = args.pop(0)
+                elif option in ('--since', '--until'): query[option[2:]] = parse_seen_time(args.pop(0))
+                elif option == '--sort':
+                    query['sort'] = args.pop(0)
+                    if query['sort'] not in ('name', 'id', 'seen', 'address'): raise ValueError(f"Unknow sort key: {query['sort']}")
+                else:
+                    logging.rint("Unknow option: " + option)
+                    return
+        except IndexError:
+            logging.rint("Invaild option value")
+            return
+        except ValueError as e:
+            logging.rint(f"Invaild option value: {e}")
+            return
+        sections = list(dict.fromkeys(sections or ('-o', '-h')))
+        page = {key: query.pop(key) for key in ('offset', 'limit') if key in query}
+        filtered = any(query.get(key) for key in ('match', 'address', 'since', 'until'))
+        # Online and history clients from one snapshot, the whole listing is written at once
+        if '-o' in sections or '-h' in sections:
+            online, history = client_manager.list_clients('-o' in sections, '-h' in sections, **query)
+        texts = []
+        for section in sections:
+            if section == '-o': texts.append(client_manager.format_clients(True, online, filtered=filtered, **page))
+            elif section == '-h': texts.append(client_manager.format_clients(False, history, filtered=filtered, **page))
+            elif section == '-b': texts.append(client_manager.format_banned_ipaddresses())
+            else: texts.append(client_manager.format_scheduled_messages())
+        logging.rint('\n'.join(texts))
+
     elif parts[0] == 'save':
         logging.info("Saving data...")
         try:
-            with client_manager.lock:
-                client_manager.save_data()
+            client_manager.save_data()
             logging.info("Save server data successfully")
         except Exception as e:
             logging.error(f"While saving data: {str(e)}")
 
+    elif parts[0] == 'status':
+        clients, apis, total = Connection.count()
+        memory = get_memory_usage()
+        logging.rint(f"Server mode: {SERVER_MODE}")
+        logging.rint(f"  Connections: {total} ({clients} clients, {apis} API, {total - clients - apis} pending)")
+        logging.rint(f"  Threads: {threading.active_count()}")
+        if memory:
+            logging.rint(f"  Memory: {memory / 1048576:.1f} MiB")
+            if total:
+                per_connection = max(memory - BASE_MEMORY, 0) / total
+                logging.rint(f"  Memory per connection: {per_connection / 1024:.1f} KiB")
+        else:
+            logging.rint("  Memory: unknown")
+        logging.rint(f"  Compression: {compression_stats.summary()}")
+        logging.rint(f"  Liveness: {client_manager.liveness.summary()}")
+        if worker_pool: logging.rint(f"  Workers: {worker_pool.summary()}")
+        logging.rint()
+
+    elif parts[0] == 'stats':
+        logging.rint("Metrics:\n" + '\n'.join("  " + line for line in metrics.registry.summary()) + "\n")
+
+    elif parts[0] == 'profile':
+        interval, duration, count, idle, args = 10.0, 60.0, 20, False, parts[1:]
+        action = args.pop(0) if args and not args[0].startswith('-') else ''
+        try:
+            while args and args[0] in ('-i', '-t', '-n', '-a'):
+                option = args.pop(0)
+                if option == '-a': idle = True
+                elif option == '-i': interval = float(args.pop(0))
+                elif option == '-t': duration = float(args.pop(0))
+                else: count = int(args.pop(0))
+        except (IndexError, ValueError):
+            logging.rint("Invaild option value")
+            return
+        if action == 'start':
+            if profiler.start(max(interval, 1) / 1000, duration): logging.info(f"Profiling every {interval:g} ms for up to {duration:g}s")
+            else: logging.rint("Profiler is already running")
+        elif action in ('stop', ''):
+            if action == 'stop' and not profiler.stop() and not profiler.samples:
+                logging.rint("Profiler is not running")
+                return
+            lines = profiler.top(count, idle)
+            if args:
+                try:
+                    profiler.write(args[0])
+                    lines.append(f"Collapsed stacks written to {args[0]}")
+                except OSError as e:
+                    lines.append(f"Cannot write {args[0]}: {e}")
+            logging.rint("Profile:\n" + '\n'.join("  " + line for line in lines) + "\n")
+        else:
+            logging.rint("Usage: profile [start|stop] [-i ms] [-t seconds] [-n count] [-a] [file]")
+
+    elif parts[0] == 'memprofile':
+        frames, count, args = 1, 20, parts[1:]
+        action = args.pop(0) if args and args[0] in ('start', 'stop') else ''
+        try:
+            while args and args[0] in ('-f', '-n'):
+                option = args.pop(0)
+                if option == '-f': frames = int(args.pop(0))
+                else: count = int(args.pop(0))
+        except (IndexError, ValueError):
+            logging.rint("Invaild option value")
+            return
+        if action == 'start':
+            if allocation_tracer.start(max(frames, 1)): logging.info(f"Tracing allocations, {max(frames, 1)} frame(s) each")
+            else: logging.rint("Allocations are already traced")
+        elif action == 'stop':
+            if allocation_tracer.stop(): logging.info("Stopped tracing allocations")
+            else: logging.rint("Allocations are not traced")
+        else:
+            try: lines = allocation_tracer.top(count, args[0] if args else None)
+            except OSError as e: lines = [f"Cannot write {args[0]}: {e}"]
+            if args and len(lines) > 1: lines.append(f"Snapshot written to {args[0]}, load it with tracemalloc.Snapshot.load")
+            logging.rint("Memory profile:\n" + '\n'.join("  " + line for line in lines) + "\n")
+
     elif parts[0] == 'kapi':
         global API_ALLOW
         API_ALLOW = not API_ALLOW
@@ -630,18 +3982,29 @@ def handle_command(cmd: str):
 
     elif parts[0] == 'restart':
         logging.info("Restarting server...")
-        python = sys.executable
-        os.execv(python, ['python'] + sys.argv)
+        try: client_manager.save_data()
+        except sqlite3.Error as e: logging.error(f"While saving data: {str(e)}")
+        argv = list(sys.argv)
+        if '--takeover' in argv: del argv[argv.index('--takeover'):argv.index('--takeover') + 2]
+        if not HandOff.supported():
+            logging.flush()
+            os.execv(sys.executable, ['python'] + argv)
+        # The loop thread stops reading by running it
+        if event_loop: event_loop.call_soon_threadsafe(HandOff.restart, argv)
+        else: HandOff.restart(argv)
 
     elif parts[0] == 'exit' or parts[0] == 'quit':
         logging.info("Saving data...")
-        with client_manager.lock:
-            client_manager.save_data()
+        try: client_manager.save_data()
+        except sqlite3.Error as e: logging.error(f"While saving data: {str(e)}")
+        if federation: federation.leave()
         logging.info("Shutting down server...")
+        logging.flush()
         os._exit(0)
 
     elif parts[0] == 'fquit':
         logging.info("Force quiting...")
+        logging.flush(1)
         os._exit(0)
 
     else:
@@ -655,23 +4018,63 @@ def server_io():
         except Exception as e:
             logging.error(f"Input error: {str(e)}")
 
-def start_server(host='0.0.0.0', port=30003):
+def start_server(host='0.0.0.0', port=30003, mode='thread', workers=0, takeover: int = None):
+    global SERVER_MODE, BASE_MEMORY, worker_pool, listen_socket, event_loop
     try:
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((host, port))
-        server_socket.listen(5)
-        logging.info(f"Server started on {host}:{port}")
+        if workers:
+            if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+                logging.error("Worker processes need fork and SO_REUSEPORT (Linux)")
+                return
+            # Fails here if the port is taken by something else, the workers bind their own sockets
+            probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            probe.bind((host, port))
+            SERVER_MODE = 'workers'
+            BASE_MEMORY = get_memory_usage()
+            worker_pool = WorkerPool(workers, host, port)
+            worker_pool.start()
+            probe.close()
+            logging.info(f"Server started on {host}:{port} ({workers} worker processes)")
+            threading.Thread(target=server_io, daemon=True).start()
+            while True:
+                try:
+                    worker_pool.wait()
+                    logging.error("Every worker process has exited")
+                    return
+                except KeyboardInterrupt:
+                    logging.rint("\nCought Ctrl+C")
+                    logging.rint("Type 'exit' to quit")
+
+        if takeover is None: server_socket, adopted = open_listener(host, port), []
+        else: server_socket, adopted = HandOff.receive(takeover)
+        listen_socket = server_socket
+        SERVER_MODE = mode
+        BASE_MEMORY = get_memory_usage()
+        logging.info(f"Server started on {host}:{port} ({mode} mode)")
         
         # 启动服务端输入线程
         input_thread = threading.Thread(target=server_io, daemon=True)
         input_thread.start()
-        
+
+        if mode == 'loop':
+            loop = event_loop = EventLoopServer(server_socket, client_manager)
+            HandOff.adopt(adopted, loop)
+            while True:
+                try: loop.serve_forever()
+                except KeyboardInterrupt:
+                    logging.rint("\nCought Ctrl+C")
+                    logging.rint("Type 'exit' to quit")
+
+        server_socket.setblocking(True)
+        HandOff.adopt(adopted)
         while True:
             try:
                 client_socket, client_address = server_socket.accept()
                 if client_address[0] in client_manager.banned_ipaddresses:
+                    metrics.connections_rejected.inc()
                     client_socket.close()
                     continue
+                metrics.connections_accepted.inc()
                 client_thread = threading.Thread(
                     target=handle_client,
                     args=(client_socket, client_address, client_manager),
@@ -694,11 +4097,90 @@ def start_server(host='0.0.0.0', port=30003):
         logging.error(f"Server error: {e}")
     
     finally:
+        logging.flush()
         sys.exit(0)
 
+compression_stats = protocol.CompressionStats()
+metrics = ServerMetrics()
 client_manager = ClientManager()
+profiler = StackSampler()
+allocation_tracer = AllocationTracer()
 PASSWORD: str = 'frank666'
 API_ALLOW = True
+# API connections open at once
+MAX_API_SESSIONS = 8
+# Longest ban with a duration (10 years)
+MAX_BAN_SECONDS = 10 * 365 * 86400
+# Clients shown by ls unless --limit says otherwise
+LS_PAGE_SIZE = 100
+# Bytes waiting to be sent to one connection before it is closed as a slow consumer
+MAX_OUTBOUND_BYTES = 8 * 1048576
+# Queued messages written with one syscall, up to this many bytes
+WRITE_BATCH_BYTES = 256 * 1024
+# Seconds an idle writer thread waits for more before it exits
+WRITER_LINGER = 2
+# Seconds one write may block before the connection is closed
+SEND_TIMEOUT = 10
+# Seconds a command may take before its request is dropped
+REQUEST_TIMEOUT = 600
+# Seconds a file transfer may take, reconnects included
+TRANSFER_TIMEOUT = 24 * 3600
+# thread: one thread per connection, loop: every connection on one event loop, workers: see WorkerPool
+SERVER_MODE = 'thread'
+# WorkerPool with --workers
+worker_pool: WorkerPool = None
+# Federation with --directory
+federation: Federation = None
+# Listening socket and EventLoopServer of this process, handed over by restart
+listen_socket: socket.socket = None
+event_loop: EventLoopServer = None
+# Seconds a restart waits for busy client threads and queued data before the clients are handed over
+HANDOFF_DRAIN_TIMEOUT = 5
+# Connections waiting for accept in the kernel, it caps this at net.core.somaxconn
+LISTEN_BACKLOG = 1024
+# TokenBucket with --accept-rate
+admission: TokenBucket = None
+# Seconds a rejected connection is told to wait at most
+MAX_RETRY_AFTER = 60
+BASE_MEMORY = 0
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="Controller server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=30003)
+    parser.add_argument('--mode', choices=('thread', 'loop'), default='thread',
+                        help="thread: one thread per connection, loop: single event loop")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Accept in this many worker processes on one SO_REUSEPORT port, the clients are managed by this process")
+    parser.add_argument('--directory', help="Join a federation of servers sharing this SQLite file as client directory")
+    parser.add_argument('--node', help="Name of this server in the federation (host-port)")
+    parser.add_argument('--advertise', help="HOST:PORT other nodes forward commands to (127.0.0.1:port)")
+    parser.add_argument('--metrics-port', type=int, help="Serve the metrics for Prometheus on 127.0.0.1:PORT/metrics")
+    parser.add_argument('--log-file', help="Also write log records to this file as JSON lines, rotated at 10 MiB")
+    parser.add_argument('--log-queue', type=int, default=10000, help="Log records waiting for the writer at most")
+    parser.add_argument('--log-overflow', choices=Logger.OVERFLOW_POLICIES, default='block',
+                        help="What to do with a new log record when the queue is full (the event loop never blocks)")
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, help="Length of the accept queue")
+    parser.add_argument('--accept-rate', type=float, default=0,
+                        help="New clients accepted per second at most, the others are told when to retry (0: no limit, API connections are never limited)")
+    parser.add_argument('--accept-burst', type=int, help="Clients accepted at once above --accept-rate (one second's worth)")
+    # Descriptor of the sockets handed over by restart, see HandOff
+    parser.add_argument('--takeover', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    LISTEN_BACKLOG = max(args.backlog, 1)
+    if args.accept_rate > 0:
+        admission = TokenBucket(args.accept_rate, args.accept_burst or max(int(args.accept_rate), 1))
+    logging.max_queue = max(args.log_queue, 1)
+    logging.overflow = args.log_overflow
+    if args.log_file: logging.set_file(args.log_file)
+    if args.metrics_port:
+        try: serve_metrics('127.0.0.1', args.metrics_port)
+        except OSError as e: logging.error(f"Cannot serve metrics on port {args.metrics_port}: {e}")
+    if args.directory:
+        node = args.node or f"{socket.gethostname()}-{args.port}"
+        try: federation = Federation(args.directory, node, args.advertise or f"127.0.0.1:{args.port}")
+        except sqlite3.Error as e:
+            logging.error(f"Cannot open federation directory {args.directory}: {e}")
+            sys.exit(1)
+        logging.info(f"Node {node} joined the federation in {args.directory}")
+    start_server(args.host, args.port, args.mode, max(args.workers, 0), args.takeover)
@@ -0,0 +1,159 @@
+import os
+import tempfile
+import unittest
+
+import protocol
+
+def decode_all(decoder: protocol.FrameDecoder, data: bytes) -> list:
+    decoder.feed(data)
+    return [(ftype, bytes(payload)) for ftype, payload in decoder.frames()]
+
+def compressed_pair() -> tuple:
+    encoder = protocol.FrameEncoder(compress=True)
+    decoder = protocol.FrameDecoder()
+    decoder.inflate = True
+    return encoder, decoder
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_round_trip(self):
+        frames = [(protocol.HEARTBEAT, b''), (protocol.MESSAGE, b'cmd ls'), (protocol.OUTPUT, os.urandom(100000))]
+        data = b''.join(protocol.encode_frame(ftype, payload) for ftype, payload in frames)
+        self.assertEqual(decode_all(protocol.FrameDecoder(), data), frames)
+
+    def test_split_across_feeds(self):
+        frames = [(protocol.MESSAGE, b'first'), (protocol.COMMAND, protocol.encode_request(7, b'uptime')), (protocol.HEARTBEAT, b'')]
+        data = b''.join(protocol.encode_frame(ftype, payload) for ftype, payload in frames)
+        decoder, received = protocol.FrameDecoder(), []
+        for i in range(len(data)): received += decode_all(decoder, data[i:i + 1])
+        self.assertEqual(received, frames)
+        self.assertEqual(decoder.buffered(), b'')
+
+    def test_partial_frame_stays_buffered(self):
+        data = protocol.encode_frame(protocol.MESSAGE, b'hello')
+        decoder = protocol.FrameDecoder()
+        self.assertEqual(decode_all(decoder, data[:-2]), [])
+        self.assertEqual(decoder.buffered(), data[:-2])
+        self.assertEqual(decode_all(decoder, data[-2:]), [(protocol.MESSAGE, b'hello')])
+
+    def test_frame_over_limit(self):
+        decoder = protocol.FrameDecoder(max_frame_size=10)
+        decoder.feed(protocol.encode_frame(protocol.MESSAGE, b'x' * 11))
+        with self.assertRaises(protocol.FrameError): list(decoder.frames())
+
+    def test_kept_payload_slice(self):
+        decoder = protocol.FrameDecoder()
+        decoder.feed(protocol.encode_frame(protocol.MESSAGE, b'hello') + protocol.encode_frame(protocol.MESSAGE, b'world'))
+        kept = [payload[1:] for _, payload in decoder.frames()]
+        self.assertEqual(decode_all(decoder, protocol.encode_frame(protocol.MESSAGE, b'again')), [(protocol.MESSAGE, b'again')])
+        self.assertEqual([view.tobytes() for view in kept], [b'ello', b'orld'])
+
+    def test_compressed_frame_needs_inflate(self):
+        encoder = protocol.FrameEncoder(compress=True, threshold=0)
+        decoder = protocol.FrameDecoder()
+        decoder.feed(encoder.encode(protocol.OUTPUT, b'x' * 100))
+        with self.assertRaises(protocol.FrameError): list(decoder.frames())
+
+    def test_legacy_decoder(self):
+        decoder = protocol.LegacyDecoder()
+        self.assertEqual(decode_all(decoder, b'HEARTBEAT'), [(protocol.HEARTBEAT, b'')])
+        self.assertEqual(decode_all(decoder, b'CMDRES:done'), [(protocol.CMDRES, b'done')])
+        self.assertEqual(decode_all(decoder, b'hi'), [(protocol.MESSAGE, b'hi')])
+        self.assertIsNone(decoder.history())
+
+class CompressionTest(unittest.TestCase):
+    def test_threshold_boundary(self):
+        encoder, decoder = compressed_pair()
+        below = encoder.encode(protocol.OUTPUT, b'a' * (protocol.COMPRESS_THRESHOLD - 1))
+        at = encoder.encode(protocol.OUTPUT, b'a' * protocol.COMPRESS_THRESHOLD)
+        self.assertFalse(below[protocol.HEADER.size - 1] & protocol.COMPRESSED)
+        self.assertTrue(at[protocol.HEADER.size - 1] & protocol.COMPRESSED)
+        self.assertEqual(decode_all(decoder, below + at), [(protocol.OUTPUT, b'a' * (protocol.COMPRESS_THRESHOLD - 1)),
+                                                            (protocol.OUTPUT, b'a' * protocol.COMPRESS_THRESHOLD)])
+
+    def test_stream_over_many_frames(self):
+        encoder, decoder = compressed_pair()
+        payloads = [(b'line %d of the output\n' % i) * 50 for i in range(200)]
+        data = b''.join(encoder.encode(protocol.OUTPUT, payload) for payload in payloads)
+        self.assertEqual([payload for _, payload in decode_all(decoder, data)], payloads)
+
+    def test_history_before_stream(self):
+        encoder, decoder = compressed_pair()
+        encoder.encode(protocol.OUTPUT, b'short')
+        self.assertIsNone(encoder.history())
+        self.assertIsNone(decoder.history())
+
+    def test_continue_stream(self):
+        # Both ends of a connection, the server side is handed to a new process halfway
+        client_encoder, server_decoder = compressed_pair()
+        server_encoder, client_decoder = compressed_pair()
+        payloads = [os.urandom(20000) + b'repeated text ' * 200 for _ in range(4)]
+        for payload in payloads:
+            self.assertEqual(decode_all(server_decoder, client_encoder.encode(protocol.OUTPUT, payload)), [(protocol.OUTPUT, payload)])
+            self.assertEqual(decode_all(client_decoder, server_encoder.encode(protocol.OUTPUT, payload)), [(protocol.OUTPUT, payload)])
+        self.assertEqual(len(server_encoder.history()), protocol.ZLIB_WINDOW)
+
+        new_encoder = protocol.FrameEncoder(compress=True)
+        new_encoder.continue_stream(server_encoder.history())
+        new_decoder = protocol.FrameDecoder()
+        new_decoder.inflate = True
+        new_decoder.continue_stream(server_decoder.history())
+        # Refers back to what went through the old stream
+        payload = payloads[-1][-5000:] + b'more'
+        self.assertEqual(decode_all(client_decoder, new_encoder.encode(protocol.OUTPUT, payload)), [(protocol.OUTPUT, payload)])
+        self.assertEqual(decode_all(new_decoder, client_encoder.encode(protocol.OUTPUT, payload)), [(protocol.OUTPUT, payload)])
+
+class PayloadTest(unittest.TestCase):
+    def test_hello(self):
+        hello = protocol.encode_hello('0123456789abcdef', {'rid', 'zlib'})
+        self.assertEqual(protocol.decode_hello(hello), ('0123456789abcdef', {'rid', 'zlib'}))
+        with self.assertRaises(protocol.FrameError): protocol.decode_hello(b'NAME:x')
+
+    def test_request_and_exit(self):
+        self.assertEqual(protocol.decode_request(protocol.encode_request(42, b'ls')), (42, b'ls'))
+        self.assertEqual(protocol.decode_exit(protocol.encode_request(42, protocol.EXIT_CODE.pack(-1))), (42, -1))
+        with self.assertRaises(protocol.FrameError): protocol.decode_request(b'\0')
+
+    def test_chunk(self):
+        header = protocol.encode_chunk_header(3, 65536, b'data')
+        self.assertEqual(protocol.decode_chunk(header + b'data'), (3, 65536, b'data', True))
+        self.assertFalse(protocol.decode_chunk(header + b'date')[3])
+
+    def test_retry_after_rounds_up(self):
+        self.assertEqual(protocol.decode_retry_after(protocol.encode_retry_after(1.0001)), 1.001)
+        with self.assertRaises(protocol.FrameError): protocol.decode_retry_after(b'\0')
+
+    def test_backoff_delay(self):
+        for attempt in range(40):
+            self.assertTrue(0 <= protocol.backoff_delay(attempt, 5, 60) <= 60)
+        self.assertTrue(10 <= protocol.backoff_delay(0, 5, 60, retry_after=10) <= 11)
+
+class ChunkTest(unittest.TestCase):
+    def test_sender_window_and_nack(self):
+        sender = protocol.ChunkSender(10, window=2, chunk_size=3)
+        self.assertEqual([sender.next_chunk(), sender.next_chunk()], [(0, 3), (3, 3)])
+        sender.ack(3, False)
+        self.assertEqual(sender.next_chunk(), (3, 3))
+        sender.ack(6, True)
+        self.assertEqual([sender.next_chunk(), sender.next_chunk()], [(6, 3), (9, 1)])
+        sender.ack(10, True)
+        self.assertIsNone(sender.next_chunk())
+
+    def test_receiver_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'file')
+            receiver = protocol.ChunkReceiver(1, path)
+            self.assertEqual(protocol.decode_ack(receiver.write(0, b'abc', True)), (1, 3, True))
+            self.assertEqual(protocol.decode_ack(receiver.write(3, b'xxx', False)), (1, 3, False))
+            # Chunks after the bad one are dropped until it comes again
+            self.assertIsNone(receiver.write(6, b'ghi', True))
+            receiver.close()
+            receiver = protocol.ChunkReceiver(1, path)
+            self.assertEqual(receiver.offset, 3)
+            receiver.size = 6
+            receiver.write(3, b'def', True)
+            self.assertTrue(receiver.complete)
+            receiver.finish()
+            with open(path, 'rb') as f: self.assertEqual(f.read(), b'abcdef')
+
+if __name__ == '__main__':
+    unittest.main()